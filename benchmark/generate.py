@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""
+規模の検証やダッシュボードの負荷試験のために、複数年分の水やりのデータを合成して
+メトリクスのデータベースとログのデータベースに書き込みます。
+
+合成するデータは以下の通りです。
+- 季節によって時間が変わる自動の水やりと、それに混ざる手動の水やり
+- 雨の日の自動の水やりの見合わせと、スケジュール実行の遅延
+- 数日続くエラー (短い間に続いた同じエラーは、アプリと同様に 1 行にまとめる)
+- 水やり毎の流量の推移 (-f を指定した場合)
+
+1 日あたりの自動の水やりの回数を増やすことで、百万件単位のデータもまとめて書き込んで短時間で作成できます。
+なお、ログのデータベースは、アプリが書き込む度に 60 日より古いものが削除されます。
+
+Usage:
+  generate.py [-c CONFIG] [-m PATH] [-l PATH] [-y YEARS] [-s COUNT] [-f PATH] [-r SEED] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込み、書き込み先の既定値とします。
+                      [default: config.example.yaml]
+  -m PATH           : メトリクスのデータベースを指定します。(指定しない場合は設定ファイルの値)
+  -l PATH           : ログのデータベースを指定します。(指定しない場合は設定ファイルの値)
+  -y YEARS          : 合成する期間 [年] を指定します。[default: 3]
+  -s COUNT          : 1 日あたりの自動の水やりの回数を指定します。[default: 2]
+  -f PATH           : 水やり毎の流量の推移を JSON Lines 形式で書き出します。
+  -r SEED           : 乱数のシードを指定します。[default: 0]
+  -D                : デバッグモードで動作します。
+"""
+
+import datetime
+import json
+import logging
+import math
+import pathlib
+import random
+import sqlite3
+import time
+
+import rasp_water.metrics.collector
+import rasp_water.metrics.migration
+
+SCHEMA_CONFIG = "config.schema"
+
+# NOTE: 1 回のトランザクションで書き込む水やりの件数
+INSERT_BATCH_SIZE = 100000
+
+# NOTE: 自動の水やりの時間 [分]。真夏に最大、真冬に最小になる
+AUTO_PERIOD_MIN = 2
+AUTO_PERIOD_MAX = 15
+# NOTE: 最も暑い日 (年始からの日数)
+PEAK_DAY_OF_YEAR = 210
+
+# NOTE: 自動の水やり 1 回あたりに、手動の水やりが行われる確率
+MANUAL_RATIO = 0.2
+MANUAL_HOST_LIST = ["iPhone", "Pixel", "Desktop"]
+
+# NOTE: 雨の日の確率。梅雨 (RAINY_DAY_OF_YEAR 前後) に増える
+RAIN_RATIO = 0.15
+RAINY_SEASON_RATIO = 0.35
+RAINY_DAY_OF_YEAR = 175
+
+# NOTE: エラーが発生し始める日の確率と、続く日数
+ERROR_BURST_RATIO = 0.02
+ERROR_BURST_DAYS_MAX = 3
+# NOTE: 天気の取得に失敗するなどして、スケジュール実行が失敗する確率
+SCHEDULE_FAIL_RATIO = 0.005
+SCHEDULE_RETRY_COUNT = 3
+
+# NOTE: 流量 [L/min] と、バルブを開いてから流量が安定するまで、閉じてから 0 になるまでの時間 [秒]
+FLOW_RATE_MEAN = 2.5
+FLOW_RATE_SIGMA = 0.2
+FLOW_NOISE_SIGMA = 0.05
+FLOW_RISE_SEC = 3
+FLOW_FALL_SEC = 5
+# NOTE: 流量が 0 になってから計測を終えるまでの時間 [秒] (control.valve.TIME_ZERO_TAIL 相当)
+FLOW_ZERO_TAIL_SEC = 5
+
+ERROR_MESSAGE_LIST = [
+    "😵 元栓が閉まっている可能性があります。",
+    "😵 バルブを閉めても水が流れ続けています。",
+    "😵水が流れすぎています。",
+]
+
+# NOTE: my_lib.webapp.log と同じテーブル (時刻は UTC の文字列)
+SQL_CREATE_LOG = (
+    "CREATE TABLE IF NOT EXISTS log(id INTEGER primary key autoincrement, date INTEGER, message TEXT)"
+)
+
+# NOTE: 時刻は UNIX 時間で渡し、文字列への変換は SQLite に任せる (Python で変換すると遅い)。
+# 形式は、アプリが書き込む値 (ローカル時刻の datetime) と同じになる。UNIX 時間は列毎に渡す。
+SQL_LOCALTIME = "datetime(?, 'unixepoch', 'localtime')"
+SQL_LOCALDATE = "date(?, 'unixepoch', 'localtime')"
+
+SQL_INSERT_LOG = "INSERT INTO log VALUES (NULL, datetime(?, 'unixepoch'), ?)"
+
+SQL_INSERT_WATERING = f"""
+    INSERT INTO watering_metrics
+    (timestamp, ts, date, operation_type, duration_seconds, volume_liters)
+    VALUES ({SQL_LOCALTIME}, ?, {SQL_LOCALDATE}, ?, ?, ?)
+"""
+
+# NOTE: まとめて記録したエラーは、発生回数と最後の発生時刻も書き込む
+SQL_INSERT_ERROR = f"""
+    INSERT INTO error_metrics
+    (date, error_type, error_message, timestamp, ts, last_timestamp, last_ts, count)
+    VALUES (
+        {SQL_LOCALDATE}, ?, ?, {SQL_LOCALTIME}, ?, {SQL_LOCALTIME}, ?, ?
+    )
+"""
+
+SQL_INSERT_SCHEDULE = f"""
+    INSERT INTO schedule_metrics
+    (timestamp, ts, period_seconds, result, retry_count, dispatch_delay_seconds, open_delay_seconds)
+    VALUES ({SQL_LOCALTIME}, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def get_per_day(count, year):
+    """水やりの件数がおよそ count 件になる、1 日あたりの自動の水やりの回数"""
+    # NOTE: 雨の日 (梅雨を除くとおよそ RAIN_RATIO) は自動の水やりを見合わせ、手動の水やりが加わる
+    watering_per_slot = 1 - RAIN_RATIO + MANUAL_RATIO
+
+    return max(round(count / (365 * year) / watering_per_slot), 1)
+
+
+class Generator:
+    def __init__(self, rng, per_day, flow_file=None):
+        self.rng = rng
+        self.per_day = per_day
+        self.flow_file = flow_file
+
+        self.clear()
+
+        self.error_burst_end = None
+        self.error_message = None
+        # NOTE: まとめて記録中のエラー [種類, メッセージ, 最初の発生時刻, 最後の発生時刻, 発生回数]
+        self.error_row = None
+
+    def get_season(self, day):
+        """夏に 1、冬に 0 になる値"""
+        return 0.5 + 0.5 * math.cos(2 * math.pi * (day.timetuple().tm_yday - PEAK_DAY_OF_YEAR) / 365)
+
+    def is_rain(self, day):
+        rainy_season = math.exp(-(((day.timetuple().tm_yday - RAINY_DAY_OF_YEAR) / 20) ** 2))
+        return self.rng.random() < RAIN_RATIO + (RAINY_SEASON_RATIO - RAIN_RATIO) * rainy_season
+
+    def update_error_burst(self, day):
+        if (self.error_burst_end is not None) and (day >= self.error_burst_end):
+            self.error_burst_end = None
+
+        if (self.error_burst_end is None) and (self.rng.random() < ERROR_BURST_RATIO):
+            self.error_burst_end = day + datetime.timedelta(days=self.rng.randint(1, ERROR_BURST_DAYS_MAX))
+            self.error_message = self.rng.choice(ERROR_MESSAGE_LIST)
+
+    def add_error(self, ts, message):
+        # NOTE: アプリと同様に、最初の発生から一定時間内の同じエラーは 1 行にまとめる
+        if (
+            (self.error_row is not None)
+            and (self.error_row[1] == message)
+            and ((ts - self.error_row[2]) < rasp_water.metrics.collector.ERROR_COALESCE_SEC)
+        ):
+            self.error_row[3] = ts
+            self.error_row[4] += 1
+            return
+
+        self.flush_error()
+        self.error_row = ["valve_control", message, ts, ts, 1]
+        self.log_list.append((ts, message))
+
+    def flush_error(self):
+        if self.error_row is not None:
+            error_type, message, first_ts, last_ts, count = self.error_row
+            self.error_list.append(
+                (first_ts, error_type, message, first_ts, first_ts, last_ts, last_ts, count)
+            )
+            self.error_row = None
+
+    def add_flow_curve(self, ts, operation_type, open_sec, rate):
+        """1 秒毎の流量 [L/min] の推移を書き出す"""
+        sample_list = []
+        for sec in range(open_sec + FLOW_FALL_SEC):
+            if sec < FLOW_RISE_SEC:
+                flow = rate * sec / FLOW_RISE_SEC
+            elif sec < open_sec:
+                flow = rate + self.rng.gauss(0, FLOW_NOISE_SIGMA)
+            else:
+                flow = rate * (1 - (sec - open_sec) / FLOW_FALL_SEC)
+            sample_list.append(round(max(flow, 0), 3))
+        sample_list.extend([0] * FLOW_ZERO_TAIL_SEC)
+
+        self.flow_file.write(
+            json.dumps({"ts": ts, "operation_type": operation_type, "flow": sample_list}) + "\n"
+        )
+
+    def add_watering(self, ts, operation_type, open_sec, host=""):
+        self.log_list.append(
+            (
+                ts,
+                "{auto}で{period_str}間の水やりを開始します。{by}".format(
+                    auto="🕑 自動" if operation_type == "auto" else "🔧 手動",
+                    period_str=format_period(open_sec),
+                    by=f"(by {host})" if host != "" else "",
+                ),
+            )
+        )
+
+        if self.error_burst_end is not None:
+            self.add_error(ts + open_sec, self.error_message)
+            # NOTE: 元栓が閉まっている場合以外は、流量の集計が行われない
+            if self.error_message != ERROR_MESSAGE_LIST[0]:
+                return
+            rate = 0
+        else:
+            rate = max(self.rng.gauss(FLOW_RATE_MEAN, FLOW_RATE_SIGMA), 0.1)
+
+        # NOTE: アプリは、バルブを開いてから流量が 0 になるまでを水やりの時間として記録する
+        duration_sec = open_sec + FLOW_FALL_SEC + FLOW_ZERO_TAIL_SEC
+        volume = rate * (open_sec - FLOW_RISE_SEC / 2 + FLOW_FALL_SEC / 2) / 60
+        end_ts = ts + duration_sec
+
+        self.watering_list.append((end_ts, end_ts, end_ts, operation_type, duration_sec, volume))
+        self.log_list.append(
+            (
+                end_ts,
+                "🚿 {time_str}間、約 {water:.2f}L の水やりを行いました。".format(
+                    time_str=format_period(duration_sec), water=volume
+                ),
+            )
+        )
+
+        if self.flow_file is not None:
+            self.add_flow_curve(ts, operation_type, open_sec, rate)
+
+    def add_schedule(self, ts, period_sec, is_rain):
+        """スケジュール実行を記録し、バルブを開いた時刻 (開かなかった場合は None) を返す"""
+        # NOTE: 実行の開始は、ほとんどの場合すぐだが、まれに大きく遅れる
+        dispatch_delay = self.rng.expovariate(1 / 0.1)
+        if self.rng.random() < 0.01:
+            dispatch_delay += self.rng.uniform(10, 120)
+
+        if self.rng.random() < SCHEDULE_FAIL_RATIO:
+            result = "fail"
+            retry_count = SCHEDULE_RETRY_COUNT
+            open_delay = None
+        elif is_rain:
+            result = "skip"
+            retry_count = 0
+            open_delay = None
+        else:
+            result = "open"
+            retry_count = 0
+            # NOTE: 天気の判定 (API へのアクセス) の分だけ、バルブを開くのが遅れる
+            open_delay = dispatch_delay + self.rng.uniform(0.3, 2.0)
+
+        self.schedule_list.append((ts, ts, period_sec, result, retry_count, dispatch_delay, open_delay))
+
+        if result == "skip":
+            rain_fall = self.rng.uniform(1, 30)
+            self.log_list.append(
+                (
+                    ts,
+                    f"☂ 前回の水やりから {rain_fall:.0f}mm の雨が降ったため、自動での水やりを見合わせます。",
+                )
+            )
+
+        if open_delay is None:
+            return None
+
+        return ts + round(open_delay)
+
+    def add_day(self, day):
+        season = self.get_season(day)
+        is_rain = self.is_rain(day)
+        self.update_error_burst(day)
+
+        period_sec = round(AUTO_PERIOD_MIN + (AUTO_PERIOD_MAX - AUTO_PERIOD_MIN) * season) * 60
+        interval = 24 * 60 * 60 / self.per_day
+        # NOTE: 1 日 2 回の場合は 6 時と 18 時になる
+        start_ts = time.mktime(day.timetuple()) + 6 * 60 * 60 - interval * (self.per_day // 2)
+
+        for i in range(self.per_day):
+            ts = int(start_ts + interval * i)
+            open_ts = self.add_schedule(ts, period_sec, is_rain)
+            if open_ts is not None:
+                self.add_watering(open_ts, "auto", period_sec)
+
+            if self.rng.random() < MANUAL_RATIO:
+                self.add_watering(
+                    int(ts + self.rng.random() * interval),
+                    "manual",
+                    self.rng.randint(1, 10) * 60,
+                    self.rng.choice(MANUAL_HOST_LIST),
+                )
+
+    def iter_day(self, year):
+        """
+        直近 year 年分を 1 日ずつ合成する
+
+        合成したデータが INSERT_BATCH_SIZE 件を超える毎と、最後の日を合成した後に、
+        その日付を返すので、呼び出し元は各リストを書き込んでから clear() する。
+        """
+        today = datetime.date.today()
+        day = today - datetime.timedelta(days=int(365 * year))
+
+        while day < today:
+            self.add_day(day)
+            day += datetime.timedelta(days=1)
+
+            if (len(self.watering_list) >= INSERT_BATCH_SIZE) or (day == today):
+                if day == today:
+                    self.flush_error()
+                yield day
+
+    def clear(self):
+        self.watering_list = []
+        self.error_list = []
+        self.schedule_list = []
+        self.log_list = []
+
+    def write(self, metrics_conn, log_conn=None):
+        with metrics_conn:
+            metrics_conn.executemany(SQL_INSERT_WATERING, self.watering_list)
+            metrics_conn.executemany(SQL_INSERT_ERROR, self.error_list)
+            metrics_conn.executemany(SQL_INSERT_SCHEDULE, self.schedule_list)
+        if log_conn is not None:
+            with log_conn:
+                log_conn.executemany(SQL_INSERT_LOG, self.log_list)
+
+        count = {
+            "watering": len(self.watering_list),
+            "error": len(self.error_list),
+            "schedule": len(self.schedule_list),
+            "log": len(self.log_list) if log_conn is not None else 0,
+        }
+
+        self.clear()
+
+        return count
+
+
+def format_period(sec):
+    minute, sec = divmod(int(sec), 60)
+
+    if minute == 0:
+        return f"{sec}秒"
+    elif sec == 0:
+        return f"{minute}分"
+    else:
+        return f"{minute}分{sec}秒"
+
+
+def open_database(path):
+    conn = sqlite3.connect(path)
+    # NOTE: 合成したデータは作り直せるので、書き込みの速度を優先する
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+
+    return conn
+
+
+def set_rollup_trigger(conn, is_enable):
+    """
+    集計テーブルを更新するトリガを有効・無効にする
+
+    1 行毎にトリガで集計するより、書き込んだ後にまとめて集計し直す方がはるかに速いので、
+    書き込む間は無効にしておき、有効に戻す際に集計し直す。
+    """
+    with conn:
+        for rollup in rasp_water.metrics.migration.ROLLUP_TABLE_LIST:
+            if is_enable:
+                conn.execute(
+                    rasp_water.metrics.migration.format_rollup_sql(
+                        rasp_water.metrics.migration.SQL_CREATE_ROLLUP_TRIGGER, rollup, "NEW.date"
+                    )
+                )
+            else:
+                conn.execute("DROP TRIGGER IF EXISTS {table}_insert".format(**rollup))
+
+        if is_enable:
+            for sql in rasp_water.metrics.migration.SQL_CREATE_ERROR_ROLLUP_TRIGGER_LIST:
+                conn.execute(sql)
+        else:
+            for trigger in rasp_water.metrics.migration.ERROR_ROLLUP_TRIGGER_LIST:
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+        if is_enable:
+            rasp_water.metrics.migration.rebuild_rollup(conn)
+            rasp_water.metrics.migration.rebuild_error_rollup(conn)
+
+
+def generate(metrics_db_path, log_db_path, year, per_day, flow_file_path=None, seed=0):
+    """直近 year 年分のデータを合成して書き込み、種類毎の件数を返す (log_db_path が None ならログは省く)"""
+    metrics_db_path = pathlib.Path(metrics_db_path)
+    metrics_db_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # NOTE: スキーマの作成はコレクタに任せる
+    rasp_water.metrics.collector.MetricsCollector(metrics_db_path, async_write=False).close()
+
+    metrics_conn = open_database(metrics_db_path)
+    log_conn = None
+    if log_db_path is not None:
+        log_db_path = pathlib.Path(log_db_path)
+        log_db_path.parent.mkdir(parents=True, exist_ok=True)
+        log_conn = open_database(log_db_path)
+        log_conn.execute(SQL_CREATE_LOG)
+    flow_file = None if flow_file_path is None else pathlib.Path(flow_file_path).open("w")
+
+    generator = Generator(random.Random(seed), per_day, flow_file)
+    total = {"watering": 0, "error": 0, "schedule": 0, "log": 0}
+
+    start = time.perf_counter()
+    set_rollup_trigger(metrics_conn, False)
+    try:
+        for day in generator.iter_day(year):
+            for name, count in generator.write(metrics_conn, log_conn).items():
+                total[name] += count
+            logging.info("Generated up to %s: %s", day, total)
+    finally:
+        set_rollup_trigger(metrics_conn, True)
+
+        metrics_conn.close()
+        if log_conn is not None:
+            log_conn.close()
+        if flow_file is not None:
+            flow_file.close()
+
+    logging.info("Generated in %.1f sec", time.perf_counter() - start)
+
+    return total
+
+
+if __name__ == "__main__":
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    metrics_db_path = args["-m"]
+    log_db_path = args["-l"]
+    year = float(args["-y"])
+    per_day = int(args["-s"])
+    flow_file_path = args["-f"]
+    seed = int(args["-r"])
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("bench", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    if (metrics_db_path is None) or (log_db_path is None):
+        import my_lib.config
+
+        config = my_lib.config.load(config_file, pathlib.Path(SCHEMA_CONFIG))
+
+        if metrics_db_path is None:
+            metrics_db_path = config["metrics"]["data"]
+        if log_db_path is None:
+            log_db_path = config["webapp"]["data"]["log_file_path"]
+
+    logging.info(generate(metrics_db_path, log_db_path, year, per_day, flow_file_path, seed))
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+アプリをダミーモードで何もせずに動かし、アイドル時にバックグラウンドのスレッドが消費する資源を計測します。
+
+バルブが閉じていて、スケジュールの実行も近くない状態で、スレッド毎に以下の値を /proc から読み取ります。
+- CPU 時間
+- コンテキストスイッチの回数 (自発的・非自発的)
+- 1 秒あたりの起床回数 (自発的なコンテキストスイッチは、スリープなどで待った回数に等しい)
+
+HTTP サーバのスレッドも起動し、multiprocessing.Manager などの子プロセスの分も含めます。
+strace がある場合は、続けて同じ時間だけシステムコールを種類毎に数えます。
+(strace は計測対象を遅くするので、/proc の計測とは別に行います)
+
+Usage:
+  idle.py [-c CONFIG] [-t SEC] [-w SEC] [-d DIR] [-S] [-o FILE] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.example.yaml]
+  -t SEC            : 計測する時間 [秒] を指定します。[default: 60]
+  -w SEC            : アプリを起動してから計測を始めるまでの時間 [秒] を指定します。[default: 5]
+  -d DIR            : 作業ディレクトリを指定します。(指定しない場合は一時ディレクトリ)
+  -S                : strace によるシステムコールの計測を行いません。
+  -o FILE           : 結果を書き出すファイルを指定します。(指定しない場合は標準出力)
+  -D                : デバッグモードで動作します。
+"""
+
+import ctypes
+import datetime
+import json
+import logging
+import os
+import pathlib
+import platform
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+import load
+import rasp_water.metrics.profiler
+import suite
+
+# NOTE: strace を止めてから集計結果を書き出すまでの待ち時間
+STRACE_TIMEOUT_SEC = 10
+
+# NOTE: Yama が有効な場合、子プロセスの strace から親であるこのプロセスに接続できるようにする
+PR_SET_PTRACER = 0x59616D61
+PR_SET_PTRACER_ANY = -1
+
+CLOCK_TICK = os.sysconf("SC_CLK_TCK")
+
+
+def read_task(pid, tid):
+    """スレッドの CPU 時間 [秒] とコンテキストスイッチの回数"""
+    task_dir = pathlib.Path(f"/proc/{pid}/task/{tid}")
+
+    try:
+        # NOTE: schedstat の実行時間はナノ秒単位なので、stat の utime / stime (tick 単位) より細かい
+        cpu_sec = int((task_dir / "schedstat").read_text().split()[0]) / 1e9
+    except FileNotFoundError:
+        stat = load.read_stat(f"{pid}/task/{tid}")
+        cpu_sec = (int(stat[load.STAT_INDEX_UTIME]) + int(stat[load.STAT_INDEX_STIME])) / CLOCK_TICK
+
+    task = {"cpu_sec": cpu_sec}
+    for line in (task_dir / "status").read_text().splitlines():
+        key, _, value = line.partition(":")
+        if key == "voluntary_ctxt_switches":
+            task["voluntary"] = int(value)
+        elif key == "nonvoluntary_ctxt_switches":
+            task["nonvoluntary"] = int(value)
+
+    return task
+
+
+def get_task_list():
+    """このプロセスと子プロセスの全てのスレッドの (pid, tid)"""
+    task_list = []
+    for pid in load.get_process_list(os.getpid()):
+        try:
+            task_list.extend((pid, int(tid)) for tid in os.listdir(f"/proc/{pid}/task"))
+        except FileNotFoundError:
+            continue
+
+    return task_list
+
+
+def get_thread_label(pid, tid):
+    if pid != os.getpid():
+        return f"child_{pid}"
+
+    for thread in threading.enumerate():
+        if thread.native_id == tid:
+            return rasp_water.metrics.profiler.get_thread_label(thread, thread.ident)
+
+    return f"thread-{tid}"
+
+
+def snapshot():
+    task_map = {}
+    for pid, tid in get_task_list():
+        try:
+            task_map[(pid, tid)] = read_task(pid, tid)
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+
+    return task_map
+
+
+def measure_thread(duration_sec):
+    """duration_sec 秒の間の、スレッド毎の CPU 時間とコンテキストスイッチの回数"""
+    start_map = snapshot()
+    start = time.perf_counter()
+    time.sleep(duration_sec)
+    end_map = snapshot()
+    elapsed = time.perf_counter() - start
+
+    thread_list = []
+    for key, end in end_map.items():
+        # NOTE: 計測中に起動したスレッドは、0 から数える
+        begin = start_map.get(key, {"cpu_sec": 0, "voluntary": 0, "nonvoluntary": 0})
+        voluntary = end["voluntary"] - begin["voluntary"]
+        nonvoluntary = end["nonvoluntary"] - begin["nonvoluntary"]
+
+        thread_list.append(
+            {
+                "name": get_thread_label(*key),
+                "pid": key[0],
+                "tid": key[1],
+                "cpu_ms": (end["cpu_sec"] - begin["cpu_sec"]) * 1000,
+                "cpu_percent": (end["cpu_sec"] - begin["cpu_sec"]) / elapsed * 100,
+                "voluntary_ctxt_switches": voluntary,
+                "nonvoluntary_ctxt_switches": nonvoluntary,
+                "wakeup_per_sec": voluntary / elapsed,
+            }
+        )
+
+    # NOTE: 計測しているこのスレッドは除く
+    thread_list = [
+        thread
+        for thread in thread_list
+        if (thread["pid"], thread["tid"]) != (os.getpid(), threading.get_native_id())
+    ]
+    thread_list.sort(key=lambda thread: thread["wakeup_per_sec"], reverse=True)
+
+    total = {
+        name: sum(thread[name] for thread in thread_list)
+        for name in [
+            "cpu_ms",
+            "cpu_percent",
+            "voluntary_ctxt_switches",
+            "nonvoluntary_ctxt_switches",
+            "wakeup_per_sec",
+        ]
+    }
+
+    return {"elapsed_sec": elapsed, "total": total, "thread": thread_list}
+
+
+def parse_strace(text):
+    """strace -c の集計結果を、システムコール毎の回数とエラーの回数にする"""
+    syscall_map = {}
+    for line in text.splitlines():
+        column_list = line.split()
+        # NOTE: "% time  seconds  usecs/call  calls  [errors]  syscall" の行だけを読む
+        if (len(column_list) not in [5, 6]) or (column_list[-1] == "total"):
+            continue
+        try:
+            float(column_list[0])
+        except ValueError:
+            continue
+
+        syscall_map[column_list[-1]] = {
+            "calls": int(column_list[3]),
+            "errors": int(column_list[4]) if len(column_list) == 6 else 0,
+        }
+
+    return dict(sorted(syscall_map.items(), key=lambda item: item[1]["calls"], reverse=True))
+
+
+def measure_syscall(duration_sec, work_dir):
+    """duration_sec 秒の間に呼ばれたシステムコールを、strace で種類毎に数える"""
+    strace_path = shutil.which("strace")
+    if strace_path is None:
+        return {"error": "strace is not found"}
+
+    try:
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PTRACER, PR_SET_PTRACER_ANY, 0, 0, 0)
+    except (AttributeError, OSError):
+        pass
+
+    output_path = pathlib.Path(work_dir) / "strace.txt"
+    # NOTE: -f を指定すると、プロセスの全てのスレッドに接続する (計測しているこのスレッドはほぼ呼ばない)
+    command = [strace_path, "-c", "-f", "-q", "-o", str(output_path)]
+    for pid in load.get_process_list(os.getpid()):
+        command.extend(["-p", str(pid)])
+
+    proc = subprocess.Popen(command, stderr=subprocess.PIPE, text=True)  # noqa: S603
+    time.sleep(duration_sec)
+
+    if proc.poll() is not None:
+        return {"error": proc.stderr.read().strip()}
+
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout=STRACE_TIMEOUT_SEC)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        return {"error": "strace did not stop"}
+
+    syscall_map = parse_strace(output_path.read_text())
+
+    return {
+        "elapsed_sec": duration_sec,
+        "total_per_sec": sum(syscall["calls"] for syscall in syscall_map.values()) / duration_sec,
+        "syscall": syscall_map,
+    }
+
+
+def start_http_server(app):
+    """本番と同じく、リクエスト毎にスレッドを作る HTTP サーバを起動"""
+    import werkzeug.serving
+
+    server = werkzeug.serving.make_server("127.0.0.1", load.get_free_port(), app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name="http_server")
+    thread.start()
+
+    return server, thread
+
+
+def run(config_file, duration_sec, warmup_sec, is_strace, work_dir):
+    work_dir = pathlib.Path(work_dir)
+    config = suite.make_config(config_file, work_dir)
+
+    result = {
+        "commit": suite.get_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "duration_sec": duration_sec,
+    }
+
+    app = suite.start_app(config)
+    server, server_thread = start_http_server(app)
+    try:
+        # NOTE: 起動直後の処理 (スケジュールの読み込みなど) が落ち着くまで待つ
+        time.sleep(warmup_sec)
+
+        logging.info("Measure threads for %d sec", duration_sec)
+        result["thread"] = measure_thread(duration_sec)
+
+        if is_strace:
+            logging.info("Measure syscalls for %d sec", duration_sec)
+            result["syscall"] = measure_syscall(duration_sec, work_dir)
+    finally:
+        server.shutdown()
+        server_thread.join()
+        suite.stop_app()
+
+    for thread in result["thread"]["thread"]:
+        logging.info(
+            "%-24s: %6.1f wakeup/sec, %7.1f ms CPU, %5d nonvoluntary",
+            thread["name"],
+            thread["wakeup_per_sec"],
+            thread["cpu_ms"],
+            thread["nonvoluntary_ctxt_switches"],
+        )
+
+    return result
+
+
+if __name__ == "__main__":
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    duration_sec = int(args["-t"])
+    warmup_sec = int(args["-w"])
+    work_dir = args["-d"]
+    is_strace = not args["-S"]
+    output_file = args["-o"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("bench", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = run(config_file, duration_sec, warmup_sec, is_strace, tmp_dir)
+    else:
+        pathlib.Path(work_dir).mkdir(parents=True, exist_ok=True)
+        result = run(config_file, duration_sec, warmup_sec, is_strace, work_dir)
+
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if output_file is None:
+        print(output)  # noqa: T201
+    else:
+        pathlib.Path(output_file).write_text(output + "\n")
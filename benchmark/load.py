@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+複数のブラウザでアプリを開いたままにした状況を再現し、サーバの応答時間と負荷を計測します。
+
+サーバはダミーモードで子プロセスとして起動し、ブラウザ 1 つあたり以下のアクセスを行います。
+- /api/valve_ctrl と /api/valve_flow を 500ms 毎に取得
+- /api/event (Server-Sent Events) に接続したままにする
+- /api/metrics と、グラフ用の /api/metrics/data を METRICS_INTERVAL_SEC 秒毎に取得
+
+サーバの CPU 使用率とメモリ使用量は、リローダを使う場合はその子プロセスも含めて /proc から読み取ります。
+アクセスを始める前にも同じ時間だけ計測し、アイドル時の値として出力します。
+全てローカルで完結し、外部へのアクセスは行いません。
+
+Usage:
+  load.py [-c CONFIG] [-n COUNT] [-t SEC] [-p PORT] [-P] [-m PATH] [-d DIR] [-o FILE] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.example.yaml]
+  -n COUNT          : 同時にアプリを開いているブラウザの数を指定します。[default: 5]
+  -t SEC            : 計測する時間 [秒] を指定します。[default: 60]
+  -p PORT           : サーバのポートを指定します。(指定しない場合は空いているポート)
+  -P                : サーバを本番用のサーバ (app.py -P) で起動します。
+  -m PATH           : メトリクスのデータベースを指定します。generate.py で作成したものを使うと、
+                      データが多い場合を計測できます。(指定しない場合は空のデータベース)
+  -d DIR            : 作業ディレクトリを指定します。(指定しない場合は一時ディレクトリ)
+  -o FILE           : 結果を書き出すファイルを指定します。(指定しない場合は標準出力)
+  -D                : デバッグモードで動作します。
+"""
+
+import datetime
+import json
+import logging
+import os
+import pathlib
+import select
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import rasp_water.metrics.collector
+import suite
+
+APP_PATH = "flask/src/app.py"
+URL_PREFIX = "/rasp-water"
+
+POLL_INTERVAL_SEC = 0.5
+METRICS_INTERVAL_SEC = 30
+REQUEST_TIMEOUT_SEC = 10
+SERVER_START_TIMEOUT_SEC = 60
+MONITOR_INTERVAL_SEC = 1
+
+# NOTE: /proc/<pid>/stat の ")" 以降の項目の位置
+STAT_INDEX_PPID = 1
+STAT_INDEX_UTIME = 11
+STAT_INDEX_STIME = 12
+STAT_INDEX_NUM_THREADS = 17
+STAT_INDEX_RSS = 21
+
+CLOCK_TICK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class Recorder:
+    """リクエスト毎の所要時間とエラーの件数を種類毎に集め、イベントの件数を数える"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.elapsed_map = {}
+        self.error_map = {}
+        self.count_map = {"connect": 0, "disconnect": 0, "event": 0}
+
+    def add(self, name, elapsed, is_error):
+        with self.lock:
+            self.elapsed_map.setdefault(name, []).append(elapsed)
+            self.error_map[name] = self.error_map.get(name, 0) + (1 if is_error else 0)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.count_map[name] += value
+
+    def summary(self):
+        with self.lock:
+            return {
+                name: {
+                    "count": len(elapsed_list),
+                    "error": self.error_map[name],
+                    "error_rate": self.error_map[name] / len(elapsed_list),
+                    "p50_ms": rasp_water.metrics.collector.get_percentile(elapsed_list, 0.5) * 1000,
+                    "p99_ms": rasp_water.metrics.collector.get_percentile(elapsed_list, 0.99) * 1000,
+                    "max_ms": max(elapsed_list) * 1000,
+                }
+                for name, elapsed_list in self.elapsed_map.items()
+            }
+
+
+def read_stat(pid):
+    # NOTE: プロセス名に空白や括弧が含まれていても良いように、最後の ")" 以降を使う
+    stat = pathlib.Path(f"/proc/{pid}/stat").read_text()
+    return stat[stat.rindex(")") + 2 :].split()
+
+
+def get_process_list(root_pid):
+    """root_pid と、その子孫のプロセスの一覧"""
+    child_map = {}
+    for path in pathlib.Path("/proc").iterdir():
+        if not path.name.isdigit():
+            continue
+        try:
+            child_map.setdefault(int(read_stat(path.name)[STAT_INDEX_PPID]), []).append(int(path.name))
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+
+    process_list = [root_pid]
+    for pid in process_list:
+        process_list.extend(child_map.get(pid, []))
+
+    return process_list
+
+
+def get_usage(root_pid):
+    """プロセス全体の CPU 時間 [秒]、メモリ使用量 [バイト]、スレッド数、開いているファイルの数"""
+    usage = {"cpu_sec": 0.0, "rss": 0, "thread": 0, "fd": 0}
+    for pid in get_process_list(root_pid):
+        try:
+            stat = read_stat(pid)
+            fd_count = len(os.listdir(f"/proc/{pid}/fd"))
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+
+        usage["cpu_sec"] += (int(stat[STAT_INDEX_UTIME]) + int(stat[STAT_INDEX_STIME])) / CLOCK_TICK
+        usage["rss"] += int(stat[STAT_INDEX_RSS]) * PAGE_SIZE
+        usage["thread"] += int(stat[STAT_INDEX_NUM_THREADS])
+        usage["fd"] += fd_count
+
+    return usage
+
+
+def monitor_server(root_pid, duration_sec):
+    """duration_sec 秒の間、サーバの負荷を MONITOR_INTERVAL_SEC 秒毎に読み取って集計"""
+    sample_list = []
+    prev = get_usage(root_pid)
+    prev_time = time.perf_counter()
+    end_time = prev_time + duration_sec
+
+    while time.perf_counter() < end_time:
+        time.sleep(MONITOR_INTERVAL_SEC)
+
+        usage = get_usage(root_pid)
+        now = time.perf_counter()
+        usage["cpu_percent"] = (usage["cpu_sec"] - prev["cpu_sec"]) / (now - prev_time) * 100
+        sample_list.append(usage)
+
+        prev = usage
+        prev_time = now
+
+    return {
+        "cpu_percent_mean": sum(sample["cpu_percent"] for sample in sample_list) / len(sample_list),
+        "cpu_percent_max": max(sample["cpu_percent"] for sample in sample_list),
+        "rss_mb_max": max(sample["rss"] for sample in sample_list) / 1024 / 1024,
+        "thread_max": max(sample["thread"] for sample in sample_list),
+        "fd_max": max(sample["fd"] for sample in sample_list),
+    }
+
+
+def fetch(recorder, name, url):
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=REQUEST_TIMEOUT_SEC) as res:  # noqa: S310
+            res.read()
+        is_error = False
+    except OSError as e:
+        logging.debug("Failed to fetch %s: %s", url, e)
+        is_error = True
+
+    recorder.add(name, time.perf_counter() - start, is_error)
+
+    return not is_error
+
+
+def browser_poll(base_url, recorder, should_terminate):
+    """画面の状態を更新するための定期的な取得"""
+    while not should_terminate.is_set():
+        start = time.perf_counter()
+        fetch(recorder, "valve_ctrl", f"{base_url}/api/valve_ctrl")
+        fetch(recorder, "valve_flow", f"{base_url}/api/valve_flow")
+
+        should_terminate.wait(max(POLL_INTERVAL_SEC - (time.perf_counter() - start), 0))
+
+
+def browser_metrics(base_url, recorder, should_terminate):
+    """メトリクスのページを開いて、グラフを描画するまでの取得"""
+    while not should_terminate.is_set():
+        fetch(recorder, "metrics", f"{base_url}/api/metrics")
+        fetch(recorder, "metrics_data", f"{base_url}/api/metrics/data")
+
+        should_terminate.wait(METRICS_INTERVAL_SEC)
+
+
+def wait_readable(sock, should_terminate):
+    """sock を読み出せるようになるまで待つ (先に終了の指示があった場合は False)"""
+    while not should_terminate.is_set():
+        if len(select.select([sock], [], [], POLL_INTERVAL_SEC)[0]) != 0:
+            return True
+
+    return False
+
+
+def browser_event(port, recorder, should_terminate):
+    """
+    Server-Sent Events に接続したままにする
+
+    終了の指示を待てるように、urllib ではなくソケットを直接読み出す。
+    接続が切れた場合は、ブラウザと同様に再接続する。
+    """
+    request = f"GET {URL_PREFIX}/api/event HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n"
+
+    while not should_terminate.is_set():
+        start = time.perf_counter()
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=REQUEST_TIMEOUT_SEC) as sock:
+                sock.sendall(request.encode())
+
+                # NOTE: サーバは最初のイベントを送るまでレスポンスのヘッダも送らない (何も無くても
+                # 10 秒程度で送る) ので、時間を区切らずに待ち、最初のイベントを受け取るまでの時間を記録する
+                if not wait_readable(sock, should_terminate):
+                    break
+                data = sock.recv(4096)
+
+                is_connect = data.startswith((b"HTTP/1.0 200", b"HTTP/1.1 200"))
+                recorder.add("event_first", time.perf_counter() - start, not is_connect)
+                if not is_connect:
+                    should_terminate.wait(REQUEST_TIMEOUT_SEC)
+                    continue
+
+                recorder.count("connect")
+                while not should_terminate.is_set():
+                    recorder.count("event", data.count(b"data:"))
+                    if len(select.select([sock], [], [], POLL_INTERVAL_SEC)[0]) == 0:
+                        data = b""
+                        continue
+                    data = sock.recv(4096)
+                    if len(data) == 0:
+                        recorder.count("disconnect")
+                        break
+        except OSError as e:
+            logging.debug("Failed to connect event stream: %s", e)
+            recorder.add("event_first", time.perf_counter() - start, True)
+            should_terminate.wait(REQUEST_TIMEOUT_SEC)
+
+
+def start_server(config_file, port, production_mode, log_file):
+    command = [sys.executable, APP_PATH, "-c", str(config_file), "-p", str(port), "-d"]
+    if production_mode:
+        command.append("-P")
+
+    proc = subprocess.Popen(  # noqa: S603
+        command,
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+        # NOTE: リローダの子プロセスもまとめて終了できるようにする
+        start_new_session=True,
+    )
+
+    url = f"http://127.0.0.1:{port}{URL_PREFIX}/api/valve_ctrl"
+    end_time = time.perf_counter() + SERVER_START_TIMEOUT_SEC
+    while time.perf_counter() < end_time:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited: {proc.returncode}")  # noqa: TRY003, EM102
+        try:
+            with urllib.request.urlopen(url, timeout=REQUEST_TIMEOUT_SEC):
+                return proc
+        except OSError:
+            time.sleep(0.5)
+
+    stop_server(proc)
+    raise RuntimeError("Server did not start")  # noqa: TRY003, EM101
+
+
+def stop_server(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=REQUEST_TIMEOUT_SEC)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run(config_file, browser_count, duration_sec, port, production_mode, metrics_db_path, work_dir):  # noqa: PLR0913
+    work_dir = pathlib.Path(work_dir)
+
+    config = suite.make_config(config_file, work_dir)
+    if metrics_db_path is not None:
+        config["metrics"]["data"] = str(pathlib.Path(metrics_db_path).resolve())
+
+    server_config_file = work_dir / "config.yaml"
+    # NOTE: JSON は YAML としてそのまま読み込める
+    server_config_file.write_text(json.dumps(config, ensure_ascii=False, indent=2))
+
+    if port is None:
+        port = get_free_port()
+    base_url = f"http://127.0.0.1:{port}{URL_PREFIX}"
+
+    result = {
+        "commit": suite.get_commit(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "browser": browser_count,
+        "duration_sec": duration_sec,
+        "production_mode": production_mode,
+    }
+
+    with (work_dir / "server.log").open("w") as log_file:
+        proc = start_server(server_config_file, port, production_mode, log_file)
+        try:
+            logging.info("Measure idle server for %d sec", duration_sec)
+            server_idle = monitor_server(proc.pid, duration_sec)
+
+            recorder = Recorder()
+            should_terminate = threading.Event()
+
+            thread_list = []
+            for i in range(browser_count):
+                thread_list.extend(
+                    [
+                        threading.Thread(
+                            target=browser_poll, args=(base_url, recorder, should_terminate), name=f"poll_{i}"
+                        ),
+                        threading.Thread(
+                            target=browser_metrics,
+                            args=(base_url, recorder, should_terminate),
+                            name=f"metrics_{i}",
+                        ),
+                        threading.Thread(
+                            target=browser_event,
+                            args=(port, recorder, should_terminate),
+                            name=f"event_{i}",
+                        ),
+                    ]
+                )
+
+            logging.info("Start %d browsers for %d sec", browser_count, duration_sec)
+            for thread in thread_list:
+                thread.start()
+            try:
+                server_load = monitor_server(proc.pid, duration_sec)
+            finally:
+                should_terminate.set()
+                for thread in thread_list:
+                    thread.join()
+        finally:
+            stop_server(proc)
+
+    result["request"] = recorder.summary()
+    result["event"] = recorder.count_map
+    result["server"] = {"idle": server_idle, "load": server_load}
+
+    return result
+
+
+if __name__ == "__main__":
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    browser_count = int(args["-n"])
+    duration_sec = int(args["-t"])
+    port = None if args["-p"] is None else int(args["-p"])
+    production_mode = args["-P"]
+    metrics_db_path = args["-m"]
+    work_dir = args["-d"]
+    output_file = args["-o"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("bench", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = run(
+                config_file, browser_count, duration_sec, port, production_mode, metrics_db_path, tmp_dir
+            )
+    else:
+        pathlib.Path(work_dir).mkdir(parents=True, exist_ok=True)
+        result = run(
+            config_file, browser_count, duration_sec, port, production_mode, metrics_db_path, work_dir
+        )
+
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if output_file is None:
+        print(output)  # noqa: T201
+    else:
+        pathlib.Path(output_file).write_text(output + "\n")
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+MetricsCollector の書き込み・読み出し性能を計測します。
+
+接続を毎回開き直す従来方式 (rollback journal)、スレッド毎の永続的な接続 (WAL)、
+さらにバックグラウンドのスレッドでまとめてコミットする方式を比較します。
+従来方式は、変更前の MetricsCollector と同じテーブル定義と SQL を使う LegacyMetricsCollector で計測します
+(現在の MetricsCollector を継承すると、マイグレーションやトリガーの分も含まれてしまうため)。
+
+Usage:
+  metrics_collector.py [-n COUNT] [-q COUNT] [-d DIR] [-D]
+
+Options:
+  -n COUNT          : 記録する水やりの回数を指定します。[default: 2000]
+  -q COUNT          : 読み出しの回数を指定します。[default: 200]
+  -d DIR            : データベースを作成するディレクトリを指定します。(指定しない場合は一時ディレクトリ)
+  -D                : デバッグモードで動作します。
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+
+import rasp_water.metrics.collector
+
+# NOTE: 以下は、変更前の MetricsCollector のテーブル定義と SQL
+SQL_LEGACY_CREATE_LIST = [
+    """
+    CREATE TABLE IF NOT EXISTS watering_metrics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TIMESTAMP NOT NULL,
+        date TEXT NOT NULL,
+        operation_type TEXT NOT NULL CHECK (operation_type IN ('manual', 'auto')),
+        duration_seconds INTEGER NOT NULL,
+        volume_liters REAL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_watering_metrics_date ON watering_metrics(date)",
+    "CREATE INDEX IF NOT EXISTS idx_watering_metrics_type ON watering_metrics(operation_type)",
+]
+SQL_LEGACY_INSERT_WATERING = """
+    INSERT INTO watering_metrics
+    (timestamp, date, operation_type, duration_seconds, volume_liters)
+    VALUES (?, ?, ?, ?, ?)
+"""
+SQL_LEGACY_SELECT_WATERING = """
+    SELECT * FROM watering_metrics
+    WHERE date BETWEEN ? AND ?
+    ORDER BY timestamp
+"""
+
+
+class LegacyMetricsCollector:
+    """呼び出し毎に接続を開き直す従来方式 (変更前の MetricsCollector の計測に使う部分)"""
+
+    def __init__(self, db_path, async_write=False):  # noqa: ARG002
+        self.db_path = db_path
+        self.lock = threading.Lock()
+
+        with contextlib.closing(sqlite3.connect(self.db_path)) as conn, conn:
+            for sql in SQL_LEGACY_CREATE_LIST:
+                conn.execute(sql)
+
+    def record_watering(self, operation_type, duration_seconds, volume_liters=None, timestamp=None):
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+
+        # NOTE: 変更前は接続を閉じていなかったが、計測中にファイルハンドルが溜まらないように閉じる
+        with self.lock, contextlib.closing(sqlite3.connect(self.db_path)) as conn, conn:
+            conn.execute(
+                SQL_LEGACY_INSERT_WATERING,
+                (timestamp, timestamp.date().isoformat(), operation_type, duration_seconds, volume_liters),
+            )
+
+    def get_recent_watering_metrics(self, days=30):
+        end_date = datetime.date.today()
+        start_date = end_date - datetime.timedelta(days=days)
+
+        with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.execute(SQL_LEGACY_SELECT_WATERING, (start_date.isoformat(), end_date.isoformat()))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def flush(self):
+        pass
+
+    def term(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def measure(collector, count, query_count):
+    timestamp = datetime.datetime.now() - datetime.timedelta(days=30)
+    step = datetime.timedelta(days=30) / count
+
+    # NOTE: 記録毎のログ出力が計測を邪魔しないようにする
+    logging.disable(logging.INFO)
+    try:
+        start = time.perf_counter()
+        for i in range(count):
+            collector.record_watering("auto" if i % 3 else "manual", 60, 12.5, timestamp + step * i)
+        collector.flush()
+        insert_sec = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(query_count):
+            collector.get_recent_watering_metrics(days=7)
+        query_sec = time.perf_counter() - start
+    finally:
+        logging.disable(logging.NOTSET)
+
+    return {
+        "insert_per_sec": count / insert_sec,
+        "query_per_sec": query_count / query_sec,
+    }
+
+
+def run(work_dir, count, query_count):
+    result = {}
+    for name, collector_class, async_write in [
+        ("legacy", LegacyMetricsCollector, False),
+        ("persistent", rasp_water.metrics.collector.MetricsCollector, False),
+        ("async", rasp_water.metrics.collector.MetricsCollector, True),
+    ]:
+        collector = collector_class(pathlib.Path(work_dir) / f"{name}.db", async_write)
+        result[name] = measure(collector, count, query_count)
+        collector.term()
+        collector.close()
+
+        logging.info(
+            "%-10s: insert %8.1f rows/sec, query %8.1f queries/sec",
+            name,
+            result[name]["insert_per_sec"],
+            result[name]["query_per_sec"],
+        )
+
+    return result
+
+
+if __name__ == "__main__":
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    count = int(args["-n"])
+    query_count = int(args["-q"])
+    work_dir = args["-d"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("bench", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = run(tmp_dir, count, query_count)
+    else:
+        result = run(work_dir, count, query_count)
+
+    print(json.dumps(result, indent=2))  # noqa: T201
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+メトリクスのスキーマ (日付の文字列 + date インデックスと、UNIX 時間の ts + カバリングインデックス) の
+検索性能と、既存のデータベースのマイグレーションにかかる時間を計測します。
+
+バージョン 1 のスキーマで合成データのデータベースを作成し、その場でマイグレーションした前後で
+同じ検索を比較します。
+
+Usage:
+  metrics_schema.py [-n COUNT] [-q COUNT] [-d DIR] [-D]
+
+Options:
+  -n COUNT          : 合成する水やりのおよその件数を指定します。[default: 1000000]
+  -q COUNT          : 検索の回数を指定します。[default: 100]
+  -d DIR            : データベースを作成するディレクトリを指定します。(指定しない場合は一時ディレクトリ)
+  -D                : デバッグモードで動作します。
+"""
+
+import datetime
+import json
+import logging
+import pathlib
+import random
+import sqlite3
+import tempfile
+import time
+
+import generate
+import rasp_water.metrics.collector
+import rasp_water.metrics.migration
+
+# NOTE: 合成するデータの期間 [年]。件数が多いほど 1 日あたりの件数が増える
+DATASET_YEAR = 3
+
+SQL_INSERT_LEGACY_WATERING = f"""
+    INSERT INTO watering_metrics
+    (timestamp, date, operation_type, duration_seconds, volume_liters)
+    VALUES ({generate.SQL_LOCALTIME}, {generate.SQL_LOCALDATE}, ?, ?, ?)
+"""
+
+# NOTE: 期間は直近 7 日 (生データ) と 30 日 (流量・種類毎の件数)
+QUERY_DAYS_LIST = [7, 30]
+
+LEGACY_QUERY = {
+    "select": """
+        SELECT * FROM watering_metrics
+        WHERE date BETWEEN ? AND ?
+        ORDER BY timestamp
+    """,
+    "flow": """
+        SELECT timestamp, volume_liters / duration_seconds
+        FROM watering_metrics
+        WHERE date BETWEEN ? AND ? AND duration_seconds > 0 AND volume_liters IS NOT NULL
+        ORDER BY timestamp
+    """,
+    "type_count": """
+        SELECT COUNT(*) FROM watering_metrics
+        WHERE operation_type = 'manual' AND date BETWEEN ? AND ?
+    """,
+}
+
+QUERY = {
+    "select": rasp_water.metrics.collector.SQL_SELECT_WATERING,
+    "flow": rasp_water.metrics.collector.SQL_SERIES_FLOW,
+    "type_count": """
+        SELECT COUNT(*) FROM watering_metrics
+        WHERE operation_type = 'manual' AND ts >= ? AND ts < ?
+    """,
+}
+
+
+def create_legacy_database(db_path, count):
+    """バージョン 1 のスキーマで、直近 DATASET_YEAR 年におよそ count 件の水やりを合成"""
+    generator = generate.Generator(random.Random(0), generate.get_per_day(count, DATASET_YEAR))
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        rasp_water.metrics.migration.migrate_v1(conn)
+        conn.execute("PRAGMA user_version=1")
+
+        for _ in generator.iter_day(DATASET_YEAR):
+            with conn:
+                # NOTE: バージョン 1 のスキーマには ts 列が無いので、時刻の文字列と日付だけを書き込む
+                conn.executemany(
+                    SQL_INSERT_LEGACY_WATERING,
+                    [
+                        (ts, date_ts, operation_type, duration_sec, volume)
+                        for ts, _, date_ts, operation_type, duration_sec, volume in generator.watering_list
+                    ],
+                )
+            generator.clear()
+    conn.close()
+
+
+def measure_query(db_path, query, query_count, is_epoch):
+    result = {}
+
+    with sqlite3.connect(db_path) as conn:
+        for name, sql in query.items():
+            for days in QUERY_DAYS_LIST:
+                end_date = datetime.date.today()
+                start_date = end_date - datetime.timedelta(days=days)
+                if is_epoch:
+                    param = rasp_water.metrics.collector.get_epoch_range(
+                        start_date.isoformat(), end_date.isoformat()
+                    )
+                else:
+                    param = (start_date.isoformat(), end_date.isoformat())
+
+                plan = " / ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", param))
+
+                start = time.perf_counter()
+                for _ in range(query_count):
+                    row_count = len(conn.execute(sql, param).fetchall())
+                elapsed_sec = time.perf_counter() - start
+
+                result[f"{name}_{days}d"] = {
+                    "query_per_sec": query_count / elapsed_sec,
+                    "row_count": row_count,
+                    "plan": plan,
+                }
+    conn.close()
+
+    return result
+
+
+def run(work_dir, count, query_count):
+    db_path = pathlib.Path(work_dir) / "metrics.db"
+    for path in [db_path, db_path.with_name(db_path.name + "-wal"), db_path.with_name(db_path.name + "-shm")]:
+        path.unlink(missing_ok=True)
+
+    start = time.perf_counter()
+    create_legacy_database(db_path, count)
+    logging.info("Created %d rows in %.1f sec", count, time.perf_counter() - start)
+
+    result = {"count": count, "legacy": measure_query(db_path, LEGACY_QUERY, query_count, False)}
+
+    # NOTE: ログは 1 万件毎に出るので、計測中は抑止する
+    logging.disable(logging.INFO)
+    try:
+        start = time.perf_counter()
+        with sqlite3.connect(db_path) as conn:
+            rasp_water.metrics.migration.migrate(conn)
+        conn.close()
+        result["migrate_sec"] = time.perf_counter() - start
+    finally:
+        logging.disable(logging.NOTSET)
+
+    result["epoch"] = measure_query(db_path, QUERY, query_count, True)
+
+    logging.info("migrate: %.1f sec", result["migrate_sec"])
+    for name in result["legacy"]:
+        logging.info(
+            "%-16s: date %8.1f queries/sec, ts %8.1f queries/sec (%d rows)",
+            name,
+            result["legacy"][name]["query_per_sec"],
+            result["epoch"][name]["query_per_sec"],
+            result["epoch"][name]["row_count"],
+        )
+
+    return result
+
+
+if __name__ == "__main__":
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    count = int(args["-n"])
+    query_count = int(args["-q"])
+    work_dir = args["-d"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("bench", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = run(tmp_dir, count, query_count)
+    else:
+        result = run(work_dir, count, query_count)
+
+    print(json.dumps(result, indent=2))  # noqa: T201
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+アプリ全体の性能をダミーモードで計測し、コミット間で比較できる JSON で出力します。
+
+計測する項目は以下の通りです。
+- /api/valve_ctrl, /api/valve_flow のスループット
+- schedule_load / schedule_store
+- MetricsCollector の書き込みと期間を指定した読み出し
+- generate_statistics / prepare_series_data
+- /api/metrics の表示 (HTML と、グラフ用の /api/metrics/data の全ての解像度)
+
+メトリクスに関する項目は、件数を変えて合成したデータベース毎に計測します。
+設定ファイルのデータの書き出し先は、全て作業ディレクトリに置き換えます。
+
+Usage:
+  suite.py [-c CONFIG] [-n COUNT_LIST] [-r COUNT] [-d DIR] [-b BASELINE] [-o FILE] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.example.yaml]
+  -n COUNT_LIST     : 合成する水やりのおよその件数をカンマ区切りで指定します。[default: 10000,100000,1000000]
+  -r COUNT          : 各項目を繰り返す最大の回数を指定します。[default: 200]
+  -d DIR            : 作業ディレクトリを指定します。合成したデータベースは次回以降も使い回します。
+                      (指定しない場合は一時ディレクトリ)
+  -b BASELINE       : 以前に出力した JSON と比較し、遅くなった項目を表示します。
+  -o FILE           : 結果を書き出すファイルを指定します。(指定しない場合は標準出力)
+  -D                : デバッグモードで動作します。
+"""
+
+import copy
+import datetime
+import json
+import logging
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from unittest import mock
+
+import generate
+
+SCHEMA_CONFIG = "config.schema"
+
+# NOTE: 合成するデータの期間 [年]。件数が多いほど 1 日あたりの件数が増える
+DATASET_YEAR = 1
+
+# NOTE: 重い項目は、繰り返しの回数に達していなくてもこの時間で打ち切る (最低 MIN_ITERATION 回は行う)
+MEASURE_BUDGET_SEC = 5
+MIN_ITERATION = 3
+
+# NOTE: 書き込みの計測で記録する件数
+INSERT_COUNT = 2000
+
+# NOTE: 基準の結果に対してこの割合より遅くなった項目を表示する
+REGRESSION_RATIO = 0.9
+
+
+def get(client, url, **kwargs):
+    """計測中にエラーのレスポンスを計測しないように、ステータスを確認する"""
+    res = client.get(url, **kwargs)
+    if res.status_code != 200:
+        raise RuntimeError(f"GET {url} failed: {res.status_code}")  # noqa: TRY003, EM102
+
+    return res
+
+
+def measure(func, repeat):
+    """func を繰り返し呼び出し、1 回あたりの所要時間の分布を計測"""
+    elapsed_list = []
+    start = time.perf_counter()
+    while len(elapsed_list) < repeat:
+        call_start = time.perf_counter()
+        func()
+        elapsed_list.append(time.perf_counter() - call_start)
+
+        if (len(elapsed_list) >= MIN_ITERATION) and ((time.perf_counter() - start) > MEASURE_BUDGET_SEC):
+            break
+
+    elapsed_list.sort()
+
+    def percentile(quantile):
+        return elapsed_list[min(int(quantile * len(elapsed_list)), len(elapsed_list) - 1)] * 1000
+
+    return {
+        "iteration": len(elapsed_list),
+        "ops_per_sec": len(elapsed_list) / sum(elapsed_list),
+        "mean_ms": statistics.mean(elapsed_list) * 1000,
+        "p50_ms": percentile(0.5),
+        "p90_ms": percentile(0.9),
+        "p99_ms": percentile(0.99),
+    }
+
+
+def create_dataset(db_path, count):
+    """直近 DATASET_YEAR 年に、水やりがおよそ count 件になるように、エラーとスケジュール実行も含めて合成"""
+    if db_path.exists():
+        logging.info("Reuse dataset: %s", db_path)
+        return
+
+    start = time.perf_counter()
+    total = generate.generate(db_path, None, DATASET_YEAR, generate.get_per_day(count, DATASET_YEAR))
+
+    logging.info("Created dataset %s in %.1f sec: %s", total, time.perf_counter() - start, db_path)
+
+
+def make_config(config_file, work_dir):
+    """データの書き出し先を作業ディレクトリに置き換えた設定を作成"""
+    import my_lib.config
+
+    config = copy.deepcopy(my_lib.config.load(config_file, pathlib.Path(SCHEMA_CONFIG)))
+
+    config["webapp"]["data"]["schedule_file_path"] = str(work_dir / "schedule.dat")
+    config["webapp"]["data"]["log_file_path"] = str(work_dir / "log.db")
+    config["webapp"]["data"]["stat_dir_path"] = str(work_dir / "stat")
+    config["metrics"]["data"] = str(work_dir / "metrics.db")
+    # NOTE: 合成したデータを削除しないようにする
+    config["metrics"].pop("retention_days", None)
+    config["metrics"].setdefault("trace", {})["enable"] = False
+    for name in config["liveness"]["file"]:
+        config["liveness"]["file"][name] = str(work_dir / "liveness" / name)
+    for name in ["forecast", "sensor"]:
+        config["weather"]["rain_fall"][name]["cache_file_path"] = str(work_dir / f"{name}.cache")
+
+    return config
+
+
+def run_app(client, url_prefix, repeat):
+    import rasp_water.control.scheduler
+
+    schedule_data = rasp_water.control.scheduler.schedule_load()
+
+    result = {
+        "api.valve_ctrl_get": measure(
+            lambda: get(client, f"{url_prefix}/api/valve_ctrl", query_string={"cmd": 0}), repeat
+        ),
+        "api.valve_ctrl_close": measure(
+            lambda: get(client, f"{url_prefix}/api/valve_ctrl", query_string={"cmd": 1, "state": 0}), repeat
+        ),
+        "api.valve_flow": measure(lambda: get(client, f"{url_prefix}/api/valve_flow"), repeat),
+        "schedule.load": measure(rasp_water.control.scheduler.schedule_load, repeat),
+        "schedule.store": measure(lambda: rasp_water.control.scheduler.schedule_store(schedule_data), repeat),
+    }
+
+    return result
+
+
+def run_dataset(client, url_prefix, config, db_path, repeat):
+    import rasp_water.metrics.collector
+    import rasp_water.metrics.webapi.page
+
+    page = rasp_water.metrics.webapi.page
+
+    # NOTE: コレクタはプロセスで 1 つなので、データベース毎に作り直す
+    rasp_water.metrics.collector.term()
+    config["metrics"]["data"] = str(db_path)
+    collector = rasp_water.metrics.collector.get_collector(db_path)
+
+    end_date = datetime.date.today()
+    date_7d = (end_date - datetime.timedelta(days=7)).isoformat()
+    date_30d = (end_date - datetime.timedelta(days=30)).isoformat()
+    date_365d = (end_date - datetime.timedelta(days=365)).isoformat()
+    end_date = end_date.isoformat()
+
+    def render_metrics():
+        # NOTE: ダッシュボードを初めて開いた場合と同じく、キャッシュが無い状態で全てを取得する
+        with page.render_cache_lock:
+            page.render_cache.clear()
+        get(client, f"{url_prefix}/api/metrics")
+        for resolution in page.RESOLUTION_LIST:
+            get(client, f"{url_prefix}/api/metrics/data", query_string={"resolution": resolution})
+
+    result = {
+        "collector.get_watering_metrics_7d": measure(
+            lambda: collector.get_watering_metrics(date_7d, end_date), repeat
+        ),
+        "collector.get_statistics_30d": measure(lambda: collector.get_statistics(date_30d, end_date), repeat),
+        "collector.get_flow_series_30d": measure(
+            lambda: collector.get_flow_series(date_30d, end_date), repeat
+        ),
+        "collector.get_daily_series_365d": measure(
+            lambda: collector.get_daily_series(date_365d, end_date), repeat
+        ),
+        "collector.get_schedule_statistics_30d": measure(
+            lambda: collector.get_schedule_statistics(date_30d, end_date), repeat
+        ),
+        "page.generate_statistics_30d": measure(
+            lambda: page.generate_statistics(collector, date_30d, end_date), repeat
+        ),
+        **{
+            f"page.prepare_series_data_{resolution}_30d": measure(
+                lambda resolution=resolution: page.prepare_series_data(
+                    collector, date_30d, end_date, resolution
+                ),
+                repeat,
+            )
+            for resolution in page.RESOLUTION_LIST
+        },
+        "api.metrics_render": measure(render_metrics, repeat),
+        "api.metrics_render_cached": measure(
+            lambda: get(client, f"{url_prefix}/api/metrics/data", query_string={"resolution": "day"}), repeat
+        ),
+    }
+
+    # NOTE: 書き込みは最後に行う (読み出しの計測に影響しないように)
+    timestamp = datetime.datetime.now()
+    start = time.perf_counter()
+    for i in range(INSERT_COUNT):
+        collector.record_watering("auto" if i % 3 else "manual", 60, 12.5, timestamp)
+    collector.flush()
+    result["collector.record_watering"] = {
+        "iteration": INSERT_COUNT,
+        "ops_per_sec": INSERT_COUNT / (time.perf_counter() - start),
+    }
+
+    return result
+
+
+def compare(result, baseline):
+    """基準の結果に対する ops_per_sec の比を追加し、遅くなった項目を表示"""
+    for group, item_map in result["result"].items():
+        for name, stat in item_map.items():
+            base_stat = baseline.get("result", {}).get(group, {}).get(name)
+            if base_stat is None:
+                continue
+
+            stat["baseline_ratio"] = stat["ops_per_sec"] / base_stat["ops_per_sec"]
+            if stat["baseline_ratio"] < REGRESSION_RATIO:
+                logging.warning(
+                    "Regression: %s %s is %.0f%% of baseline", group, name, stat["baseline_ratio"] * 100
+                )
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def start_app(config):
+    """ダミーモードでアプリを作成し、ワーカーを起動する"""
+    # NOTE: rasp_water.control.valve はロード時にダミーモードかどうかを判定するので、先に設定する
+    os.environ["DUMMY_MODE"] = "true"
+
+    from app import create_app
+
+    with mock.patch.dict("os.environ", {"WERKZEUG_RUN_MAIN": "true"}):
+        return create_app(config, dummy_mode=True)
+
+
+def stop_app():
+    import my_lib.webapp.log
+    import rasp_water.control.webapi.schedule
+    import rasp_water.control.webapi.valve
+    import rasp_water.metrics.collector
+
+    my_lib.webapp.log.term()
+    rasp_water.control.webapi.schedule.term()
+    rasp_water.control.webapi.valve.term()
+    rasp_water.metrics.collector.term()
+
+
+def run(config_file, count_list, repeat, work_dir):
+    work_dir = pathlib.Path(work_dir)
+    config = make_config(config_file, work_dir)
+
+    for count in count_list:
+        create_dataset(work_dir / f"metrics_{count}.db", count)
+
+    import my_lib.webapp.config
+
+    app = start_app(config)
+    client = app.test_client()
+    url_prefix = my_lib.webapp.config.URL_PREFIX
+
+    result = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "repeat": repeat,
+        "result": {},
+    }
+
+    # NOTE: 計測毎のログ出力が計測を邪魔しないようにする
+    logging.disable(logging.INFO)
+    try:
+        result["result"]["app"] = run_app(client, url_prefix, repeat)
+        for count in count_list:
+            result["result"][f"dataset_{count}"] = run_dataset(
+                client, url_prefix, config, work_dir / f"metrics_{count}.db", repeat
+            )
+    finally:
+        logging.disable(logging.NOTSET)
+        stop_app()
+
+    for group, item_map in result["result"].items():
+        for name, stat in item_map.items():
+            logging.info("%-16s %-42s: %10.1f ops/sec", group, name, stat["ops_per_sec"])
+
+    return result
+
+
+if __name__ == "__main__":
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    count_list = [int(count) for count in args["-n"].split(",")]
+    repeat = int(args["-r"])
+    work_dir = args["-d"]
+    baseline_file = args["-b"]
+    output_file = args["-o"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("bench", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = run(config_file, count_list, repeat, tmp_dir)
+    else:
+        pathlib.Path(work_dir).mkdir(parents=True, exist_ok=True)
+        result = run(config_file, count_list, repeat, work_dir)
+
+    if baseline_file is not None:
+        compare(result, json.loads(pathlib.Path(baseline_file).read_text()))
+
+    output = json.dumps(result, indent=2)
+    if output_file is None:
+        print(output)  # noqa: T201
+    else:
+        pathlib.Path(output_file).write_text(output + "\n")
@@ -3,11 +3,12 @@
 水やりを自動化するアプリのサーバーです
 
 Usage:
-  app.py [-c CONFIG] [-p PORT] [-D] [-d]
+  app.py [-c CONFIG] [-p PORT] [-P] [-D] [-d]
 
 Options:
   -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
   -p PORT           : WEB サーバのポートを指定します。[default: 5000]
+  -P                : 本番用のサーバで動作します。(リローダを使わず、決まった数のスレッドで処理します)
   -d                : ダミーモードで実行します。CI テストで利用することを想定しています。
   -D                : デバッグモードで動作します。
 """
@@ -29,16 +30,27 @@ import my_lib.proc_util
 import rasp_water.control.webapi.schedule
 import rasp_water.control.webapi.valve
 import rasp_water.control.webapi.test.time
+import rasp_water.metrics.collector
+import rasp_water.metrics.span
+import rasp_water.metrics.trace
+import rasp_water.metrics.webapi.asset
+import rasp_water.metrics.webapi.export
+import rasp_water.metrics.webapi.openmetrics
 import rasp_water.metrics.webapi.page
+import rasp_water.metrics.webapi.profile
 
 
 SCHEMA_CONFIG = "config.schema"
 
 def term():
     import rasp_water.control.scheduler
+    import rasp_water.metrics.collector
 
     rasp_water.control.scheduler.term()
 
+    # NOTE: キューに残っているメトリクスを書き込む
+    rasp_water.metrics.collector.term()
+
     # 子プロセスを終了
     my_lib.proc_util.kill_child()
 
@@ -56,7 +68,18 @@ def sig_handler(num, frame):  # noqa: ARG001
         term()
 
 
-def create_app(config, dummy_mode=False):
+def create_app(config, dummy_mode=False, init_worker=None):
+    """
+    アプリを作成
+
+    Args:
+    ----
+        config: 設定
+        dummy_mode: ダミーモードで動作するかどうか
+        init_worker: ワーカーを起動するかどうか (指定しない場合は、Werkzeug のリローダの
+            子プロセスの場合のみ起動する)
+
+    """
     # NOTE: オプションでダミーモードが指定された場合、環境変数もそれに揃えておく
     if dummy_mode:
         os.environ["DUMMY_MODE"] = "true"
@@ -74,12 +97,19 @@ def create_app(config, dummy_mode=False):
     # NOTE: アクセスログは無効にする
     logging.getLogger("werkzeug").setLevel(logging.ERROR)
 
-    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    # NOTE: リローダを使う場合、親プロセスではワーカーを起動しない
+    if init_worker is None:
+        init_worker = os.environ.get("WERKZEUG_RUN_MAIN") == "true"
+
+    if init_worker:
         if dummy_mode:
             logging.warning("Set dummy mode")
         else:  # pragma: no cover
             pass
 
+        rasp_water.metrics.collector.init(config)
+        rasp_water.metrics.span.init(config)
+        rasp_water.metrics.trace.init(config)
         rasp_water.control.webapi.schedule.init(config)
         rasp_water.control.webapi.valve.init(config)
         my_lib.webapp.log.init(config)
@@ -100,12 +130,32 @@ def create_app(config, dummy_mode=False):
 
     app.json.compat = True
 
-    app.register_blueprint(rasp_water.control.webapi.valve.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX)
-    app.register_blueprint(rasp_water.control.webapi.schedule.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX)
-    app.register_blueprint(rasp_water.metrics.webapi.page.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX)
+    app.register_blueprint(
+        rasp_water.control.webapi.valve.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX
+    )
+    app.register_blueprint(
+        rasp_water.control.webapi.schedule.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX
+    )
+    app.register_blueprint(
+        rasp_water.metrics.webapi.page.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX
+    )
+    app.register_blueprint(
+        rasp_water.metrics.webapi.export.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX
+    )
+    app.register_blueprint(
+        rasp_water.metrics.webapi.asset.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX
+    )
+    app.register_blueprint(
+        rasp_water.metrics.webapi.openmetrics.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX
+    )
+    app.register_blueprint(
+        rasp_water.metrics.webapi.profile.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX
+    )
 
     if dummy_mode:
-        app.register_blueprint(rasp_water.control.webapi.test.time.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX)
+        app.register_blueprint(
+            rasp_water.control.webapi.test.time.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX
+        )
 
     app.register_blueprint(my_lib.webapp.base.blueprint_default)
     app.register_blueprint(my_lib.webapp.base.blueprint, url_prefix=my_lib.webapp.config.URL_PREFIX)
@@ -128,7 +178,8 @@ if __name__ == "__main__":
     args = docopt.docopt(__doc__)
 
     config_file = args["-c"]
-    port = args["-p"]
+    port = int(args["-p"])
+    production_mode = args["-P"]
     dummy_mode = args["-d"]
     debug_mode = args["-D"]
 
@@ -136,14 +187,19 @@ if __name__ == "__main__":
 
     config = my_lib.config.load(config_file, pathlib.Path(SCHEMA_CONFIG))
 
-    app = create_app(config, dummy_mode)
+    app = create_app(config, dummy_mode, init_worker=True if production_mode else None)
 
     signal.signal(signal.SIGTERM, sig_handler)
 
     # Flaskアプリケーションを実行
     try:
-        # NOTE: スクリプトの自動リロード停止したい場合は use_reloader=False にする
-        app.run(host="0.0.0.0", port=port, threaded=True, use_reloader=True, debug=debug_mode)  # noqa: S104
+        if production_mode:
+            import rasp_water.webapi.server
+
+            rasp_water.webapi.server.create_server(app, port, config).run()
+        else:
+            # NOTE: スクリプトの自動リロード停止したい場合は use_reloader=False にする
+            app.run(host="0.0.0.0", port=port, threaded=True, use_reloader=True, debug=debug_mode)  # noqa: S104
     except KeyboardInterrupt:
         logging.info("Received KeyboardInterrupt, shutting down...")
         sig_handler(signal.SIGINT, None)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+降雨予想の取得元 (プロバイダ) を抽象化します。
+
+各プロバイダは keep-alive な requests.Session を持ち、リトライ回数を制限した上で、
+失敗が続いた場合はサーキットブレーカーで一定時間アクセスを止めます。
+取得結果は RainfallTimeline に正規化されます。
+どのプロバイダでも、10 分毎の降水強度 [mm/h] の時系列に揃えるので、合計値の意味は変わりません。
+"""
+
+from __future__ import annotations
+
+import abc
+import dataclasses
+import datetime
+import json
+import logging
+import threading
+import time
+
+import my_lib.time
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+# NOTE: 1 回の取得で行う HTTP リクエストのリトライ回数
+RETRY_COUNT = 2
+RETRY_BACKOFF_SEC = 0.5
+TIMEOUT_SEC = 5
+
+# NOTE: この回数連続して失敗したら、BREAKER_RESET_SEC の間はアクセスしない
+BREAKER_FAIL_COUNT = 3
+BREAKER_RESET_SEC = 10 * 60
+
+# NOTE: 正規化後のサンプルの間隔 (Yahoo の降水強度の間隔に合わせる)
+SAMPLE_INTERVAL_SEC = 10 * 60
+
+
+@dataclasses.dataclass(frozen=True)
+class RainfallTimeline:
+    """降水量の時系列 (SAMPLE_INTERVAL_SEC 毎の UNIX 時間と降水強度 [mm/h] の並列配列)"""
+
+    provider: str
+    time: tuple[float, ...]
+    rainfall: tuple[float, ...]
+
+
+class CircuitBreaker:
+    """連続した失敗を検出して、一定時間アクセスを遮断するクラス"""
+
+    def __init__(self, fail_count=BREAKER_FAIL_COUNT, reset_sec=BREAKER_RESET_SEC):
+        self.fail_count = fail_count
+        self.reset_sec = reset_sec
+        self.lock = threading.Lock()
+        self.count = 0
+        self.open_time = None
+        self.is_trial = False
+
+    def is_open(self) -> bool:
+        """遮断中かどうか (False を返した場合、呼び出し元は結果を record_* で報告すること)"""
+        with self.lock:
+            if self.open_time is None:
+                return False
+
+            if (time.monotonic() - self.open_time) < self.reset_sec:
+                return True
+
+            # NOTE: 一定時間経過したら、お試しで 1 回だけ通す (half-open)。
+            # 結果が報告されるまでは、他の呼び出しは遮断する。
+            if self.is_trial:
+                return True
+
+            self.is_trial = True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.count = 0
+            self.open_time = None
+            self.is_trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.count += 1
+            if self.count >= self.fail_count:
+                if self.open_time is None:
+                    logging.warning("Circuit breaker is open (%d failures)", self.count)
+                self.open_time = time.monotonic()
+            self.is_trial = False
+
+
+def create_session():
+    retry = urllib3.util.retry.Retry(
+        total=RETRY_COUNT,
+        backoff_factor=RETRY_BACKOFF_SEC,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=("GET",),
+    )
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(max_retries=retry, pool_maxsize=1))
+    session.mount("https://", requests.adapters.HTTPAdapter(max_retries=retry, pool_maxsize=1))
+
+    return session
+
+
+class ForecastProvider(abc.ABC):
+    """降雨予想プロバイダの基底クラス (get_params と parse を実装すること)"""
+
+    NAME = None
+    ENDPOINT = None
+
+    def __init__(self, provider_config):
+        self.endpoint = provider_config.get("endpoint", self.ENDPOINT)
+        self.session = create_session()
+        self.breaker = CircuitBreaker()
+
+    def fetch(self, point) -> RainfallTimeline | None:
+        if self.breaker.is_open():
+            logging.debug("Skip %s since circuit breaker is open", self.NAME)
+            return None
+
+        try:
+            res = self.session.get(self.endpoint, params=self.get_params(point), timeout=TIMEOUT_SEC)
+
+            if res.status_code != 200:
+                logging.warning(
+                    "Failed to fetch weather info from %s (status: %d)", self.NAME, res.status_code
+                )
+                self.breaker.record_failure()
+                return None
+
+            timeline = self.parse(json.loads(res.content))
+        except Exception:
+            logging.warning("Failed to fetch weather info from %s", self.NAME)
+            self.breaker.record_failure()
+            return None
+
+        self.breaker.record_success()
+
+        return timeline
+
+    @abc.abstractmethod
+    def get_params(self, point) -> dict:
+        """地点 (point の lat, lon) に対する、リクエストのパラメータ"""
+
+    @abc.abstractmethod
+    def parse(self, data) -> RainfallTimeline:
+        """レスポンスの JSON を RainfallTimeline に変換"""
+
+    def close(self):
+        self.session.close()
+
+
+class YahooProvider(ForecastProvider):
+    NAME = "yahoo"
+    ENDPOINT = "https://map.yahooapis.jp/weather/V1/place"
+
+    def __init__(self, provider_config):
+        super().__init__(provider_config)
+        self.app_id = provider_config["id"]
+
+    def get_params(self, point):
+        return {
+            "appid": self.app_id,
+            "coordinates": f"{point['lon']},{point['lat']}",
+            "output": "json",
+            "past": 2,
+        }
+
+    def parse(self, data):
+        weather_list = data["Feature"][0]["Property"]["WeatherList"]["Weather"]
+
+        return RainfallTimeline(
+            provider=self.NAME,
+            time=tuple(
+                datetime.datetime.strptime(x["Date"], "%Y%m%d%H%M")
+                .replace(tzinfo=my_lib.time.get_zoneinfo())
+                .timestamp()
+                for x in weather_list
+            ),
+            rainfall=tuple(float(x["Rainfall"]) for x in weather_list),
+        )
+
+
+class OpenMeteoProvider(ForecastProvider):
+    NAME = "open_meteo"
+    ENDPOINT = "https://api.open-meteo.com/v1/forecast"
+
+    def get_params(self, point):
+        return {
+            "latitude": point["lat"],
+            "longitude": point["lon"],
+            "minutely_15": "precipitation",
+            "past_minutely_15": 8,
+            "forecast_minutely_15": 4,
+            "timeformat": "unixtime",
+        }
+
+    def parse(self, data):
+        interval_sec = 15 * 60
+
+        # NOTE: 各時刻の値は、直前の 15 分間の降水量 [mm] なので、降水強度 [mm/h] に換算してから
+        # SAMPLE_INTERVAL_SEC 毎の時刻に割り当てる (その時刻を含む 15 分間の降水強度を使う)
+        time_list = []
+        rainfall_list = []
+        for end_time, precipitation in zip(
+            data["minutely_15"]["time"], data["minutely_15"]["precipitation"], strict=True
+        ):
+            rainfall = float(precipitation or 0) * (60 * 60 / interval_sec)
+            sample_time = (int(end_time) - interval_sec) // SAMPLE_INTERVAL_SEC * SAMPLE_INTERVAL_SEC
+            sample_time += SAMPLE_INTERVAL_SEC
+            while sample_time <= int(end_time):
+                time_list.append(float(sample_time))
+                rainfall_list.append(rainfall)
+                sample_time += SAMPLE_INTERVAL_SEC
+
+        return RainfallTimeline(provider=self.NAME, time=tuple(time_list), rainfall=tuple(rainfall_list))
+
+
+PROVIDER_CLASS_LIST = [YahooProvider, OpenMeteoProvider]
+
+
+def create_provider_list(forecast_config) -> list[ForecastProvider]:
+    # NOTE: 設定ファイルに記載されているプロバイダを、PROVIDER_CLASS_LIST の順番で優先して使う
+    return [
+        provider_class(forecast_config[provider_class.NAME])
+        for provider_class in PROVIDER_CLASS_LIST
+        if provider_class.NAME in forecast_config
+    ]
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+雨量センサーの値を 1 時間単位で SQLite にキャッシュします。
+
+InfluxDB からは、キャッシュ済みの最新時刻 (high-water mark) より新しい分と、
+遅れて届いたデータを反映するために直近 REFRESH_HOURS 時間分だけを取得し、
+期間の合計はキャッシュから計算します。InfluxDB にアクセスできない場合でも、
+キャッシュ済みの範囲で合計を返します。
+"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import influxdb_client
+
+HOUR_SEC = 60 * 60
+
+# NOTE: weather_sensor.hours_since_last_watering() が返す最大値 (7 日) より少し長めに保持する
+KEEP_HOURS = 24 * 8
+
+# NOTE: センサーのデータが遅れて届いたり、InfluxDB への書き込みが遅れたりした場合に備えて、
+# 完了した時間のうち直近のこの時間分は、毎回取得し直す
+REFRESH_HOURS = 2
+
+# NOTE: my_lib.sensor_data.get_hour_sum() と同様に、1 分毎の平均値を合計する
+FLUX_HOUR_SUM_QUERY = """
+from(bucket: "{bucket}")
+    |> range(start: {start}, stop: {stop})
+    |> filter(fn: (r) => r._measurement == "{measure}")
+    |> filter(fn: (r) => r.hostname == "{hostname}")
+    |> filter(fn: (r) => r._field == "{field}")
+    |> aggregateWindow(every: 1m, fn: mean, createEmpty: false)
+    |> aggregateWindow(every: 1h, fn: sum, createEmpty: true, timeSrc: "_start")
+"""
+
+
+def format_time(epoch):
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class RainFallCache:
+    """雨量の 1 時間毎の合計値をキャッシュするクラス"""
+
+    def __init__(self, db_path: Path, db_config: dict, measure: str, hostname: str, field: str = "rain"):
+        """コンストラクタ
+
+        Args:
+        ----
+            db_path: SQLiteデータベースファイルパス
+            db_config: InfluxDB の設定
+            measure: 雨量センサーの measurement
+            hostname: 雨量センサーのホスト名
+            field: 雨量のフィールド名
+
+        """
+        self.db_path = db_path
+        self.db_config = db_config
+        self.measure = measure
+        self.hostname = hostname
+        self.field = field
+        self.lock = threading.Lock()
+        self._init_database()
+
+    def _init_database(self):
+        """データベース初期化"""
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rain_fall_hour (
+                    hour INTEGER PRIMARY KEY,
+                    value REAL NOT NULL
+                )
+            """)
+
+    def _query(self, start, stop) -> list[tuple[int, float]]:
+        """InfluxDB から [start, stop) の 1 時間毎の合計値を取得"""
+        query = FLUX_HOUR_SUM_QUERY.format(
+            bucket=self.db_config["bucket"],
+            start=format_time(start),
+            stop=format_time(stop),
+            measure=self.measure,
+            hostname=self.hostname,
+            field=self.field,
+        )
+
+        with influxdb_client.InfluxDBClient(
+            url=self.db_config["url"], token=self.db_config["token"], org=self.db_config["org"]
+        ) as client:
+            table_list = client.query_api().query(query=query)
+
+        return [
+            (int(record.get_time().timestamp()), record.get_value() or 0.0)
+            for table in table_list
+            for record in table.records
+        ]
+
+    def get_high_water_mark(self) -> int | None:
+        """キャッシュ済みの最新の時間 (その時間の開始時刻) を取得"""
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute("SELECT MAX(hour) FROM rain_fall_hour").fetchone()[0]
+
+    def update(self, now=None) -> list[tuple[int, float]]:
+        """
+        キャッシュを更新
+
+        完了した時間の値はキャッシュに保存し、現在の (途中の) 時間の値は返り値として返します。
+        """
+        if now is None:
+            now = time.time()
+
+        hour_now = int(now // HOUR_SEC) * HOUR_SEC
+        hour_oldest = hour_now - KEEP_HOURS * HOUR_SEC
+
+        with self.lock:
+            high_water_mark = self.get_high_water_mark()
+            if high_water_mark is None:
+                start = hour_oldest
+            else:
+                start = max(min(high_water_mark + HOUR_SEC, hour_now - REFRESH_HOURS * HOUR_SEC), hour_oldest)
+
+            bucket_list = self._query(start, now) if start < now else []
+
+            with sqlite3.connect(self.db_path) as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO rain_fall_hour (hour, value) VALUES (?, ?)",
+                    [bucket for bucket in bucket_list if bucket[0] < hour_now],
+                )
+                conn.execute("DELETE FROM rain_fall_hour WHERE hour < ?", (hour_oldest,))
+
+        return [bucket for bucket in bucket_list if bucket[0] >= hour_now]
+
+    def get_sum(self, hours: int, now=None) -> float:
+        """
+        直近 hours 時間の雨量の合計を取得
+
+        キャッシュは 1 時間単位なので、直近 hours 時間 (現在時刻までの 60 * hours 分間) を必ず含むように、
+        現在の (途中の) 時間と、その前の完了した hours 時間分を合計します。
+        このため、最大で hours + 1 時間分の雨量を含みます (雨を見逃して水やりしないよう、長めに見る)。
+
+        Args:
+        ----
+            hours: 集計する時間
+            now: 基準となる UNIX 時間 (指定しない場合は現在時刻)
+
+        Returns:
+        -------
+            雨量の合計
+
+        """
+        if now is None:
+            now = time.time()
+
+        hour_now = int(now // HOUR_SEC) * HOUR_SEC
+
+        try:
+            current_list = self.update(now)
+        except Exception as e:
+            # NOTE: InfluxDB にアクセスできない場合は、キャッシュ済みの値だけで計算する
+            if self.get_high_water_mark() is None:
+                raise
+            logging.warning("Failed to update rain fall cache, use cached value: %s", e)
+            current_list = []
+
+        with sqlite3.connect(self.db_path) as conn:
+            cached_sum = conn.execute(
+                "SELECT TOTAL(value) FROM rain_fall_hour WHERE hour >= ? AND hour < ?",
+                (hour_now - hours * HOUR_SEC, hour_now),
+            ).fetchone()[0]
+
+        return cached_sum + sum(value for _, value in current_list)
+
+
+# グローバルインスタンス
+_cache_instance: RainFallCache | None = None
+
+
+def get_cache(config) -> RainFallCache:
+    """雨量キャッシュのインスタンスを取得"""
+    global _cache_instance
+
+    if _cache_instance is None:
+        sensor_config = config["weather"]["rain_fall"]["sensor"]
+        db_path = Path(sensor_config.get("cache_file_path", "flask/data/rain_fall.db"))
+        _cache_instance = RainFallCache(
+            db_path, config["influxdb"], sensor_config["measure"], sensor_config["hostname"]
+        )
+        logging.info("Rain fall cache initialized: %s", db_path)
+
+    return _cache_instance
@@ -11,7 +11,12 @@ import my_lib.footprint
 import my_lib.serializer
 import my_lib.webapp.config
 import my_lib.webapp.log
+import rasp_water.control.valve
 import rasp_water.control.webapi.valve
+import rasp_water.metrics.collector
+import rasp_water.metrics.registry
+import rasp_water.metrics.span
+import rasp_water.metrics.trace
 import rasp_water.control.webapi.test.time
 import schedule
 
@@ -19,6 +24,8 @@ RETRY_COUNT = 3
 
 schedule_lock = None
 should_terminate = threading.Event()
+# NOTE: 実行中のジョブの予定時刻と実行を開始した時刻 (valve_auto_control で遅延を記録するため)
+fire_info = None
 
 # Worker-specific scheduler instance for pytest-xdist parallel execution
 _scheduler_instances = {}
@@ -71,14 +78,76 @@ def valve_auto_control_impl(config, period):
 def valve_auto_control(config, period):
     logging.info("Starts automatic control of the valve")
 
-    for _ in range(RETRY_COUNT):
-        if valve_auto_control_impl(config, period):
-            return True
+    # NOTE: 水やりのトレースはスケジューラが起動した時点から記録する
+    rasp_water.metrics.trace.begin("auto", period=period * 60)
+
+    with rasp_water.metrics.trace.span("scheduler.valve_auto_control"):
+        for i in range(RETRY_COUNT):
+            if valve_auto_control_impl(config, period):
+                record_schedule(config, period, i)
+                return True
+            rasp_water.metrics.trace.instant("scheduler.retry", count=i + 1)
 
     my_lib.webapp.log.info("😵 水やりの自動実行に失敗しました。")
+    rasp_water.metrics.trace.end(result="fail")
+    record_schedule(config, period, RETRY_COUNT, is_fail=True)
     return False
 
 
+def record_schedule(config, period, retry_count, is_fail=False):
+    # NOTE: run_pending() の外から呼ばれた場合は、予定時刻がわからないので記録しない
+    if fire_info is None:
+        return
+
+    open_time = rasp_water.control.valve.last_open_time
+    if is_fail or ((open_time is not None) and (open_time < fire_info["dispatch_time"])):
+        # NOTE: 失敗した場合と、このジョブより前に開いた時刻の場合 (見合わせた) は、今回は開いていない
+        open_time = None
+
+    if is_fail:
+        result = "fail"
+    elif open_time is None:
+        result = "skip"
+    else:
+        result = "open"
+
+    try:
+        rasp_water.metrics.collector.record_schedule(
+            planned_time=fire_info["planned_time"],
+            dispatch_time=fire_info["dispatch_time"],
+            open_time=open_time,
+            period_seconds=period * 60,
+            result=result,
+            metrics_data_path=config["metrics"]["data"],
+            retry_count=retry_count,
+        )
+    except Exception as e:
+        logging.warning("Failed to record schedule metrics: %s", e)
+
+
+def run_pending(scheduler):
+    """
+    scheduler.run_pending() と同じく、実行時刻を過ぎたジョブを実行
+
+    遅延を記録するため、ジョブ毎に予定時刻と実行を開始した時刻を fire_info に設定してから実行します。
+    """
+    global fire_info  # noqa: PLW0603
+
+    # NOTE: schedule の Job.should_run と同じく、datetime.datetime.now() と比較する
+    for job in sorted(job for job in scheduler.jobs if job.should_run):
+        dispatch_time = datetime.datetime.now()
+        rasp_water.metrics.registry.SCHEDULER_LATENESS.observe((dispatch_time - job.next_run).total_seconds())
+
+        fire_info = {"planned_time": job.next_run, "dispatch_time": dispatch_time}
+        try:
+            ret = job.run()
+        finally:
+            fire_info = None
+
+        if isinstance(ret, schedule.CancelJob) or ret is schedule.CancelJob:
+            scheduler.cancel_job(job)
+
+
 def schedule_validate(schedule_data):  # noqa: C901, PLR0911
     if len(schedule_data) != 2:
         logging.warning("Count of entry is Invalid: %d", len(schedule_data))
@@ -242,7 +311,8 @@ def schedule_worker(config, queue):
             if os.environ.get("DUMMY_MODE", "false") == "true":
                 scheduler._time_func = my_lib.time.now
             
-            scheduler.run_pending()
+            with rasp_water.metrics.span.span("scheduler.run_pending"):
+                run_pending(scheduler)
             logging.debug("Sleep %.1f sec...", sleep_sec)
             time.sleep(sleep_sec)
         except OverflowError:  # pragma: no cover
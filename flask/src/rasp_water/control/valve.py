@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import datetime
 import enum
 import inspect
 import logging
@@ -10,6 +11,10 @@ import time
 import my_lib.footprint
 import my_lib.rpi
 import my_lib.webapp.config
+import rasp_water.control.valve_daemon
+import rasp_water.metrics.registry
+import rasp_water.metrics.span
+import rasp_water.metrics.trace
 
 # バルブを一定期間開く際に作られるファイル。
 # ファイルの内容はバルブを閉じるべき UNIX 時間。
@@ -74,7 +79,7 @@ if (os.environ.get("DUMMY_MODE", "false") != "true") and (
 
         return flow
 
-    def get_flow(offset=0):
+    def read_flow(offset=0):
         try:
             with pathlib.Path(config["flow"]["sensor"]["adc"]["value_file"]).open(mode="r") as f:
                 return {"flow": conv_rawadc_to_flow(int(f.read()), offset), "result": "success"}
@@ -84,38 +89,52 @@ if (os.environ.get("DUMMY_MODE", "false") != "true") and (
 else:
     import random
 
-    def get_flow(offset=0):  # noqa: ARG001
+    def read_flow(offset=0):  # noqa: ARG001
         if my_lib.footprint.exists(STAT_PATH_VALVE_OPEN):
-            if get_flow.prev_flow == 0:
+            if read_flow.prev_flow == 0:
                 flow = config["flow"]["sensor"]["scale"]["max"]
             else:
                 flow = max(
                     0,
                     min(
-                        get_flow.prev_flow
+                        read_flow.prev_flow
                         + (random.random() - 0.5) * (config["flow"]["sensor"]["scale"]["max"] / 5.0),  # noqa: S311
                         config["flow"]["sensor"]["scale"]["max"],
                     ),
                 )
 
-            get_flow.prev_flow = flow
+            read_flow.prev_flow = flow
 
             return {"flow": flow, "result": "success"}
         else:
-            if get_flow.prev_flow > 1:
-                get_flow.prev_flow /= 5
+            if read_flow.prev_flow > 1:
+                read_flow.prev_flow /= 5
             else:
-                get_flow.prev_flow = max(0, get_flow.prev_flow - 0.5)
+                read_flow.prev_flow = max(0, read_flow.prev_flow - 0.5)
 
-            return {"flow": get_flow.prev_flow, "result": "success"}
+            return {"flow": read_flow.prev_flow, "result": "success"}
 
-    get_flow.prev_flow = 0
+    read_flow.prev_flow = 0
 
 config = None
 pin_no = GPIO_PIN_DEFAULT
 worker = None
 should_terminate = threading.Event()
 current_auto_mode = False  # 現在の水やりが自動モードかどうか
+# NOTE: 最後にバルブを開いた時刻 (スケジュール実行の遅延の記録用)
+last_open_time = None
+# NOTE: 別プロセスで制御する場合 (control.daemon.enable) の、WEB のプロセス側の窓口
+daemon = None
+# NOTE: 別プロセスで制御する場合に、デーモン側で状態と流量を書き込む共有メモリ
+shared_state = None
+
+
+def get_flow(offset=0):
+    # NOTE: 別プロセスで制御している場合は、デーモンが読んだ値を返す
+    if daemon is not None:
+        return daemon.get_flow(offset)
+
+    return read_flow(offset)
 
 
 # NOTE: STAT_PATH_VALVE_CONTROL_COMMAND の内容に基づいて、
@@ -140,15 +159,28 @@ def control_worker(config, queue):  # noqa: PLR0912, PLR0915, C901
     notify_last_flow_sum = 0
     notify_last_count = 0
     stop_measure = False
+    # NOTE: 水やりのトレース用 (計測の開始と、バルブを閉じた時刻)
+    trace_open_ts = None
+    trace_close_ts = None
+    is_flow_started = False
 
     i = 0
     while True:
         if should_terminate.is_set():
             break
 
+        span_start = rasp_water.metrics.span.start()
+
         if time_open_start is not None:
-            flow = get_flow(config["flow"]["offset"])["flow"]
+            with rasp_water.metrics.registry.ADC_READ.time(), rasp_water.metrics.span.span("valve.get_flow"):
+                flow = get_flow(config["flow"]["offset"])["flow"]
+            rasp_water.metrics.registry.FLOW.set(flow)
+            if shared_state is not None:
+                shared_state.add_sample(flow)
             logging.debug("Current flow: %.1f", flow)
+            if (not is_flow_started) and (flow > 0):
+                rasp_water.metrics.trace.instant("flow.first_nonzero", flow=flow)
+                is_flow_started = True
             flow_sum += flow
             count_flow += 1
 
@@ -164,6 +196,9 @@ def control_worker(config, queue):  # noqa: PLR0912, PLR0915, C901
                 notify_last_time = my_lib.rpi.gpio_time()
                 notify_last_flow_sum = flow_sum
                 notify_last_count = count_flow
+        elif (shared_state is not None) and shared_state.is_flow_requested():
+            # NOTE: 計測していない間は、WEB のプロセスから流量の問い合わせがあった時だけ読んで書き込む
+            shared_state.add_sample(get_flow(config["flow"]["offset"])["flow"])
 
         # NOTE: 以下の処理はファイルシステムへのアクセスが発生するので、実施頻度を落とす
         if i % 5 == 0:
@@ -174,6 +209,8 @@ def control_worker(config, queue):  # noqa: PLR0912, PLR0915, C901
 
                     time_open_start = my_lib.rpi.gpio_time()
                     notify_last_time = time_open_start
+                    trace_open_ts = rasp_water.metrics.trace.get_ts()
+                    rasp_water.metrics.trace.instant("flow.measure_start")
                     # NOTE: バルブを閉じてから流量が 0 になるまでに再度開いた場合にエラーにならないようにする
                     time_close = None
             else:
@@ -190,6 +227,8 @@ def control_worker(config, queue):  # noqa: PLR0912, PLR0915, C901
                             # STAT_PATH_VALVE_CONTROL_COMMAND は削除される
                             set_state(VALVE_STATE.CLOSE)
                             time_close = my_lib.rpi.gpio_time()
+                            trace_close_ts = rasp_water.metrics.trace.get_ts()
+                            rasp_water.metrics.trace.instant("valve.close", reason="timer")
                     except Exception:
                         logging.exception("Failed to read command")
 
@@ -197,6 +236,8 @@ def control_worker(config, queue):  # noqa: PLR0912, PLR0915, C901
                     logging.info("May be manually closed")
                     set_state(VALVE_STATE.CLOSE)
                     time_close = my_lib.rpi.gpio_time()
+                    trace_close_ts = rasp_water.metrics.trace.get_ts()
+                    rasp_water.metrics.trace.instant("valve.close", reason="manual")
 
             if (time_close is not None) and (time_open_start is not None):
                 period_sec = my_lib.rpi.gpio_time() - time_open_start
@@ -214,6 +255,7 @@ def control_worker(config, queue):  # noqa: PLR0912, PLR0915, C901
                 # NOTE: バルブが閉じられた後、流量が 0 になっていたらトータル流量を報告する
                 if count_zero > TIME_ZERO_TAIL:
                     logging.info("Stop flow measurement")
+                    rasp_water.metrics.trace.complete("flow.zero_tail", trace_close_ts)
 
                     # NOTE: 流量(L/min)の平均を求めてから期間(min)を掛ける
                     total = float(flow_sum) / count_flow * period_sec / 60
@@ -225,36 +267,45 @@ def control_worker(config, queue):  # noqa: PLR0912, PLR0915, C901
                         period_sec,
                         total,
                     )
+                    rasp_water.metrics.trace.complete("flow.measure", trace_open_ts, total=total)
+
+                    # NOTE: is_end は 1 回の水やりの最後の通知に付ける (トレースの書き出し用)
+                    is_close_fail = (period_sec > TIME_CLOSE_FAIL) and (total < 1)
                     queue.put(
                         {
                             "type": "total",
                             "period": period_sec,
                             "total": total,
                             "auto": current_auto_mode,
+                            "is_end": not is_close_fail,
                         }
                     )
 
-                    if (period_sec > TIME_CLOSE_FAIL) and (total < 1):
+                    if is_close_fail:
                         queue.put(
                             {
                                 "type": "error",
                                 "message": "😵 元栓が閉まっている可能性があります。",
+                                "is_end": True,
                             }
                         )
 
                     stop_measure = True
                 elif (my_lib.rpi.gpio_time() - time_close) > TIME_OPEN_FAIL:
                     set_state(VALVE_STATE.CLOSE)
+                    rasp_water.metrics.trace.complete("flow.measure", trace_open_ts)
                     queue.put(
                         {
                             "type": "error",
                             "message": "😵 バルブを閉めても水が流れ続けています。",
+                            "is_end": True,
                         }
                     )
                     stop_measure = True
 
                 if stop_measure:
                     stop_measure = False
+                    rasp_water.metrics.registry.FLOW.set(0)
                     time_open_start = None
                     time_close = None
                     flow_sum = 0
@@ -266,6 +317,13 @@ def control_worker(config, queue):  # noqa: PLR0912, PLR0915, C901
                     notify_last_flow_sum = 0
                     notify_last_count = 0
 
+                    trace_open_ts = None
+                    trace_close_ts = None
+                    is_flow_started = False
+
+        # NOTE: sleep を除いた 1 周の処理時間
+        rasp_water.metrics.span.end("valve.control_worker", span_start)
+
         time.sleep(sleep_sec)
 
         if i % (10 / sleep_sec) == 0:
@@ -276,9 +334,10 @@ def control_worker(config, queue):  # noqa: PLR0912, PLR0915, C901
     logging.info("Terminate valve control worker")
 
 
-def init(config_, queue, pin=GPIO_PIN_DEFAULT):
+def init(config_, queue, pin=GPIO_PIN_DEFAULT, use_daemon=None):
     global config  # noqa: PLW0603
     global worker  # noqa: PLW0603
+    global daemon  # noqa: PLW0603
     global pin_no  # noqa: PLW0603
     global should_terminate
     global STAT_PATH_VALVE_CONTROL_COMMAND  # noqa: PLW0603
@@ -291,11 +350,19 @@ def init(config_, queue, pin=GPIO_PIN_DEFAULT):
 
     config = config_
 
-    if worker is not None:
+    if (worker is not None) or (daemon is not None):
         raise ValueError("worker should be None")  # noqa: TRY003, EM101
 
     pin_no = pin
 
+    if use_daemon is None:
+        use_daemon = config["control"].get("daemon", {}).get("enable", False)
+
+    if use_daemon:
+        logging.info("Start valve daemon process")
+        daemon = rasp_water.control.valve_daemon.Client(config, queue, pin)
+        return
+
     set_state(VALVE_STATE.CLOSE)
 
     logging.info("Setting scale of ADC")
@@ -311,12 +378,20 @@ def init(config_, queue, pin=GPIO_PIN_DEFAULT):
             config,
             queue,
         ),
+        name="valve_control",
     )
     worker.start()
 
 
 def term():
     global worker  # noqa: PLW0603
+    global daemon  # noqa: PLW0603
+
+    # NOTE: 別プロセスで制御している場合、後始末はデーモンが行う
+    if daemon is not None:
+        daemon.term()
+        daemon = None
+        return
 
     should_terminate.set()
     worker.join()
@@ -333,6 +408,7 @@ def term():
 # NOTE: 実際にバルブを開きます。
 def set_state(valve_state):
     global pin_no
+    global last_open_time  # noqa: PLW0603
 
     logging.debug(
         "set_state = %s from %s at %s:%d",
@@ -342,36 +418,56 @@ def set_state(valve_state):
         inspect.stack()[1].lineno,
     )
 
-    curr_state = get_state()
-
-    if valve_state != curr_state:
-        logging.info("VALVE: %s -> %s", curr_state.name, valve_state.name)
-
-    my_lib.rpi.gpio.setwarnings(False)
-    my_lib.rpi.gpio.setmode(my_lib.rpi.gpio.BCM)
-    my_lib.rpi.gpio.setup(pin_no, my_lib.rpi.gpio.OUT)
-    my_lib.rpi.gpio.output(pin_no, valve_state.value)
+    if daemon is not None:
+        valve_state = daemon.set_state(valve_state)
+        last_open_time = daemon.get_state()["last_open_time"]
+        return valve_state
+
+    with rasp_water.metrics.trace.span("valve.set_state", state=valve_state.name):
+        curr_state = get_state()
+
+        if valve_state != curr_state:
+            logging.info("VALVE: %s -> %s", curr_state.name, valve_state.name)
+
+        with (
+            rasp_water.metrics.span.span("valve.gpio_output"),
+            rasp_water.metrics.trace.span("valve.gpio_output"),
+        ):
+            my_lib.rpi.gpio.setwarnings(False)
+            my_lib.rpi.gpio.setmode(my_lib.rpi.gpio.BCM)
+            my_lib.rpi.gpio.setup(pin_no, my_lib.rpi.gpio.OUT)
+            my_lib.rpi.gpio.output(pin_no, valve_state.value)
+        rasp_water.metrics.registry.VALVE_STATE.set(1 if valve_state == VALVE_STATE.OPEN else 0)
+
+        if valve_state == VALVE_STATE.OPEN:
+            last_open_time = datetime.datetime.now()
+            my_lib.footprint.clear(STAT_PATH_VALVE_CLOSE)
+            my_lib.footprint.update(STAT_PATH_VALVE_OPEN)
+        else:
+            my_lib.footprint.clear(STAT_PATH_VALVE_OPEN)
+            my_lib.footprint.clear(STAT_PATH_VALVE_CONTROL_COMMAND)
+            my_lib.footprint.update(STAT_PATH_VALVE_CLOSE)
 
-    if valve_state == VALVE_STATE.OPEN:
-        my_lib.footprint.clear(STAT_PATH_VALVE_CLOSE)
-        my_lib.footprint.update(STAT_PATH_VALVE_OPEN)
-    else:
-        my_lib.footprint.clear(STAT_PATH_VALVE_OPEN)
-        my_lib.footprint.clear(STAT_PATH_VALVE_CONTROL_COMMAND)
-        my_lib.footprint.update(STAT_PATH_VALVE_CLOSE)
+        if shared_state is not None:
+            shared_state.set_valve(valve_state, last_open_time)
 
-    return get_state()
+        return get_state()
 
 
 # NOTE: 実際のバルブの状態を返します
 def get_state():
     global pin_no
 
-    my_lib.rpi.gpio.setwarnings(False)
-    my_lib.rpi.gpio.setmode(my_lib.rpi.gpio.BCM)
-    my_lib.rpi.gpio.setup(pin_no, my_lib.rpi.gpio.OUT)
+    if daemon is not None:
+        return daemon.get_state()["valve"]
+
+    with rasp_water.metrics.span.span("valve.gpio_input"), rasp_water.metrics.trace.span("valve.gpio_input"):
+        my_lib.rpi.gpio.setwarnings(False)
+        my_lib.rpi.gpio.setmode(my_lib.rpi.gpio.BCM)
+        my_lib.rpi.gpio.setup(pin_no, my_lib.rpi.gpio.OUT)
+        level = my_lib.rpi.gpio.input(pin_no)
 
-    if my_lib.rpi.gpio.input(pin_no) == 1:
+    if level == 1:
         return VALVE_STATE.OPEN
     else:
         return VALVE_STATE.CLOSE
@@ -379,31 +475,63 @@ def get_state():
 
 def set_control_mode(open_sec, auto=False):
     global current_auto_mode
+    global last_open_time  # noqa: PLW0603
+
+    if daemon is not None:
+        daemon.set_control_mode(open_sec, auto)
+        last_open_time = daemon.get_state()["last_open_time"]
+        return
+
     current_auto_mode = auto
     
     logging.info("Open valve for %d sec (auto=%s)", open_sec, auto)
 
     set_state(VALVE_STATE.OPEN)
-    my_lib.footprint.update(STAT_PATH_VALVE_CONTROL_COMMAND, my_lib.rpi.gpio_time() + open_sec)
+    time_to_close = my_lib.rpi.gpio_time() + open_sec
+    my_lib.footprint.update(STAT_PATH_VALVE_CONTROL_COMMAND, time_to_close)
+    if shared_state is not None:
+        shared_state.set_time_to_close(time_to_close)
 
 
 def get_control_mode():
-    if my_lib.footprint.exists(STAT_PATH_VALVE_CONTROL_COMMAND):
+    if daemon is not None:
+        # NOTE: 共有メモリの値を使い、ファイルシステムにはアクセスしない
+        time_to_close = daemon.get_state()["time_to_close"]
+        if time_to_close == 0:
+            return {"mode": CONTROL_MODE.IDLE, "remain": 0}
+    elif my_lib.footprint.exists(STAT_PATH_VALVE_CONTROL_COMMAND):
         time_to_close = my_lib.footprint.mtime(STAT_PATH_VALVE_CONTROL_COMMAND)
-        time_now = my_lib.rpi.gpio_time()
-
-        if time_to_close >= time_now:
-            return {
-                "mode": CONTROL_MODE.TIMER,
-                "remain": time_to_close - time_now,
-            }
-        else:
-            if (time_now - time_to_close) > 1:
-                logging.warning("Timer control of the valve may be broken")
-            return {"mode": CONTROL_MODE.TIMER, "remain": 0}
     else:
         return {"mode": CONTROL_MODE.IDLE, "remain": 0}
 
+    time_now = my_lib.rpi.gpio_time()
+
+    if time_to_close >= time_now:
+        return {
+            "mode": CONTROL_MODE.TIMER,
+            "remain": time_to_close - time_now,
+        }
+    else:
+        if (time_now - time_to_close) > 1:
+            logging.warning("Timer control of the valve may be broken")
+        return {"mode": CONTROL_MODE.TIMER, "remain": 0}
+
+
+def sync_metrics():
+    """別プロセスで制御している場合に、共有メモリの状態をこのプロセスのメトリクスに反映"""
+    if daemon is None:
+        return
+
+    try:
+        state = daemon.get_state()
+        sample = daemon.shared_state.get_fresh_sample()
+    except rasp_water.control.valve_daemon.DaemonError as e:
+        logging.warning("Failed to read the state of valve daemon: %s", e)
+        return
+
+    rasp_water.metrics.registry.VALVE_STATE.set(1 if state["valve"] == VALVE_STATE.OPEN else 0)
+    rasp_water.metrics.registry.FLOW.set(0 if sample is None else sample[1])
+
 
 if __name__ == "__main__":
     from multiprocessing import Queue
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+電磁弁の制御と流量の計測を、WEB サーバとは別のプロセス (デーモン) で行います。
+
+同じプロセスで動かすと、リクエストの処理やグラフの描画、SQLite へのアクセスと GIL を取り合うので、
+流量のサンプリングやバルブを閉じるタイミングが遅れることがあります。
+control.daemon.enable を true にすると、rasp_water.control.valve の制御スレッドを別プロセスで動かし、
+WEB のプロセスとは次の方法でやり取りします。
+
+- バルブの状態と流量のサンプルは共有メモリに置き、プロセス間で共有するロックを取って読み書きする
+  (バルブが閉じている間は、WEB のプロセスから流量の問い合わせがあった時だけ、デーモンは流量を読む)
+- バルブの操作は、パイプを使ったコマンドでデーモンに依頼する (応答を待つ期限を過ぎたコマンドは実行しない)
+- 水やりのトレースのイベントは、通知用のキューで WEB のプロセスに送る
+
+デーモンが停止した場合は、WEB のプロセスがエラーを通知して再起動します (起動したデーモンはバルブを閉じます)。
+
+設定に応じて、デーモンを特定の CPU に固定し、リアルタイム優先度 (SCHED_FIFO) で動かします。
+なお、デーモン内で記録したスパンや ADC の読み取り時間は、WEB のプロセスのメトリクスには含まれません。
+
+Usage:
+  valve_daemon.py [-c CONFIG] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
+  -D                : デバッグモードで動作します。
+"""
+
+from __future__ import annotations
+
+import contextlib
+import datetime
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import my_lib.webapp.config
+import rasp_water.control.valve
+import rasp_water.metrics.trace
+
+# NOTE: 流量のサンプルを保持する数 (制御周期 0.1 秒で 60 秒分)
+SAMPLE_RING_SIZE = 600
+
+# NOTE: 最新のサンプルがこれより古い場合は、デーモンが止まっているとみなす。
+# また、バルブが閉じている間は、流量の問い合わせからこの時間だけデーモンが流量を読む
+SAMPLE_FRESH_SEC = 2
+
+# NOTE: バルブが閉じている間に流量を問い合わせた場合に、デーモンが読んだ値をこの時間まで待つ
+FLOW_WAIT_SEC = 0.5
+FLOW_POLL_SEC = 0.05
+
+# NOTE: コマンドの応答をこの時間待っても来なければエラーにする (デーモンは、期限を過ぎたコマンドを実行しない)
+COMMAND_TIMEOUT_SEC = 5
+# NOTE: 期限の直前に実行を始めたコマンドの応答も受け取れるように、期限より少し長く待つ
+COMMAND_GRACE_SEC = 1
+
+# NOTE: デーモンが停止していないか確認する間隔
+SUPERVISE_INTERVAL_SEC = 1
+
+# NOTE: デーモンの終了をこの時間待っても終わらなければ、強制終了する
+TERM_TIMEOUT_SEC = 10
+
+# NOTE: 共有メモリのロックをこの時間待っても取れなければエラーにする
+LOCK_TIMEOUT_SEC = 0.5
+
+# NOTE: 共有メモリ上の状態の配置
+STATE_INDEX_VALVE = 0  # VALVE_STATE の値
+STATE_INDEX_TIME_TO_CLOSE = 1  # バルブを閉じるべき時刻 (タイマー動作していない場合は 0)
+STATE_INDEX_LAST_OPEN = 2  # 最後にバルブを開いた UNIX 時間 (開いていない場合は 0)
+STATE_INDEX_SAMPLE_COUNT = 3  # これまでに書き込んだサンプルの数
+STATE_INDEX_FLOW_REQUEST = 4  # 最後に流量を問い合わせた monotonic 時刻 (問い合わせていない場合は 0)
+STATE_SIZE = 5
+
+
+class DaemonError(Exception):
+    """デーモンや共有メモリにアクセスできない"""
+
+
+class SharedState:
+    """
+    バルブの状態と流量のサンプル (リングバッファ) を置く共有メモリ
+
+    読み書きは、プロセス間で共有するロックを取って行います (ロックがメモリの順序も保証します)。
+    ロックを持つのは値をコピーする間だけで、LOCK_TIMEOUT_SEC 秒で取れない場合、読み出しは DaemonError を
+    送出します。書き込みは主にデーモンが行うので、バルブの制御を止めないように、諦めて続けます。
+    """
+
+    def __init__(self, context):
+        self.lock = context.Lock()
+        self.state = context.RawArray("d", STATE_SIZE)
+        # NOTE: (monotonic 時刻, 流量) の組を並べる
+        self.ring = context.RawArray("d", SAMPLE_RING_SIZE * 2)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        if not self.lock.acquire(timeout=LOCK_TIMEOUT_SEC):
+            raise DaemonError("Failed to lock shared state")  # noqa: TRY003, EM101
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def _write(self, value_map, sample=None):
+        try:
+            with self._lock():
+                for index, value in value_map.items():
+                    self.state[index] = value
+                if sample is not None:
+                    count = int(self.state[STATE_INDEX_SAMPLE_COUNT])
+                    pos = (count % SAMPLE_RING_SIZE) * 2
+                    self.ring[pos] = sample[0]
+                    self.ring[pos + 1] = sample[1]
+                    self.state[STATE_INDEX_SAMPLE_COUNT] = count + 1
+        except DaemonError as e:
+            logging.warning("Failed to write shared state: %s", e)
+
+    def set_valve(self, valve_state, last_open_time):
+        value_map = {
+            STATE_INDEX_VALVE: valve_state.value,
+            STATE_INDEX_LAST_OPEN: 0 if last_open_time is None else last_open_time.timestamp(),
+        }
+        if valve_state == rasp_water.control.valve.VALVE_STATE.CLOSE:
+            value_map[STATE_INDEX_TIME_TO_CLOSE] = 0
+
+        self._write(value_map)
+
+    def set_time_to_close(self, time_to_close):
+        self._write({STATE_INDEX_TIME_TO_CLOSE: time_to_close})
+
+    def add_sample(self, flow):
+        self._write({}, (time.monotonic(), flow))
+
+    def request_flow(self):
+        self._write({STATE_INDEX_FLOW_REQUEST: time.monotonic()})
+
+    def is_flow_requested(self):
+        try:
+            with self._lock():
+                request_time = self.state[STATE_INDEX_FLOW_REQUEST]
+        except DaemonError as e:
+            logging.warning("Failed to read shared state: %s", e)
+            return False
+
+        return (request_time != 0) and ((time.monotonic() - request_time) < SAMPLE_FRESH_SEC)
+
+    def get_state(self):
+        with self._lock():
+            state = self.state[:]
+
+        return {
+            "valve": rasp_water.control.valve.VALVE_STATE(int(state[STATE_INDEX_VALVE])),
+            "time_to_close": state[STATE_INDEX_TIME_TO_CLOSE],
+            "last_open_time": (
+                None
+                if state[STATE_INDEX_LAST_OPEN] == 0
+                else datetime.datetime.fromtimestamp(state[STATE_INDEX_LAST_OPEN])
+            ),
+        }
+
+    def get_sample_list(self, count=SAMPLE_RING_SIZE):
+        """新しい順に最大 count 個の (monotonic 時刻, 流量)"""
+        sample_list = []
+        with self._lock():
+            total = int(self.state[STATE_INDEX_SAMPLE_COUNT])
+            for i in range(total - 1, max(total - min(count, SAMPLE_RING_SIZE), 0) - 1, -1):
+                pos = (i % SAMPLE_RING_SIZE) * 2
+                sample_list.append((self.ring[pos], self.ring[pos + 1]))
+
+        return sample_list
+
+    def get_fresh_sample(self):
+        """SAMPLE_FRESH_SEC 秒以内の最新のサンプル (無い場合は None)"""
+        sample_list = self.get_sample_list(1)
+        if (len(sample_list) != 0) and ((time.monotonic() - sample_list[0][0]) < SAMPLE_FRESH_SEC):
+            return sample_list[0]
+
+        return None
+
+
+def set_priority(daemon_config):
+    """CPU の固定とリアルタイム優先度の設定 (権限が無いなどで失敗しても動作は続ける)"""
+    if "cpu" in daemon_config:
+        try:
+            os.sched_setaffinity(0, {daemon_config["cpu"]})
+            logging.info("Pin valve daemon to CPU %d", daemon_config["cpu"])
+        except (AttributeError, OSError) as e:
+            logging.warning("Failed to set CPU affinity: %s", e)
+
+    if "priority" in daemon_config:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(daemon_config["priority"]))
+            logging.info("Set real-time priority of valve daemon to %d", daemon_config["priority"])
+        except (AttributeError, OSError) as e:
+            logging.warning("Failed to set real-time priority: %s", e)
+
+
+def handle_command(command):
+    name = command["name"]
+
+    if name == "set_state":
+        return rasp_water.control.valve.set_state(rasp_water.control.valve.VALVE_STATE(command["state"]))
+    elif name == "set_control_mode":
+        return rasp_water.control.valve.set_control_mode(command["open_sec"], command["auto"])
+    else:
+        raise ValueError(f"Unknown command: {name}")  # noqa: TRY003, EM102
+
+
+def daemon_main(config, queue, pin, shared_state, conn, log_level):  # noqa: PLR0913  # pragma: no cover
+    import my_lib.logger
+
+    my_lib.logger.init("hems.rasp-water", level=log_level)
+    my_lib.webapp.config.init(config)
+
+    # NOTE: 記録中の水やりは WEB のプロセスにあるので、イベントは通知用のキューで送る
+    rasp_water.metrics.trace.init(config)
+    if rasp_water.metrics.trace.is_enable:
+        rasp_water.metrics.trace.set_forward(queue)
+
+    # NOTE: 制御スレッドを起動する前に設定し、スレッドに引き継がせる
+    set_priority(config["control"]["daemon"])
+
+    rasp_water.control.valve.shared_state = shared_state
+    rasp_water.control.valve.init(config, queue, pin, use_daemon=False)
+
+    logging.info("Start valve daemon")
+    try:
+        while True:
+            try:
+                command = conn.recv()
+            except EOFError:
+                # NOTE: WEB のプロセスが終了した場合
+                logging.warning("Command channel is closed")
+                break
+
+            if command is None:
+                break
+
+            # NOTE: WEB のプロセスが応答を待つのを諦めたコマンドは、実行しない
+            if time.monotonic() > command["deadline"]:
+                logging.warning("Drop expired command: %s", command["name"])
+                conn.send({"id": command["id"], "error": f"Command expired: {command['name']}"})
+                continue
+
+            try:
+                conn.send({"id": command["id"], "value": handle_command(command)})
+            except Exception as e:
+                logging.exception("Failed to execute command: %s", command["name"])
+                conn.send({"id": command["id"], "error": str(e)})
+    finally:
+        # NOTE: バルブを閉じてから終了する
+        rasp_water.control.valve.term()
+        logging.info("Terminate valve daemon")
+
+
+class Client:
+    """WEB のプロセスからデーモンを起動・監視し、状態の参照とコマンドの送信を行う"""
+
+    def __init__(self, config, queue, pin):
+        # NOTE: スレッドが動いているプロセスを fork しないように、spawn で起動する
+        self.context = multiprocessing.get_context("spawn")
+        self.config = config
+        self.queue = queue
+        self.pin = pin
+
+        self.lock = threading.Lock()
+        self.command_id = 0
+        self.start()
+
+        self.should_terminate = threading.Event()
+        self.supervisor = threading.Thread(
+            target=self.supervise_worker, name="valve_daemon_supervisor", daemon=True
+        )
+        self.supervisor.start()
+
+    def start(self):
+        # NOTE: 停止したデーモンがロックを持ったままの可能性があるので、共有メモリとパイプは作り直す
+        self.shared_state = SharedState(self.context)
+        self.conn, daemon_conn = self.context.Pipe()
+
+        self.process = self.context.Process(
+            target=daemon_main,
+            args=(
+                self.config,
+                self.queue,
+                self.pin,
+                self.shared_state,
+                daemon_conn,
+                logging.getLogger().getEffectiveLevel(),
+            ),
+            name="valve_daemon",
+            daemon=True,
+        )
+        self.process.start()
+        daemon_conn.close()
+
+    def restart(self):
+        """停止したデーモンを起動し直す (self.lock を取った状態で呼ぶ)"""
+        message = f"バルブを制御するデーモンが停止したので再起動します。(終了コード: {self.process.exitcode})"
+        logging.error(message)
+
+        self.process.join()
+        self.conn.close()
+
+        # NOTE: 起動したデーモンは、最初にバルブを閉じる
+        self.start()
+
+        # NOTE: 計測中の水やりの集計は失われるので、エラーとして通知する
+        self.queue.put({"type": "error", "message": message})
+
+    def supervise_worker(self):
+        while not self.should_terminate.wait(SUPERVISE_INTERVAL_SEC):
+            with self.lock:
+                if (not self.should_terminate.is_set()) and (not self.process.is_alive()):
+                    self.restart()
+
+    def command(self, name, **arg_map):
+        with self.lock:
+            if not self.process.is_alive():
+                self.restart()
+
+            self.command_id += 1
+            # NOTE: 応答を待つのを諦めた後で実行されないように、期限を付けて送る
+            deadline = time.monotonic() + COMMAND_TIMEOUT_SEC
+            try:
+                self.conn.send(dict({"id": self.command_id, "name": name, "deadline": deadline}, **arg_map))
+
+                while True:
+                    wait_sec = deadline + COMMAND_GRACE_SEC - time.monotonic()
+                    if (wait_sec <= 0) or (not self.conn.poll(wait_sec)):
+                        raise DaemonError(f"Valve daemon did not respond: {name}")  # noqa: TRY003, EM102
+
+                    reply = self.conn.recv()
+                    # NOTE: タイムアウトしたコマンドの応答が遅れて届いた場合は読み捨てる
+                    if reply["id"] == self.command_id:
+                        break
+            except (OSError, EOFError) as e:
+                raise DaemonError(f"Valve daemon is not running: {name}") from e  # noqa: TRY003, EM102
+
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+
+        return reply["value"]
+
+    def set_state(self, valve_state):
+        return self.command("set_state", state=valve_state.value)
+
+    def set_control_mode(self, open_sec, auto):
+        return self.command("set_control_mode", open_sec=open_sec, auto=auto)
+
+    def get_state(self):
+        return self.shared_state.get_state()
+
+    def get_flow(self, offset):  # noqa: ARG002
+        # NOTE: 流量はデーモンが共有メモリに書き込むので、コマンドは送らずに最新のサンプルを返す。
+        # バルブが閉じている間は、問い合わせがあった時だけデーモンが読むので、無ければ少し待つ
+        shared_state = self.shared_state
+        try:
+            shared_state.request_flow()
+
+            sample = shared_state.get_fresh_sample()
+            time_end = time.monotonic() + FLOW_WAIT_SEC
+            while (sample is None) and (time.monotonic() < time_end):
+                time.sleep(FLOW_POLL_SEC)
+                sample = shared_state.get_fresh_sample()
+        except DaemonError as e:
+            logging.warning("Failed to read flow: %s", e)
+            sample = None
+
+        if sample is None:
+            return {"flow": 0, "result": "fail"}
+
+        return {"flow": sample[1], "result": "success"}
+
+    def term(self):
+        self.should_terminate.set()
+        self.supervisor.join()
+
+        # NOTE: デーモンが既に終了している場合は送れない
+        with self.lock, contextlib.suppress(OSError):
+            self.conn.send(None)
+
+        self.process.join(TERM_TIMEOUT_SEC)
+        if self.process.is_alive():
+            logging.warning("Valve daemon did not terminate")
+            self.process.kill()
+            self.process.join()
+
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.config
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    config = my_lib.config.load(config_file)
+    config["control"]["daemon"] = dict(config["control"].get("daemon", {}), enable=True)
+    my_lib.webapp.config.init(config)
+
+    queue = multiprocessing.Manager().Queue()
+    rasp_water.control.valve.init(config, queue)
+
+    rasp_water.control.valve.set_control_mode(5)
+    for _ in range(10):
+        logging.info(
+            "%s, flow: %.2f",
+            rasp_water.control.valve.get_control_mode(),
+            rasp_water.control.valve.get_flow(config["flow"]["offset"])["flow"],
+        )
+        time.sleep(1)
+
+    while True:
+        info = queue.get()
+        logging.info(info)
+
+        if info["type"] == "total":
+            break
+
+    rasp_water.control.valve.term()
@@ -10,71 +10,185 @@ Options:
   -D                : デバッグモードで動作します。
 """
 
-import datetime
-import functools
-import json
 import logging
+import pathlib
+import threading
+import time
 
 import my_lib.pretty
+import my_lib.serializer
 import my_lib.time
 import my_lib.webapp.config
-import requests
+import rasp_water.control.forecast_provider
+
+# NOTE: Yahoo の降水量は 10 分毎に更新されるので、それに合わせてキャッシュする
+CACHE_TTL_SEC = 10 * 60
+# NOTE: TTL を過ぎてもこの時間内であれば、バックグラウンドで更新しつつ古いデータを使う
+CACHE_EXPIRE_SEC = 60 * 60
+# NOTE: 有効期限を過ぎて取得にも失敗した場合、この時間内であれば最後に取得できたデータを使う
+CACHE_FALLBACK_SEC = 3 * 60 * 60
+CACHE_FILE_PATH_DEFAULT = "flask/data/weather_forecast.dat"
+
+# NOTE: Yahoo は 1 時間後までしか予報が取れないので、他のプロバイダでも同じ範囲で合計する
+FORECAST_HOUR = 1
+
+cache_lock = threading.Lock()
+# NOTE: 座標をキーにして、{"time": 取得時刻, "timeline": RainfallTimeline} を保持する
+cache_data = None
+cache_file_path = None
+cache_refresh_set = set()
+
+provider_lock = threading.Lock()
+provider_list = None
+
+
+def get_cache_key(config):
+    return ",".join(
+        map(
+            str,
+            [
+                config["weather"]["rain_fall"]["forecast"]["point"]["lon"],
+                config["weather"]["rain_fall"]["forecast"]["point"]["lat"],
+            ],
+        )
+    )
+
 
-YAHOO_API_ENDPOINT = "https://map.yahooapis.jp/weather/V1/place"
+def cache_load(config):
+    global cache_data  # noqa: PLW0603
+    global cache_file_path  # noqa: PLW0603
 
+    if cache_data is not None:
+        return cache_data
 
-def get_weather_info_yahoo(config):
+    cache_file_path = pathlib.Path(
+        config["weather"]["rain_fall"]["forecast"].get("cache_file_path", CACHE_FILE_PATH_DEFAULT)
+    )
     try:
-        params = {
-            "appid": config["weather"]["rain_fall"]["forecast"]["yahoo"]["id"],
-            "coordinates": ",".join(
-                map(
-                    str,
-                    [
-                        config["weather"]["rain_fall"]["forecast"]["point"]["lon"],
-                        config["weather"]["rain_fall"]["forecast"]["point"]["lat"],
-                    ],
-                )
-            ),
-            "output": "json",
-            "past": 2,
-        }
-
-        res = requests.get(YAHOO_API_ENDPOINT, params=params, timeout=5)
-
-        if res.status_code != 200:
-            logging.warning("Failed to fetch weather info from Yahoo")
-            return None
-
-        return json.loads(res.content)["Feature"][0]["Property"]["WeatherList"]["Weather"]
+        cache_data = my_lib.serializer.load(cache_file_path, {})
     except Exception:
-        logging.warning("Failed to fetch weather info from Yahoo")
-        return None
+        logging.warning("Failed to load weather forecast cache")
+        cache_data = {}
+
+    return cache_data
+
+
+def cache_store(config, key, timeline):
+    with cache_lock:
+        cache_load(config)[key] = {"time": time.time(), "timeline": timeline}
+
+        try:
+            my_lib.serializer.store(cache_file_path, cache_data)
+        except Exception:
+            logging.warning("Failed to store weather forecast cache")
+
+
+def cache_clear():
+    global cache_data  # noqa: PLW0603
+
+    with cache_lock:
+        cache_data = None
+        if cache_file_path is not None:
+            cache_file_path.unlink(missing_ok=True)
+
+
+def get_provider_list(config):
+    global provider_list  # noqa: PLW0603
+
+    with provider_lock:
+        if provider_list is None:
+            provider_list = rasp_water.control.forecast_provider.create_provider_list(
+                config["weather"]["rain_fall"]["forecast"]
+            )
+
+        return provider_list
+
+
+def provider_clear():
+    global provider_list  # noqa: PLW0603
+
+    with provider_lock:
+        if provider_list is not None:
+            for provider in provider_list:
+                provider.close()
+        provider_list = None
+
+
+def fetch_weather_info(config):
+    # NOTE: 優先度の高いプロバイダから順に試し、最初に取得できたものを使う
+    for provider in get_provider_list(config):
+        timeline = provider.fetch(config["weather"]["rain_fall"]["forecast"]["point"])
+        if timeline is not None:
+            return timeline
+
+    return None
+
+
+def refresh_weather_info(config, key):
+    try:
+        timeline = fetch_weather_info(config)
+        if timeline is not None:
+            cache_store(config, key, timeline)
+    finally:
+        with cache_lock:
+            cache_refresh_set.discard(key)
+
+
+def get_weather_info(config):
+    key = get_cache_key(config)
+
+    with cache_lock:
+        entry = cache_load(config).get(key)
+
+    if (entry is not None) and ("timeline" in entry):
+        age_sec = time.time() - entry["time"]
+
+        if age_sec < CACHE_TTL_SEC:
+            return entry["timeline"]
+
+        if age_sec < CACHE_EXPIRE_SEC:
+            # NOTE: 古いデータを返しつつ、バックグラウンドで更新する
+            with cache_lock:
+                if key not in cache_refresh_set:
+                    cache_refresh_set.add(key)
+                    threading.Thread(
+                        target=refresh_weather_info, args=(config, key), name="weather_forecast"
+                    ).start()
+            return entry["timeline"]
+
+    timeline = fetch_weather_info(config)
+    if timeline is not None:
+        cache_store(config, key, timeline)
+        return timeline
+
+    if (entry is not None) and ("timeline" in entry):
+        age_sec = time.time() - entry["time"]
+        if age_sec < CACHE_FALLBACK_SEC:
+            logging.warning("Failed to fetch weather forecast, use cached one (%d sec old)", age_sec)
+            return entry["timeline"]
+
+    return None
 
 
 def get_rain_fall(config):
-    weather_info = get_weather_info_yahoo(config)
+    timeline = get_weather_info(config)
 
-    if weather_info is None:
+    if timeline is None:
         return (False, 0)
 
-    logging.debug(my_lib.pretty.format(weather_info))
+    logging.debug(my_lib.pretty.format(timeline))
 
-    # NOTE: YAhoo の場合、1 時間後までしか情報がとれないことに注意
+    now = my_lib.time.now().timestamp()
+
+    # NOTE: どのプロバイダでも 10 分毎の降水強度に揃えてあるので、同じ範囲であれば合計値の意味は同じ
     rainfall_list = [
-        x["Rainfall"]
-        for x in filter(
-            lambda x: (
-                my_lib.time.now()
-                - datetime.datetime.strptime(x["Date"], "%Y%m%d%H%M").replace(tzinfo=my_lib.time.get_pytz())
-            ).total_seconds()
-            / (60 * 60)
-            < config["weather"]["rain_fall"]["forecast"]["threshold"]["before_hour"],
-            weather_info,
-        )
+        rainfall
+        for date, rainfall in zip(timeline.time, timeline.rainfall, strict=True)
+        if ((now - date) / (60 * 60) < config["weather"]["rain_fall"]["forecast"]["threshold"]["before_hour"])
+        and ((date - now) / (60 * 60) <= FORECAST_HOUR)
     ]
 
-    rainfall_sum = functools.reduce(lambda x, y: x + y, rainfall_list)
+    rainfall_sum = sum(rainfall_list)
 
     logging.info(
         "Rain fall forecast sum: %d (%s)", rainfall_sum, ", ".join(f"{num:.1f}" for num in rainfall_list)
@@ -14,8 +14,8 @@ Options:
 import datetime
 import logging
 
-import my_lib.sensor_data
 import my_lib.time
+import rasp_water.control.rain_fall_cache
 import rasp_water.control.scheduler
 
 
@@ -52,13 +52,8 @@ def hours_since_last_watering():
 
 
 def get_rain_fall_sum(config, hours):
-    return my_lib.sensor_data.get_hour_sum(
-        config["influxdb"],
-        config["weather"]["rain_fall"]["sensor"]["measure"],
-        config["weather"]["rain_fall"]["sensor"]["hostname"],
-        "rain",
-        hours=hours,
-    )
+    # NOTE: InfluxDB に毎回長期間の集計をさせないよう、1 時間単位の合計値をローカルにキャッシュする
+    return rasp_water.control.rain_fall_cache.get_cache(config).get_sum(hours)
 
 
 def get_rain_fall(config):
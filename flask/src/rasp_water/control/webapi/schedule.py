@@ -37,6 +37,7 @@ def init(config):
             config,
             schedule_queue,
         ),
+        name="scheduler",
     )
     worker.start()
 
@@ -17,6 +17,9 @@ import my_lib.webapp.log
 import rasp_water.control.valve
 import rasp_water.control.weather_forecast
 import rasp_water.control.weather_sensor
+import rasp_water.metrics.collector
+import rasp_water.metrics.span
+import rasp_water.metrics.trace
 
 import flask
 
@@ -40,7 +43,7 @@ def init(config):
     flow_stat_manager = multiprocessing.Manager()
     flow_stat_queue = flow_stat_manager.Queue()
     rasp_water.control.valve.init(config, flow_stat_queue)
-    worker = threading.Thread(target=flow_notify_worker, args=(config, flow_stat_queue))
+    worker = threading.Thread(target=flow_notify_worker, args=(config, flow_stat_queue), name="flow_notify")
     worker.start()
 
 
@@ -61,9 +64,10 @@ def term():
 
 def send_data(config, flow):
     logging.info("Send fluentd: flow = %.2f", flow)
-    sender = fluent.sender.FluentSender(config["fluent"]["data"]["tag"], host=config["fluent"]["host"])
-    sender.emit("rasp", {"hostname": config["fluent"]["data"]["hostname"], "flow": flow})
-    sender.close()
+    with rasp_water.metrics.trace.span("fluentd.send", flow=flow):
+        sender = fluent.sender.FluentSender(config["fluent"]["data"]["tag"], host=config["fluent"]["host"])
+        sender.emit("rasp", {"hostname": config["fluent"]["data"]["hostname"], "flow": flow})
+        sender.close()
 
 
 def second_str(sec):
@@ -82,6 +86,77 @@ def second_str(sec):
         return f"{sec}秒"
 
 
+def notify_total(config, stat):
+    my_lib.webapp.log.info(
+        "🚿 {time_str}間、約 {water:.2f}L の水やりを行いました。".format(
+            time_str=second_str(stat["period"]), water=stat["total"]
+        )
+    )
+
+    # メトリクス記録
+    try:
+        operation_type = "auto" if stat.get("auto", False) else "manual"
+        with rasp_water.metrics.trace.span("metrics.record_watering"):
+            rasp_water.metrics.collector.record_watering(
+                operation_type=operation_type,
+                duration_seconds=stat["period"],
+                volume_liters=stat["total"],
+                metrics_data_path=config["metrics"]["data"]
+            )
+    except Exception as e:
+        logging.warning("Failed to record watering metrics: %s", e)
+
+
+def notify_error(config, stat):
+    # エラーメトリクス記録
+    is_new = True
+    rasp_water.metrics.trace.instant("error", message=stat["message"])
+    try:
+        with rasp_water.metrics.trace.span("metrics.record_error"):
+            is_new = rasp_water.metrics.collector.record_error(
+                error_type="valve_control",
+                error_message=stat["message"],
+                metrics_data_path=config["metrics"]["data"]
+            )
+    except Exception as e:
+        logging.warning("Failed to record error metrics: %s", e)
+
+    # NOTE: 同じエラーが続けて発生した場合は、最初の 1 回だけ通知する
+    if is_new:
+        my_lib.webapp.log.error(stat["message"])
+    else:
+        logging.warning("Repeated error (not notified): %s", stat["message"])
+
+
+def notify(config, stat):
+    span_start = rasp_water.metrics.span.start()
+
+    logging.debug("flow notify = %s", str(stat))
+
+    if stat["type"] == "total":
+        notify_total(config, stat)
+    elif stat["type"] == "instantaneous":
+        send_data(config, stat["flow"])
+    elif stat["type"] == "error":
+        notify_error(config, stat)
+    elif stat["type"] == "trace":
+        # NOTE: 別プロセスのデーモンで発生したトレースのイベント
+        rasp_water.metrics.trace.append_event(stat["event"], stat["thread_name"])
+    else:  # pragma: no cover
+        pass
+
+    rasp_water.metrics.span.end(f"notify.{stat['type']}", span_start)
+
+    # NOTE: 1 回の水やりの最後の通知を処理したら、トレースを書き出す
+    if stat.get("is_end", False):
+        if stat["type"] == "total":
+            rasp_water.metrics.trace.end(
+                result="success", measured_period=stat["period"], total=stat["total"]
+            )
+        else:
+            rasp_water.metrics.trace.end(result="fail", message=stat["message"])
+
+
 def flow_notify_worker(config, queue):
     global should_terminate
 
@@ -97,46 +172,7 @@ def flow_notify_worker(config, queue):
 
         try:
             if not queue.empty():
-                stat = queue.get()
-
-                logging.debug("flow notify = %s", str(stat))
-
-                if stat["type"] == "total":
-                    my_lib.webapp.log.info(
-                        "🚿 {time_str}間、約 {water:.2f}L の水やりを行いました。".format(
-                            time_str=second_str(stat["period"]), water=stat["total"]
-                        )
-                    )
-                    
-                    # メトリクス記録
-                    try:
-                        import rasp_water.metrics.collector
-                        operation_type = "auto" if stat.get("auto", False) else "manual"
-                        rasp_water.metrics.collector.record_watering(
-                            operation_type=operation_type,
-                            duration_seconds=stat["period"],
-                            volume_liters=stat["total"],
-                            metrics_data_path=config["metrics"]["data"]
-                        )
-                    except Exception as e:
-                        logging.warning("Failed to record watering metrics: %s", e)
-                elif stat["type"] == "instantaneous":
-                    send_data(config, stat["flow"])
-                elif stat["type"] == "error":
-                    my_lib.webapp.log.error(stat["message"])
-                    
-                    # エラーメトリクス記録
-                    try:
-                        import rasp_water.metrics.collector
-                        rasp_water.metrics.collector.record_error(
-                            error_type="valve_control",
-                            error_message=stat["message"],
-                            metrics_data_path=config["metrics"]["data"]
-                        )
-                    except Exception as e:
-                        logging.warning("Failed to record error metrics: %s", e)
-                else:  # pragma: no cover
-                    pass
+                notify(config, queue.get())
             time.sleep(sleep_sec)
         except OverflowError:  # pragma: no cover
             # NOTE: テストする際、freezer 使って日付をいじるとこの例外が発生する
@@ -169,7 +205,8 @@ def judge_execute(config, state, auto):
     if (state != 1) or (not auto):
         return True
 
-    rainfall_judge, rain_fall_sum = rasp_water.control.weather_sensor.get_rain_fall(config)
+    with rasp_water.metrics.trace.span("weather_sensor.get_rain_fall"):
+        rainfall_judge, rain_fall_sum = rasp_water.control.weather_sensor.get_rain_fall(config)
     if rainfall_judge:
         # NOTE: ダミーモードの場合、とにかく水やりする (CI テストの為)
         if os.environ.get("DUMMY_MODE", "false") == "true":
@@ -180,7 +217,8 @@ def judge_execute(config, state, auto):
         )
         return False
 
-    rainfall_judge, rain_fall_sum = rasp_water.control.weather_forecast.get_rain_fall(config)
+    with rasp_water.metrics.trace.span("weather_forecast.get_rain_fall"):
+        rainfall_judge, rain_fall_sum = rasp_water.control.weather_forecast.get_rain_fall(config)
 
     if rainfall_judge:
         # NOTE: ダミーモードの場合、とにかく水やりする (CI テストの為)
@@ -196,29 +234,43 @@ def judge_execute(config, state, auto):
 
 
 def set_valve_state(config, state, period, auto, host=""):
-    is_execute = judge_execute(config, state, auto)
-
-    if not is_execute:
-        my_lib.webapp.event.notify_event(my_lib.webapp.event.EVENT_TYPE.CONTROL)
-        return get_valve_state()
-
     if state == 1:
-        my_lib.webapp.log.info(
-            "{auto}で{period_str}間の水やりを開始します。{by}".format(
-                auto="🕑 自動" if auto else "🔧 手動",
-                period_str=second_str(period),
-                by=f"(by {host})" if host != "" else "",
+        # NOTE: スケジューラから呼ばれた場合は、既に記録を開始している
+        rasp_water.metrics.trace.begin("auto" if auto else "manual", period=period)
+
+    try:
+        rasp_water.metrics.trace.instant("valve.request", state=state, period=period, auto=auto, host=host)
+
+        with rasp_water.metrics.trace.span("judge_execute"):
+            is_execute = judge_execute(config, state, auto)
+
+        if not is_execute:
+            rasp_water.metrics.trace.end(result="skip")
+            my_lib.webapp.event.notify_event(my_lib.webapp.event.EVENT_TYPE.CONTROL)
+            return get_valve_state()
+
+        if state == 1:
+            my_lib.webapp.log.info(
+                "{auto}で{period_str}間の水やりを開始します。{by}".format(
+                    auto="🕑 自動" if auto else "🔧 手動",
+                    period_str=second_str(period),
+                    by=f"(by {host})" if host != "" else "",
+                )
             )
-        )
-        rasp_water.control.valve.set_control_mode(period, auto)
-    else:
-        my_lib.webapp.log.info(
-            "{auto}で水やりを終了します。{by}".format(
-                auto="🕑 自動" if auto else "🔧 手動",
-                by=f"(by {host})" if host != "" else "",
+            rasp_water.control.valve.set_control_mode(period, auto)
+        else:
+            my_lib.webapp.log.info(
+                "{auto}で水やりを終了します。{by}".format(
+                    auto="🕑 自動" if auto else "🔧 手動",
+                    by=f"(by {host})" if host != "" else "",
+                )
             )
-        )
-        rasp_water.control.valve.set_state(rasp_water.control.valve.VALVE_STATE.CLOSE)
+            rasp_water.control.valve.set_state(rasp_water.control.valve.VALVE_STATE.CLOSE)
+    except Exception as e:
+        # NOTE: 正常な場合は、流量の通知を処理するスレッドが記録を終える。
+        # 途中で失敗した場合はその通知が来ないので、ここで終えておく
+        rasp_water.metrics.trace.end(result="fail", message=str(e))
+        raise
 
     my_lib.webapp.event.notify_event(my_lib.webapp.event.EVENT_TYPE.CONTROL)
     return get_valve_state()
@@ -7,77 +7,634 @@
 - 1回あたりの水やりをした量
 - 手動で水やりをしたのか、自動で水やりをしたのか
 - エラー発生回数
+- スケジュール実行の遅延 (予定時刻から、実行の開始およびバルブを開くまで)
 
 1日に複数回水やりをした場合、それぞれの水やり毎にデータを記録します。
+日毎・週毎の集計値 (エラーは日毎の回数) は、トリガーで記録と同じトランザクション内で更新します。
+
+Usage:
+  collector.py [-c CONFIG] [-R] [-M] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
+  -R                : 日毎・週毎の集計テーブルを生データから再構築します。
+  -M                : 保持期間を過ぎた生データを削除し、空いた領域を解放します。
+  -D                : デバッグモードで動作します。
 """
 
 from __future__ import annotations
 
+import atexit
 import datetime
+import itertools
 import logging
+import math
+import queue
 import sqlite3
 import threading
+import time
+import weakref
 from pathlib import Path
 
+from rasp_water.metrics import migration, registry
+
+# NOTE: ページキャッシュのサイズ (KiB)
+CACHE_SIZE_KB = 8 * 1024
+
+# NOTE: 書き込みキューの最大長。溢れた場合は呼び出し元のスレッドで直接書き込む
+WRITE_QUEUE_SIZE = 1000
+WRITE_QUEUE_TIMEOUT_SEC = 1
+# NOTE: 1 回のトランザクションでまとめて書き込む最大件数
+WRITE_BATCH_SIZE = 100
+
+# NOTE: 書き込みがこの時間途絶えたら、保持期間を過ぎたデータの削除と領域の解放を行う
+MAINTENANCE_IDLE_SEC = 10
+# NOTE: 保持期間を過ぎたデータの削除と領域の解放は、最後に完了してからこの時間が経過するまで行わない
+MAINTENANCE_INTERVAL_SEC = 60 * 60
+# NOTE: 書き込みを長時間止めないように、少しずつ削除・解放する
+RETENTION_BATCH_SIZE = 500
+VACUUM_PAGE_COUNT = 100
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+# NOTE: 最初の発生からこの時間内に同じエラーが発生した場合は、同じ行の count を増やす
+ERROR_COALESCE_SEC = 10 * 60
+
+# NOTE: スケジュール実行の遅延の目標値。予定時刻からこの時間内にバルブを開いた割合を集計する
+SCHEDULE_SLO_SEC = 60
+SCHEDULE_QUANTILE_LIST = [0.5, 0.9, 0.99]
+
+# NOTE: datetime.date.min / max を指定された場合の ts の範囲 (タイムゾーンによっては UNIX 時間に変換できない)
+EPOCH_MIN = -(2**63)
+EPOCH_MAX = 2**63 - 1
+
+SQL_DELETE_EXPIRED = """
+    DELETE FROM {table}
+    WHERE id IN (SELECT id FROM {table} WHERE ts < ? LIMIT ?)
+"""
+
+# NOTE: プリペアドステートメントを使い回すため、SQL は定数として定義しておく
+SQL_INSERT_WATERING = """
+    INSERT INTO watering_metrics
+    (timestamp, ts, date, operation_type, duration_seconds, volume_liters)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+SQL_INSERT_ERROR = """
+    INSERT INTO error_metrics (date, error_type, error_message, timestamp, ts, last_timestamp, last_ts)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+# NOTE: まとめる対象は、直近に記録した同じ種類・メッセージの行
+SQL_COALESCE_ERROR = """
+    UPDATE error_metrics SET count = count + ?, last_timestamp = ?, last_ts = ?
+    WHERE id = (
+        SELECT id FROM error_metrics
+        WHERE error_type = ? AND error_message IS ?
+        ORDER BY id DESC
+        LIMIT 1
+    )
+"""
+
+SQL_INSERT_SCHEDULE = """
+    INSERT INTO schedule_metrics
+    (timestamp, ts, period_seconds, result, retry_count, dispatch_delay_seconds, open_delay_seconds)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_SELECT_WATERING = """
+    SELECT * FROM watering_metrics
+    WHERE ts >= ? AND ts < ?
+    ORDER BY ts
+"""
+
+SQL_SELECT_ERROR = """
+    SELECT * FROM error_metrics
+    WHERE ts >= ? AND ts < ?
+    ORDER BY ts
+"""
+
+SQL_SELECT_ROLLUP = """
+    SELECT * FROM {table}
+    WHERE {key} BETWEEN ? AND ?
+    ORDER BY {key}
+"""
+
+# NOTE: 集計テーブルに行が無い日は、生データに対する集計と同じく total_count 以外は NULL になる
+SQL_SUMMARY_WATERING = """
+    SELECT
+        COALESCE(SUM(count), 0) as total_count,
+        SUM(manual_count) as manual_count,
+        SUM(auto_count) as auto_count,
+        SUM(duration_seconds) as total_duration_seconds,
+        CASE WHEN SUM(volume_count) > 0 THEN SUM(volume_liters) END as total_volume_liters,
+        CAST(SUM(duration_seconds) AS REAL) / SUM(count) as avg_duration_seconds,
+        SUM(volume_liters) / NULLIF(SUM(volume_count), 0) as avg_volume_liters,
+        MIN(min_duration_seconds) as min_duration_seconds,
+        MAX(max_duration_seconds) as max_duration_seconds,
+        MIN(min_volume_liters) as min_volume_liters,
+        MAX(max_volume_liters) as max_volume_liters
+    FROM daily_rollup
+    WHERE date = ?
+"""
+
+# NOTE: ダッシュボード用の集計。日毎の集計テーブルを元にするので、期間の日数分の行しか読まない
+SQL_STATISTICS_WATERING = """
+    SELECT
+        COUNT(*) as total_days,
+        COALESCE(SUM(count), 0) as total_watering_count,
+        COALESCE(SUM(manual_count), 0) as manual_watering_count,
+        COALESCE(SUM(auto_count), 0) as auto_watering_count,
+        COALESCE(SUM(duration_seconds), 0) as total_duration_seconds,
+        TOTAL(volume_liters) as total_volume_liters
+    FROM daily_rollup
+    WHERE date BETWEEN ? AND ?
+"""
+
+# NOTE: まとめて記録したエラーは、最初の発生日に count 回として数える
+SQL_STATISTICS_ERROR = """
+    SELECT COALESCE(SUM(count), 0) FROM error_daily_rollup
+    WHERE date BETWEEN ? AND ?
+"""
+
+# NOTE: パーセンタイルは Python 側で求める (スケジュール実行は 1 日数回なので、行数は少ない)
+SQL_STATISTICS_SCHEDULE = """
+    SELECT result, dispatch_delay_seconds, open_delay_seconds FROM schedule_metrics
+    WHERE ts >= ? AND ts < ?
+"""
+
+SQL_SERIES_DAILY = """
+    SELECT date as label, count, manual_count, duration_seconds, volume_liters
+    FROM daily_rollup
+    WHERE date BETWEEN ? AND ?
+    ORDER BY date
+"""
+
+# NOTE: weekly_rollup は週全体の値なので、期間の途中から始まる週も正しく扱えるように日毎の値を集計する
+SQL_SERIES_WEEKLY = f"""
+    SELECT
+        {migration.SQL_WEEK_START.format(date="date")} as label,
+        SUM(count) as count,
+        SUM(manual_count) as manual_count,
+        SUM(duration_seconds) as duration_seconds,
+        SUM(volume_liters) as volume_liters
+    FROM daily_rollup
+    WHERE date BETWEEN ? AND ?
+    GROUP BY label
+    ORDER BY label
+"""
+
+# NOTE: idx_watering_metrics_ts だけで完結するように、label は ts (UNIX 時間) とする
+SQL_SERIES_FLOW = """
+    SELECT ts as label, volume_liters / duration_seconds as rate
+    FROM watering_metrics
+    WHERE ts >= ? AND ts < ? AND duration_seconds > 0 AND volume_liters IS NOT NULL
+    ORDER BY ts
+"""
+
+# NOTE: エクスポートは id によるキーセットページネーションで少しずつ読み出す
+EXPORT_BATCH_SIZE = 1000
+
+# NOTE: エクスポートする列 (列名と型)
+EXPORT_TABLE = {
+    "watering": {
+        "table": "watering_metrics",
+        "column_list": [
+            ("id", "integer"),
+            ("timestamp", "text"),
+            ("ts", "integer"),
+            ("date", "text"),
+            ("operation_type", "text"),
+            ("duration_seconds", "integer"),
+            ("volume_liters", "real"),
+        ],
+    },
+    "error": {
+        "table": "error_metrics",
+        "column_list": [
+            ("id", "integer"),
+            ("timestamp", "text"),
+            ("ts", "integer"),
+            ("date", "text"),
+            ("error_type", "text"),
+            ("error_message", "text"),
+            ("count", "integer"),
+            ("last_timestamp", "text"),
+            ("last_ts", "integer"),
+        ],
+    },
+    "schedule": {
+        "table": "schedule_metrics",
+        "column_list": [
+            ("id", "integer"),
+            ("timestamp", "text"),
+            ("ts", "integer"),
+            ("period_seconds", "integer"),
+            ("result", "text"),
+            ("retry_count", "integer"),
+            ("dispatch_delay_seconds", "real"),
+            ("open_delay_seconds", "real"),
+        ],
+    },
+}
+
+SQL_EXPORT = """
+    SELECT {column} FROM {table}
+    WHERE id > ? AND ts >= ? AND ts < ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+# NOTE: 行の追加は最大の id で検出する。
+# 削除や再集計、エラーの回数の更新は MetricsCollector.generation で検出する
+SQL_DATA_VERSION = """
+    SELECT
+        (SELECT MAX(id) FROM watering_metrics),
+        (SELECT MAX(id) FROM error_metrics),
+        (SELECT MAX(id) FROM schedule_metrics)
+"""
+
+SQL_SUMMARY_ERROR = """
+    SELECT
+        COALESCE(SUM(count), 0) as error_count,
+        COUNT(DISTINCT error_type) as error_type_count
+    FROM error_daily_rollup
+    WHERE date = ?
+"""
+
+
+def get_percentile(value_list: list[float], quantile: float) -> float | None:
+    """最近傍順位法によるパーセンタイル (value_list が空の場合は None)"""
+    if len(value_list) == 0:
+        return None
+
+    value_list = sorted(value_list)
+    rank = max(math.ceil(quantile * len(value_list)), 1)
+
+    return value_list[rank - 1]
+
+
+def get_epoch_range(start_date: str, end_date: str) -> tuple[int, int]:
+    """開始日の 0 時から終了日の翌日の 0 時 (ローカル時刻) までを UNIX 時間の [start, end) で取得"""
+    start = datetime.date.fromisoformat(start_date)
+    end = datetime.date.fromisoformat(end_date)
+
+    if start == datetime.date.min:
+        start_ts = EPOCH_MIN
+    else:
+        start_ts = int(datetime.datetime.combine(start, datetime.time.min).timestamp())
+
+    if end == datetime.date.max:
+        end_ts = EPOCH_MAX
+    else:
+        end_ts = int(
+            datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time.min).timestamp()
+        )
+
+    return (start_ts, end_ts)
+
+
+class Connection(sqlite3.Connection):
+    """弱参照で管理できるようにした sqlite3.Connection"""
+
 
 class MetricsCollector:
     """水やりメトリクス収集クラス"""
 
-    def __init__(self, db_path: Path):
+    def __init__(self, db_path: Path, async_write: bool = True, retention_days: int | None = None):
         """コンストラクタ
 
         Args:
         ----
             db_path: SQLiteデータベースファイルパス
+            async_write: バックグラウンドのスレッドでまとめて書き込むかどうか
+            retention_days: 生データを保持する日数 (None の場合は削除しない、集計値は常に保持する)
 
         """
         self.db_path = db_path
+        self.retention_days = retention_days
+        self.maintenance_time = None
         self.lock = threading.Lock()
+        self.write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.writer = None
+        self.commit_stat_lock = threading.Lock()
+        self.commit_stat = {"count": 0, "row_count": 0, "last_sec": 0.0, "max_sec": 0.0, "total_sec": 0.0}
+        self.local = threading.local()
+        # NOTE: 行の追加以外でデータが変化したときに更新する (self.lock を取って更新する)
+        self.generation = 0
+        # NOTE: スレッドが終了すると接続は解放されるので、弱参照で管理する
+        self.conn_set_lock = threading.Lock()
+        self.conn_set = weakref.WeakSet()
+        # NOTE: 同じエラーをまとめるための、(種類, メッセージ) 毎の最初の発生時刻とまだ書き込んでいない回数
+        self.error_dedupe_lock = threading.Lock()
+        self.error_dedupe = {}
         self._init_database()
 
+        if async_write:
+            self.start_writer()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """スレッド毎の永続的な接続を取得"""
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            return conn
+
+        # NOTE: close() で他のスレッドから閉じられるように check_same_thread=False にする
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, factory=Connection)
+        # NOTE: WAL にすることで、ダッシュボードの読み出しと記録の書き込みが互いにブロックしないようにする
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+
+        self.local.conn = conn
+        with self.conn_set_lock:
+            self.conn_set.add(conn)
+
+        return conn
+
+    def close(self):
+        """全てのスレッドの接続を閉じる"""
+        with self.conn_set_lock:
+            for conn in list(self.conn_set):
+                conn.close()
+            self.conn_set = weakref.WeakSet()
+
+        self.local = threading.local()
+
     def _init_database(self):
         """データベース初期化"""
-        with sqlite3.connect(self.db_path) as conn:
-            # 水やり操作のメトリクステーブル
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS watering_metrics (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp TIMESTAMP NOT NULL,
-                    date TEXT NOT NULL,
-                    operation_type TEXT NOT NULL CHECK (operation_type IN ('manual', 'auto')),
-                    duration_seconds INTEGER NOT NULL,
-                    volume_liters REAL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # エラー発生のメトリクステーブル
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS error_metrics (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    date TEXT NOT NULL,
-                    error_type TEXT NOT NULL,
-                    error_message TEXT,
-                    timestamp TIMESTAMP NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        conn = self._get_connection()
+
+        # NOTE: 削除したデータの領域を少しずつ解放できるようにする。
+        # 既存のデータベースの設定を変更するには VACUUM が必要 (初回のみ)。
+        # データベース全体を書き直すので、大きい場合は起動に時間がかかる。
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            if page_count != 0:
+                logging.info(
+                    "Rewrite metrics database to enable incremental vacuum (%d pages), this may take a while",
+                    page_count,
                 )
-            """)
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+
+        # NOTE: スキーマは PRAGMA user_version で管理し、古いデータベースはここでアップグレードする
+        migration.migrate(conn)
+
+    def rebuild_rollup(self):
+        """日毎・週毎の集計テーブルを生データから再構築 (生データを削除済みの日の集計値はそのまま残す)"""
+        self.flush()
+
+        with self.lock:
+            with self._get_connection() as conn:
+                migration.rebuild_rollup(conn)
+                migration.rebuild_error_rollup(conn)
+            self.generation += 1
+
+        logging.info("Rebuilt metrics rollup tables")
+
+    def get_data_version(self) -> str:
+        """データが変化すると値が変わる文字列を取得 (描画結果のキャッシュのキーに使う)"""
+        # NOTE: まとめたエラーの回数の更新は行を追加しないので、先に書き込んで generation に反映させる
+        self._flush_coalesced_error()
+
+        max_id_list = self._get_connection().execute(SQL_DATA_VERSION).fetchone()
+
+        return "-".join(str(max_id) for max_id in [self.generation, *max_id_list])
+
+    def start_writer(self):
+        """書き込みスレッドを開始"""
+        if self.writer is not None:
+            return
+
+        self.writer = threading.Thread(target=self._writer_worker, name="metrics_writer", daemon=True)
+        self.writer.start()
+
+        # NOTE: term() が呼ばれずに終了する場合でも、キューに残ったデータを書き込む
+        atexit.register(self.term)
+
+    def term(self):
+        """キューに残ったデータを書き込んでから、書き込みスレッドを停止"""
+        if self.writer is None:
+            return
+
+        for item in self._pop_coalesced_error(is_all=True):
+            self.write_queue.put(item)
+        self.write_queue.put(None)
+        self.writer.join()
+        self.writer = None
+
+        atexit.unregister(self.term)
+
+    def flush(self):
+        """キューに積まれたデータ (まとめたエラーの回数を含む) が書き込まれるまで待つ"""
+        for sql, param in self._pop_coalesced_error():
+            self._write(sql, param)
+
+        if self.writer is not None:
+            self.write_queue.join()
+
+    def _flush_coalesced_error(self):
+        """まとめたエラーのまだ書き込んでいない回数があれば、書き込まれるまで待つ (集計値を読む前に使う)"""
+        item_list = self._pop_coalesced_error()
+        if len(item_list) == 0:
+            return
+
+        for sql, param in item_list:
+            self._write(sql, param)
+
+        if self.writer is not None:
+            self.write_queue.join()
+
+    def get_writer_stat(self) -> dict:
+        """書き込みキューの長さとコミットの所要時間を取得"""
+        with self.commit_stat_lock:
+            stat = dict(self.commit_stat)
+
+        return {
+            "queue_depth": self.write_queue.qsize(),
+            "commit_count": stat["count"],
+            "commit_row_count": stat["row_count"],
+            "commit_latency_last_sec": stat["last_sec"],
+            "commit_latency_max_sec": stat["max_sec"],
+            "commit_latency_avg_sec": stat["total_sec"] / stat["count"] if stat["count"] > 0 else 0.0,
+        }
+
+    def _writer_worker(self):
+        logging.info("Start metrics writer")
+
+        is_terminate = False
+        while not is_terminate:
+            try:
+                item = self.write_queue.get(timeout=MAINTENANCE_IDLE_SEC)
+            except queue.Empty:
+                self._commit_coalesced_error()
+                self._maintain_if_due()
+                continue
+
+            batch = []
+            while True:
+                if item is None:
+                    is_terminate = True
+                else:
+                    batch.append(item)
+
+                if is_terminate or (len(batch) >= WRITE_BATCH_SIZE):
+                    break
+                try:
+                    item = self.write_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            item_count = len(batch)
+            try:
+                # NOTE: 書き込みが続いて暇にならない場合でも、まとめたエラーの回数が遅れて反映されないように、
+                # 一緒に書き込む
+                batch.extend(self._pop_coalesced_error())
+                if len(batch) != 0:
+                    self._commit(batch)
+            except Exception:
+                logging.exception("Failed to write metrics")
+            finally:
+                for _ in range(item_count + (1 if is_terminate else 0)):
+                    self.write_queue.task_done()
+
+        logging.info("Terminate metrics writer")
+
+    def _commit(self, batch: list[tuple[str, tuple]]):
+        """SQL 毎にまとめて executemany し、1 回のトランザクションでコミット"""
+        start = time.perf_counter()
+
+        with self.lock:
+            with self._get_connection() as conn:
+                for sql, group in itertools.groupby(batch, key=lambda item: item[0]):
+                    conn.executemany(sql, [param for _, param in group])
+
+            # NOTE: まとめたエラーの回数の更新は最大の id を変えないので、generation で知らせる
+            if any(sql == SQL_COALESCE_ERROR for sql, _ in batch):
+                self.generation += 1
+
+        elapsed_sec = time.perf_counter() - start
+
+        with self.commit_stat_lock:
+            self.commit_stat["count"] += 1
+            self.commit_stat["row_count"] += len(batch)
+            self.commit_stat["last_sec"] = elapsed_sec
+            self.commit_stat["max_sec"] = max(self.commit_stat["max_sec"], elapsed_sec)
+            self.commit_stat["total_sec"] += elapsed_sec
 
-            # インデックスの作成
-            conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_watering_metrics_date
-                ON watering_metrics(date)
-            """)
+    def _pop_coalesced_error(self, is_all: bool = False) -> list[tuple[str, tuple]]:
+        """
+        まとめたエラーのまだ書き込んでいない回数を、書き込み用の SQL として取り出す
+
+        Args:
+        ----
+            is_all: まとめる期間が終わっていないものも含めて、全て取り出して忘れるかどうか
+
+        """
+        now = datetime.datetime.now()
+        item_list = []
+
+        with self.error_dedupe_lock:
+            for key, entry in list(self.error_dedupe.items()):
+                if entry["pending"] != 0:
+                    last_timestamp = entry["last_timestamp"]
+                    item_list.append(
+                        (
+                            SQL_COALESCE_ERROR,
+                            (entry["pending"], last_timestamp, int(last_timestamp.timestamp()), *key),
+                        )
+                    )
+                    entry["pending"] = 0
+
+                if is_all or ((now - entry["first_timestamp"]).total_seconds() >= ERROR_COALESCE_SEC):
+                    del self.error_dedupe[key]
+
+        return item_list
+
+    def _commit_coalesced_error(self):
+        try:
+            item_list = self._pop_coalesced_error()
+            if len(item_list) != 0:
+                self._commit(item_list)
+        except Exception:
+            logging.exception("Failed to write coalesced error metrics")
+
+    def _maintain_if_due(self):
+        if (self.maintenance_time is not None) and (
+            (time.monotonic() - self.maintenance_time) < MAINTENANCE_INTERVAL_SEC
+        ):
+            return
+
+        try:
+            # NOTE: 書き込みの依頼が来たら中断し、次に暇になったときに続きを行う
+            if self.maintain(is_interruptible=True):
+                self.maintenance_time = time.monotonic()
+        except Exception:
+            logging.exception("Failed to maintain metrics database")
+
+    def maintain(self, is_interruptible: bool = False) -> bool:
+        """
+        保持期間を過ぎた生データを削除し、空いた領域を解放
+
+        Args:
+        ----
+            is_interruptible: 書き込みの依頼が来たら中断するかどうか
 
-            conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_watering_metrics_type
-                ON watering_metrics(operation_type)
-            """)
+        Returns:
+        -------
+            最後まで完了したかどうか
+
+        """
+        if self.retention_days is not None:
+            cutoff_date = datetime.date.today() - datetime.timedelta(days=self.retention_days)
+            cutoff_ts = int(datetime.datetime.combine(cutoff_date, datetime.time.min).timestamp())
+
+            # NOTE: 水やりとエラーの集計値はトリガーで記録時に集計済みなので、生データを削除するだけで良い。
+            # スケジュール実行の遅延はパーセンタイルを求めるので集計値にまとめられない。
+            # 1 日数行しか増えないので、生データを削除せずに残す。
+            for table in ["watering_metrics", "error_metrics"]:
+                while True:
+                    if is_interruptible and not self.write_queue.empty():
+                        return False
+
+                    with self.lock:
+                        with self._get_connection() as conn:
+                            count = conn.execute(
+                                SQL_DELETE_EXPIRED.format(table=table), (cutoff_ts, RETENTION_BATCH_SIZE)
+                            ).rowcount
+
+                        if count == 0:
+                            break
+
+                        self.generation += 1
+
+                    logging.info("Deleted %d expired rows from %s", count, table)
 
-            conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_error_metrics_date
-                ON error_metrics(date)
-            """)
+        while True:
+            if is_interruptible and not self.write_queue.empty():
+                return False
+
+            with self.lock:
+                conn = self._get_connection()
+                if conn.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+                    break
+                # NOTE: incremental_vacuum は結果を読み出すことで 1 ページずつ処理が進む
+                conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGE_COUNT})").fetchall()
+
+        return True
+
+    def _write(self, sql: str, param: tuple):
+        """書き込みスレッドに書き込みを依頼"""
+        if self.writer is not None:
+            try:
+                self.write_queue.put((sql, param), timeout=WRITE_QUEUE_TIMEOUT_SEC)
+                return
+            except queue.Full:
+                logging.warning("Metrics write queue is full, write directly")
+
+        self._commit([(sql, param)])
 
     def _get_today_date(self) -> str:
         """今日の日付を文字列で取得"""
@@ -106,16 +663,15 @@ class MetricsCollector:
 
         date = timestamp.date().isoformat()
 
-        with self.lock:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute(
-                    """
-                    INSERT INTO watering_metrics
-                    (timestamp, date, operation_type, duration_seconds, volume_liters)
-                    VALUES (?, ?, ?, ?, ?)
-                """,
-                    (timestamp, date, operation_type, duration_seconds, volume_liters),
-                )
+        self._write(
+            SQL_INSERT_WATERING,
+            (timestamp, int(timestamp.timestamp()), date, operation_type, duration_seconds, volume_liters),
+        )
+
+        registry.WATERING.inc(type=operation_type)
+        registry.WATERING_DURATION.inc(duration_seconds, type=operation_type)
+        if volume_liters is not None:
+            registry.WATERING_VOLUME.inc(volume_liters, type=operation_type)
 
         logging.info(
             "Recorded watering metrics: type=%s, duration=%ds, volume=%s",
@@ -129,34 +685,120 @@ class MetricsCollector:
         error_type: str,
         error_message: str | None = None,
         timestamp: datetime.datetime | None = None,
-    ):
+    ) -> bool:
         """
         エラー発生を記録
 
+        最初の発生から ERROR_COALESCE_SEC 秒以内に発生した同じ種類・メッセージのエラーは、
+        新しい行を追加せずに、最初の行の発生回数 (count) と最後の発生時刻を更新します。
+        バックグラウンドのスレッドで書き込む場合、発生回数は書き込みが途絶えたときにまとめて更新します。
+
         Args:
         ----
             error_type: エラーの種類（例: "valve_control", "schedule", "sensor"）
             error_message: エラーメッセージ
             timestamp: エラー発生時刻（指定しない場合は現在時刻）
 
+        Returns:
+        -------
+            新しい行として記録したかどうか (False の場合は、直前の同じエラーにまとめた)
+
         """
         if timestamp is None:
             timestamp = datetime.datetime.now()
 
+        # NOTE: まとめて記録する場合も、発生回数は数える
+        registry.ERROR.inc(type=error_type)
+
+        key = (error_type, error_message)
+        with self.error_dedupe_lock:
+            entry = self.error_dedupe.get(key)
+            is_coalesce = (entry is not None) and (
+                0 <= (timestamp - entry["first_timestamp"]).total_seconds() < ERROR_COALESCE_SEC
+            )
+            if is_coalesce:
+                entry["pending"] += 1
+                entry["last_timestamp"] = max(entry["last_timestamp"], timestamp)
+                pending = entry["pending"]
+            else:
+                # NOTE: 前の行にまだ書き込んでいない回数が残っている場合は、先に書き込む
+                pending = 0
+                if (entry is not None) and (entry["pending"] != 0):
+                    pending = entry["pending"]
+                    last_timestamp = entry["last_timestamp"]
+                self.error_dedupe[key] = {
+                    "first_timestamp": timestamp,
+                    "last_timestamp": timestamp,
+                    "pending": 0,
+                }
+
+        if is_coalesce:
+            # NOTE: 同期的に書き込む場合は、まとめる相手の行が既にあるので、すぐに更新する
+            if self.writer is None:
+                self._commit(self._pop_coalesced_error())
+            logging.debug("Coalesced error metrics: type=%s, pending=%d", error_type, pending)
+            return False
+
+        if pending != 0:
+            self._write(SQL_COALESCE_ERROR, (pending, last_timestamp, int(last_timestamp.timestamp()), *key))
+
         date = timestamp.date().isoformat()
+        ts = int(timestamp.timestamp())
 
-        with self.lock:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute(
-                    """
-                    INSERT INTO error_metrics (date, error_type, error_message, timestamp)
-                    VALUES (?, ?, ?, ?)
-                """,
-                    (date, error_type, error_message, timestamp),
-                )
+        self._write(SQL_INSERT_ERROR, (date, error_type, error_message, timestamp, ts, timestamp, ts))
 
         logging.info("Recorded error metrics: type=%s, message=%s", error_type, error_message)
 
+        return True
+
+    def record_schedule(  # noqa: PLR0913
+        self,
+        planned_time: datetime.datetime,
+        dispatch_time: datetime.datetime,
+        open_time: datetime.datetime | None,
+        period_seconds: int,
+        result: str,
+        retry_count: int = 0,
+    ):
+        """
+        スケジュール実行の遅延を記録
+
+        Args:
+        ----
+            planned_time: スケジュールの予定時刻
+            dispatch_time: スケジューラがジョブの実行を開始した時刻
+            open_time: バルブを開いた時刻 (開かなかった場合は None)
+            period_seconds: 水やりの時間（秒）
+            result: "open" (バルブを開いた), "skip" (天気により見合わせた), "fail" (失敗した)
+            retry_count: 失敗して再試行した回数
+
+        """
+        dispatch_delay_sec = (dispatch_time - planned_time).total_seconds()
+        open_delay_sec = (open_time - planned_time).total_seconds() if open_time is not None else None
+
+        self._write(
+            SQL_INSERT_SCHEDULE,
+            (
+                planned_time,
+                int(planned_time.timestamp()),
+                period_seconds,
+                result,
+                retry_count,
+                dispatch_delay_sec,
+                open_delay_sec,
+            ),
+        )
+
+        if open_delay_sec is not None:
+            registry.SCHEDULER_OPEN_DELAY.observe(open_delay_sec)
+
+        logging.info(
+            "Recorded schedule metrics: result=%s, dispatch_delay=%.2fs, open_delay=%s",
+            result,
+            dispatch_delay_sec,
+            f"{open_delay_sec:.2f}s" if open_delay_sec is not None else "N/A",
+        )
+
     def get_watering_metrics(self, start_date: str, end_date: str) -> list:
         """
         指定期間の水やりメトリクスを取得
@@ -171,17 +813,11 @@ class MetricsCollector:
             水やりメトリクスデータのリスト
 
         """
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.execute(
-                """
-                SELECT * FROM watering_metrics
-                WHERE date BETWEEN ? AND ?
-                ORDER BY timestamp
-            """,
-                (start_date, end_date),
-            )
-            return [dict(row) for row in cursor.fetchall()]
+        cursor = self._get_connection().cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(SQL_SELECT_WATERING, get_epoch_range(start_date, end_date))
+
+        return [dict(row) for row in cursor.fetchall()]
 
     def get_error_metrics(self, start_date: str, end_date: str) -> list:
         """
@@ -197,17 +833,50 @@ class MetricsCollector:
             エラーメトリクスデータのリスト
 
         """
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.execute(
-                """
-                SELECT * FROM error_metrics
-                WHERE date BETWEEN ? AND ?
-                ORDER BY timestamp
-            """,
-                (start_date, end_date),
-            )
-            return [dict(row) for row in cursor.fetchall()]
+        cursor = self._get_connection().cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(SQL_SELECT_ERROR, get_epoch_range(start_date, end_date))
+
+        return [dict(row) for row in cursor.fetchall()]
+
+    def _get_rollup(self, rollup: dict, start_date: str, end_date: str) -> list:
+        cursor = self._get_connection().cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(SQL_SELECT_ROLLUP.format(**rollup), (start_date, end_date))
+
+        return [dict(row) for row in cursor.fetchall()]
+
+    def get_daily_rollup(self, start_date: str, end_date: str) -> list:
+        """
+        指定期間の日毎の集計値を取得
+
+        Args:
+        ----
+            start_date: 開始日（YYYY-MM-DD形式）
+            end_date: 終了日（YYYY-MM-DD形式）
+
+        Returns:
+        -------
+            日毎の集計値のリスト
+
+        """
+        return self._get_rollup(migration.ROLLUP_TABLE_LIST[0], start_date, end_date)
+
+    def get_weekly_rollup(self, start_date: str, end_date: str) -> list:
+        """
+        指定期間の週毎の集計値を取得
+
+        Args:
+        ----
+            start_date: 開始日（YYYY-MM-DD形式、週の開始日である月曜日で比較）
+            end_date: 終了日（YYYY-MM-DD形式）
+
+        Returns:
+        -------
+            週毎の集計値のリスト
+
+        """
+        return self._get_rollup(migration.ROLLUP_TABLE_LIST[1], start_date, end_date)
 
     def get_daily_summary(self, date: str) -> dict:
         """
@@ -222,44 +891,151 @@ class MetricsCollector:
             統計サマリー（水やり回数、総時間、総量など）
 
         """
-        with sqlite3.connect(self.db_path) as conn:
-            # 水やり統計
-            cursor = conn.execute(
-                """
-                SELECT 
-                    COUNT(*) as total_count,
-                    SUM(CASE WHEN operation_type = 'manual' THEN 1 ELSE 0 END) as manual_count,
-                    SUM(CASE WHEN operation_type = 'auto' THEN 1 ELSE 0 END) as auto_count,
-                    SUM(duration_seconds) as total_duration_seconds,
-                    SUM(volume_liters) as total_volume_liters,
-                    AVG(duration_seconds) as avg_duration_seconds,
-                    AVG(volume_liters) as avg_volume_liters
-                FROM watering_metrics
-                WHERE date = ?
-            """,
-                (date,),
-            )
-            watering_stats = dict(cursor.fetchone())
-
-            # エラー統計
-            cursor = conn.execute(
-                """
-                SELECT 
-                    COUNT(*) as error_count,
-                    COUNT(DISTINCT error_type) as error_type_count
-                FROM error_metrics
-                WHERE date = ?
-            """,
-                (date,),
-            )
-            error_stats = dict(cursor.fetchone())
+        self._flush_coalesced_error()
+
+        cursor = self._get_connection().cursor()
+        cursor.row_factory = sqlite3.Row
+
+        # 水やり統計
+        watering_stats = dict(cursor.execute(SQL_SUMMARY_WATERING, (date,)).fetchone())
+
+        # エラー統計
+        error_stats = dict(cursor.execute(SQL_SUMMARY_ERROR, (date,)).fetchone())
+
+        return {
+            "date": date,
+            "watering": watering_stats,
+            "errors": error_stats,
+        }
+
+    def get_statistics(self, start_date: str, end_date: str) -> dict:
+        """
+        指定期間の水やりとエラーの合計値を取得
+
+        Args:
+        ----
+            start_date: 開始日（YYYY-MM-DD形式）
+            end_date: 終了日（YYYY-MM-DD形式）
+
+        Returns:
+        -------
+            水やりした日数、回数、総時間、総量およびエラー回数
+
+        """
+        self._flush_coalesced_error()
+
+        cursor = self._get_connection().cursor()
+        cursor.row_factory = sqlite3.Row
+
+        stats = dict(cursor.execute(SQL_STATISTICS_WATERING, (start_date, end_date)).fetchone())
+        stats["error_count"] = cursor.execute(SQL_STATISTICS_ERROR, (start_date, end_date)).fetchone()[0]
+
+        return stats
+
+    def get_schedule_statistics(self, start_date: str, end_date: str) -> dict:
+        """
+        指定期間のスケジュール実行の遅延の統計を取得
+
+        Args:
+        ----
+            start_date: 開始日（YYYY-MM-DD形式）
+            end_date: 終了日（YYYY-MM-DD形式）
 
+        Returns:
+        -------
+            結果毎の回数、遅延のパーセンタイルと最大値、および目標値 (SCHEDULE_SLO_SEC) 内に
+            バルブを開いた割合 (見合わせたものは除く、対象が無い場合は None)
+
+        """
+        row_list = (
+            self._get_connection()
+            .execute(SQL_STATISTICS_SCHEDULE, get_epoch_range(start_date, end_date))
+            .fetchall()
+        )
+
+        result_list = [row[0] for row in row_list]
+        dispatch_delay_list = [row[1] for row in row_list]
+        open_delay_list = [row[2] for row in row_list if row[2] is not None]
+
+        def summarize(delay_list):
             return {
-                "date": date,
-                "watering": watering_stats,
-                "errors": error_stats,
+                **{
+                    f"p{int(quantile * 100)}_sec": get_percentile(delay_list, quantile)
+                    for quantile in SCHEDULE_QUANTILE_LIST
+                },
+                "max_sec": max(delay_list, default=None),
             }
 
+        # NOTE: 失敗したものは目標を達成できなかったものとして数える
+        target_count = result_list.count("open") + result_list.count("fail")
+        slo_met_count = sum(1 for delay in open_delay_list if delay <= SCHEDULE_SLO_SEC)
+
+        return {
+            "count": len(row_list),
+            "open_count": result_list.count("open"),
+            "skip_count": result_list.count("skip"),
+            "fail_count": result_list.count("fail"),
+            "dispatch_delay": summarize(dispatch_delay_list),
+            "open_delay": summarize(open_delay_list),
+            "slo_sec": SCHEDULE_SLO_SEC,
+            "slo_met_ratio": slo_met_count / target_count if target_count > 0 else None,
+        }
+
+    def _get_series(self, sql: str, param: tuple) -> dict:
+        """クエリ結果を列毎のリストにして返す"""
+        cursor = self._get_connection().execute(sql, param)
+        name_list = [desc[0] for desc in cursor.description]
+        column_list = list(zip(*cursor.fetchall(), strict=True)) or [()] * len(name_list)
+
+        return {name: list(column) for name, column in zip(name_list, column_list, strict=True)}
+
+    def get_daily_series(self, start_date: str, end_date: str) -> dict:
+        """指定期間の日毎の集計値を列毎のリスト (label, count, manual_count, ...) で取得"""
+        return self._get_series(SQL_SERIES_DAILY, (start_date, end_date))
+
+    def get_weekly_series(self, start_date: str, end_date: str) -> dict:
+        """指定期間の週毎の集計値を列毎のリスト (label は週の開始日) で取得"""
+        return self._get_series(SQL_SERIES_WEEKLY, (start_date, end_date))
+
+    def get_flow_series(self, start_date: str, end_date: str) -> dict:
+        """指定期間の水やり毎の流量 [L/秒] を列毎のリスト (label は UNIX 時間, rate) で取得"""
+        return self._get_series(SQL_SERIES_FLOW, get_epoch_range(start_date, end_date))
+
+    def iter_export(self, name: str, start_date: str, end_date: str, batch_size: int = EXPORT_BATCH_SIZE):
+        """
+        指定期間のメトリクスを id 順に少しずつ読み出す
+
+        Args:
+        ----
+            name: EXPORT_TABLE のキー ("watering" または "error")
+            start_date: 開始日（YYYY-MM-DD形式）
+            end_date: 終了日（YYYY-MM-DD形式）
+            batch_size: 1 回に読み出す行数
+
+        Yields:
+        ------
+            行 (EXPORT_TABLE の列順のタプル) のリスト
+
+        """
+        export_table = EXPORT_TABLE[name]
+        sql = SQL_EXPORT.format(
+            table=export_table["table"],
+            column=", ".join(column for column, _ in export_table["column_list"]),
+        )
+
+        # NOTE: 呼び出し側が読み出しの合間に処理をしても読み取りトランザクションを保持し続けないように、
+        # 毎回 fetchall() で読み切る
+        start_ts, end_ts = get_epoch_range(start_date, end_date)
+        last_id = 0
+        while True:
+            row_list = self._get_connection().execute(sql, (last_id, start_ts, end_ts, batch_size)).fetchall()
+            if len(row_list) == 0:
+                return
+
+            yield row_list
+
+            last_id = row_list[-1][0]
+
     def get_recent_watering_metrics(self, days: int = 30) -> list:
         """
         最近N日間の水やりメトリクスを取得
@@ -301,18 +1077,37 @@ class MetricsCollector:
 _collector_instance: MetricsCollector | None = None
 
 
-def get_collector(metrics_data_path) -> MetricsCollector:
+def init(config):
+    """設定ファイルの内容 (保持期間など) に従って、メトリクス収集インスタンスを作成"""
+    get_collector(config["metrics"]["data"], config["metrics"].get("retention_days"))
+
+
+def get_collector(metrics_data_path, retention_days: int | None = None) -> MetricsCollector:
     """メトリクス収集インスタンスを取得"""
     global _collector_instance
 
     if _collector_instance is None:
         db_path = Path(metrics_data_path)
-        _collector_instance = MetricsCollector(db_path)
+        _collector_instance = MetricsCollector(db_path, retention_days=retention_days)
         logging.info("Metrics collector initialized: %s", db_path)
 
     return _collector_instance
 
 
+def term():
+    """キューに残ったデータを書き込んでから終了"""
+    global _collector_instance
+
+    if _collector_instance is None:
+        return
+
+    _collector_instance.term()
+    _collector_instance.close()
+    _collector_instance = None
+
+    logging.info("Metrics collector terminated")
+
+
 def record_watering(
     operation_type: str,
     duration_seconds: int,
@@ -331,6 +1126,53 @@ def record_error(
     metrics_data_path,
     error_message: str | None = None,
     timestamp: datetime.datetime | None = None,
+) -> bool:
+    """エラー発生を記録（便利関数、直前の同じエラーにまとめた場合は False を返す）"""
+    return get_collector(metrics_data_path).record_error(error_type, error_message, timestamp)
+
+
+def record_schedule(  # noqa: PLR0913
+    planned_time: datetime.datetime,
+    dispatch_time: datetime.datetime,
+    open_time: datetime.datetime | None,
+    period_seconds: int,
+    result: str,
+    metrics_data_path,
+    retry_count: int = 0,
 ):
-    """エラー発生を記録（便利関数）"""
-    get_collector(metrics_data_path).record_error(error_type, error_message, timestamp)
\ No newline at end of file
+    """スケジュール実行の遅延を記録（便利関数）"""
+    get_collector(metrics_data_path).record_schedule(
+        planned_time, dispatch_time, open_time, period_seconds, result, retry_count
+    )
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.config
+    import my_lib.logger
+    import my_lib.pretty
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    rebuild = args["-R"]
+    maintain = args["-M"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    config = my_lib.config.load(config_file)
+
+    collector = MetricsCollector(
+        Path(config["metrics"]["data"]),
+        async_write=False,
+        retention_days=config["metrics"].get("retention_days"),
+    )
+
+    if rebuild:
+        collector.rebuild_rollup()
+    if maintain:
+        collector.maintain()
+
+    logging.info(my_lib.pretty.format(collector.get_daily_summary(datetime.date.today().isoformat())))
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+水やりメトリクスのデータベースのスキーマを管理します。
+
+スキーマのバージョンは PRAGMA user_version に記録し、古いデータベースは
+MIGRATION_LIST の順に、その場でアップグレードします。
+大量の行を書き換えるマイグレーションは、少しずつコミットしながら行います。
+
+Usage:
+  migration.py [-c CONFIG] [-D]
+
+Options:
+  -c CONFIG         : CONFIG を設定ファイルとして読み込んで実行します。[default: config.yaml]
+  -D                : デバッグモードで動作します。
+"""
+
+from __future__ import annotations
+
+import logging
+import sqlite3
+
+# NOTE: 1 回のトランザクションで書き換える最大件数
+MIGRATE_BATCH_SIZE = 10000
+
+# NOTE: 週の始まりは月曜日 (ISO 8601) とする
+SQL_WEEK_START = "date({date}, '-6 days', 'weekday 1')"
+
+# NOTE: 集計テーブル (daily_rollup, weekly_rollup) は同じ列を持つ
+SQL_CREATE_ROLLUP = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        {key} TEXT PRIMARY KEY,
+        count INTEGER NOT NULL,
+        manual_count INTEGER NOT NULL,
+        auto_count INTEGER NOT NULL,
+        duration_seconds INTEGER NOT NULL,
+        volume_liters REAL NOT NULL,
+        volume_count INTEGER NOT NULL,
+        min_duration_seconds INTEGER,
+        max_duration_seconds INTEGER,
+        min_volume_liters REAL,
+        max_volume_liters REAL
+    )
+"""
+
+# NOTE: 水やりが 1 件記録される毎に、その行の値を集計テーブルに足し込む。
+# 引数が 1 つでも NULL だと MIN() / MAX() は NULL を返すので、COALESCE で補う。
+SQL_CREATE_ROLLUP_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS {table}_insert
+    AFTER INSERT ON watering_metrics
+    BEGIN
+        INSERT INTO {table} VALUES (
+            {key_value}, 1, NEW.operation_type = 'manual', NEW.operation_type = 'auto',
+            NEW.duration_seconds, COALESCE(NEW.volume_liters, 0), NEW.volume_liters IS NOT NULL,
+            NEW.duration_seconds, NEW.duration_seconds, NEW.volume_liters, NEW.volume_liters
+        )
+        ON CONFLICT({key}) DO UPDATE SET
+            count = count + 1,
+            manual_count = manual_count + excluded.manual_count,
+            auto_count = auto_count + excluded.auto_count,
+            duration_seconds = duration_seconds + excluded.duration_seconds,
+            volume_liters = volume_liters + excluded.volume_liters,
+            volume_count = volume_count + excluded.volume_count,
+            min_duration_seconds = MIN(min_duration_seconds, excluded.min_duration_seconds),
+            max_duration_seconds = MAX(max_duration_seconds, excluded.max_duration_seconds),
+            min_volume_liters = COALESCE(
+                MIN(min_volume_liters, excluded.min_volume_liters),
+                min_volume_liters,
+                excluded.min_volume_liters
+            ),
+            max_volume_liters = COALESCE(
+                MAX(max_volume_liters, excluded.max_volume_liters),
+                max_volume_liters,
+                excluded.max_volume_liters
+            );
+    END
+"""
+
+# NOTE: 保持期間を過ぎて生データを削除した日の集計値は残すため、生データがある日だけ集計し直す
+SQL_REBUILD_DAILY_ROLLUP = """
+    INSERT INTO daily_rollup
+    SELECT
+        date,
+        COUNT(*),
+        SUM(operation_type = 'manual'),
+        SUM(operation_type = 'auto'),
+        SUM(duration_seconds),
+        TOTAL(volume_liters),
+        COUNT(volume_liters),
+        MIN(duration_seconds),
+        MAX(duration_seconds),
+        MIN(volume_liters),
+        MAX(volume_liters)
+    FROM watering_metrics
+    GROUP BY date
+"""
+
+SQL_DELETE_DAILY_ROLLUP = """
+    DELETE FROM daily_rollup
+    WHERE date >= (SELECT MIN(date) FROM watering_metrics)
+"""
+
+# NOTE: 週毎の集計値は、日毎の集計値から作る
+SQL_REBUILD_WEEKLY_ROLLUP = f"""
+    INSERT INTO weekly_rollup
+    SELECT
+        {SQL_WEEK_START.format(date="date")} AS week_start,
+        SUM(count),
+        SUM(manual_count),
+        SUM(auto_count),
+        SUM(duration_seconds),
+        SUM(volume_liters),
+        SUM(volume_count),
+        MIN(min_duration_seconds),
+        MAX(max_duration_seconds),
+        MIN(min_volume_liters),
+        MAX(max_volume_liters)
+    FROM daily_rollup
+    GROUP BY week_start
+"""
+
+ROLLUP_TABLE_LIST = [
+    {"table": "daily_rollup", "key": "date", "key_value": "{date}"},
+    {"table": "weekly_rollup", "key": "week_start", "key_value": SQL_WEEK_START},
+]
+
+# NOTE: エラーは日毎・種類毎の回数を集計する。まとめて記録したエラーは、最初の発生日に count 回として数える
+SQL_CREATE_ERROR_ROLLUP = """
+    CREATE TABLE IF NOT EXISTS error_daily_rollup (
+        date TEXT NOT NULL,
+        error_type TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (date, error_type)
+    )
+"""
+
+SQL_CREATE_ERROR_ROLLUP_TRIGGER_LIST = [
+    """
+    CREATE TRIGGER IF NOT EXISTS error_daily_rollup_insert
+    AFTER INSERT ON error_metrics
+    BEGIN
+        INSERT INTO error_daily_rollup VALUES (NEW.date, NEW.error_type, NEW.count)
+        ON CONFLICT(date, error_type) DO UPDATE SET count = count + excluded.count;
+    END
+    """,
+    # NOTE: 同じエラーをまとめて記録した場合は、増えた回数だけを足し込む
+    """
+    CREATE TRIGGER IF NOT EXISTS error_daily_rollup_update
+    AFTER UPDATE OF count ON error_metrics
+    BEGIN
+        UPDATE error_daily_rollup SET count = count + NEW.count - OLD.count
+        WHERE date = NEW.date AND error_type = NEW.error_type;
+    END
+    """,
+]
+
+ERROR_ROLLUP_TRIGGER_LIST = ["error_daily_rollup_insert", "error_daily_rollup_update"]
+
+SQL_DELETE_ERROR_ROLLUP = """
+    DELETE FROM error_daily_rollup
+    WHERE date >= (SELECT MIN(date) FROM error_metrics)
+"""
+
+SQL_REBUILD_ERROR_ROLLUP = """
+    INSERT INTO error_daily_rollup
+    SELECT date, error_type, SUM(count)
+    FROM error_metrics
+    GROUP BY date, error_type
+"""
+
+# NOTE: 埋める対象の行を id の順に最大 MIGRATE_BATCH_SIZE 件選び、その最後の id を返す。
+# 変換できずに NULL のまま残る行があっても先に進めるように、id をカーソルにする
+SQL_BACKFILL_CURSOR = """
+    SELECT MAX(id) FROM (
+        SELECT id FROM {table} WHERE {column} IS NULL AND id > ? ORDER BY id LIMIT ?
+    )
+"""
+
+# NOTE: timestamp 列はローカル時刻の文字列なので、'utc' を指定して UNIX 時間に変換する
+SQL_BACKFILL_TS = """
+    UPDATE {table} SET ts = CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+    WHERE ts IS NULL AND id > ? AND id <= ?
+"""
+
+# NOTE: 既存の行は 1 回だけ発生したエラーとして扱う
+SQL_BACKFILL_LAST_TS = """
+    UPDATE error_metrics SET last_timestamp = timestamp, last_ts = ts
+    WHERE last_ts IS NULL AND id > ? AND id <= ?
+"""
+
+
+def format_rollup_sql(sql: str, rollup: dict, date: str) -> str:
+    """集計テーブル用の SQL を組み立てる (date は日付を表す SQL の式)"""
+    return sql.format(
+        table=rollup["table"], key=rollup["key"], key_value=rollup["key_value"].format(date=date)
+    )
+
+
+def rebuild_rollup(conn: sqlite3.Connection):
+    """日毎・週毎の集計テーブルを生データから再構築 (生データを削除済みの日の集計値はそのまま残す)"""
+    conn.execute(SQL_DELETE_DAILY_ROLLUP)
+    conn.execute(SQL_REBUILD_DAILY_ROLLUP)
+    conn.execute("DELETE FROM weekly_rollup")
+    conn.execute(SQL_REBUILD_WEEKLY_ROLLUP)
+
+
+def rebuild_error_rollup(conn: sqlite3.Connection):
+    """エラーの日毎の集計テーブルを生データから再構築 (生データを削除済みの日の集計値はそのまま残す)"""
+    conn.execute(SQL_DELETE_ERROR_ROLLUP)
+    conn.execute(SQL_REBUILD_ERROR_ROLLUP)
+
+
+def get_column_list(conn: sqlite3.Connection, table: str) -> list[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def backfill(conn: sqlite3.Connection, sql: str, table: str, column: str):
+    """
+    指定した列が NULL の行を sql で埋める
+
+    途中で中断しても続きから再開できるように、少しずつコミットする。
+    埋められずに NULL のまま残った行は、警告を出してそのままにする。
+
+    Args:
+    ----
+        conn: データベースの接続
+        sql: 埋める SQL (id の範囲を表す 2 つのパラメータを取る)
+        table: 対象のテーブル
+        column: 埋める列
+
+    """
+    last_id = 0
+    while True:
+        end_id = conn.execute(
+            SQL_BACKFILL_CURSOR.format(table=table, column=column), (last_id, MIGRATE_BATCH_SIZE)
+        ).fetchone()[0]
+        if end_id is None:
+            break
+
+        with conn:
+            count = conn.execute(sql.format(table=table), (last_id, end_id)).rowcount
+        logging.info("Backfilled %s of %d rows in %s", column, count, table)
+
+        last_id = end_id
+
+    null_count = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {column} IS NULL").fetchone()[0]  # noqa: S608
+    if null_count != 0:
+        logging.warning("Failed to backfill %s of %d rows in %s", column, null_count, table)
+
+
+def migrate_v1(conn: sqlite3.Connection):
+    """メトリクスのテーブルと日毎・週毎の集計テーブルを作成"""
+    with conn:
+        # 水やり操作のメトリクステーブル
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS watering_metrics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TIMESTAMP NOT NULL,
+                date TEXT NOT NULL,
+                operation_type TEXT NOT NULL CHECK (operation_type IN ('manual', 'auto')),
+                duration_seconds INTEGER NOT NULL,
+                volume_liters REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # エラー発生のメトリクステーブル
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS error_metrics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT NOT NULL,
+                error_type TEXT NOT NULL,
+                error_message TEXT,
+                timestamp TIMESTAMP NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # インデックスの作成
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_watering_metrics_date
+            ON watering_metrics(date)
+        """)
+
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_watering_metrics_type
+            ON watering_metrics(operation_type)
+        """)
+
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_error_metrics_date
+            ON error_metrics(date)
+        """)
+
+        # 日毎・週毎の集計テーブル
+        is_rollup_exist = (
+            conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'daily_rollup'").fetchone() is not None
+        )
+        for rollup in ROLLUP_TABLE_LIST:
+            conn.execute(SQL_CREATE_ROLLUP.format(**rollup))
+            conn.execute(format_rollup_sql(SQL_CREATE_ROLLUP_TRIGGER, rollup, "NEW.date"))
+
+        # NOTE: 集計テーブルを導入する前のデータがある場合は、ここで集計しておく
+        if not is_rollup_exist:
+            rebuild_rollup(conn)
+
+
+def migrate_v2(conn: sqlite3.Connection):
+    """UNIX 時間の列 (ts) を追加し、期間と種類で検索するためのカバリングインデックスを作成"""
+    for table in ["watering_metrics", "error_metrics"]:
+        if "ts" not in get_column_list(conn, table):
+            with conn:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN ts INTEGER")
+
+        backfill(conn, SQL_BACKFILL_TS, table, "ts")
+
+    with conn:
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_watering_metrics_ts
+            ON watering_metrics(ts, operation_type, duration_seconds, volume_liters)
+        """)
+
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_watering_metrics_type_ts
+            ON watering_metrics(operation_type, ts)
+        """)
+
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_error_metrics_ts
+            ON error_metrics(ts, error_type)
+        """)
+
+        # NOTE: 上記のインデックスで置き換えられるので削除する。
+        # date のインデックスは、集計テーブルの再構築 (MIN(date) と GROUP BY date) で使うので残す
+        conn.execute("DROP INDEX IF EXISTS idx_watering_metrics_type")
+
+
+def migrate_v3(conn: sqlite3.Connection):
+    """同じエラーをまとめて記録するため、エラーの発生回数 (count) と最後の発生時刻を追加"""
+    column_list = get_column_list(conn, "error_metrics")
+    with conn:
+        if "count" not in column_list:
+            conn.execute("ALTER TABLE error_metrics ADD COLUMN count INTEGER NOT NULL DEFAULT 1")
+        if "last_timestamp" not in column_list:
+            conn.execute("ALTER TABLE error_metrics ADD COLUMN last_timestamp TIMESTAMP")
+        if "last_ts" not in column_list:
+            conn.execute("ALTER TABLE error_metrics ADD COLUMN last_ts INTEGER")
+
+    backfill(conn, SQL_BACKFILL_LAST_TS, "error_metrics", "last_ts")
+
+
+def migrate_v4(conn: sqlite3.Connection):
+    """スケジュール実行の遅延 (予定時刻から、実行の開始およびバルブを開くまで) を記録するテーブルを追加"""
+    with conn:
+        # NOTE: ts は予定時刻 (UNIX 時間の整数、期間の検索と保持期間の判定に使う)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schedule_metrics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TIMESTAMP NOT NULL,
+                ts INTEGER NOT NULL,
+                period_seconds INTEGER NOT NULL,
+                result TEXT NOT NULL CHECK (result IN ('open', 'skip', 'fail')),
+                retry_count INTEGER NOT NULL,
+                dispatch_delay_seconds REAL NOT NULL,
+                open_delay_seconds REAL
+            )
+        """)
+
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_schedule_metrics_ts
+            ON schedule_metrics(ts, result, dispatch_delay_seconds, open_delay_seconds)
+        """)
+
+
+def migrate_v5(conn: sqlite3.Connection):
+    """保持期間を過ぎて生データを削除してもエラーの回数が分かるように、エラーの日毎の集計テーブルを追加"""
+    with conn:
+        is_rollup_exist = (
+            conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'error_daily_rollup'").fetchone()
+            is not None
+        )
+        conn.execute(SQL_CREATE_ERROR_ROLLUP)
+        for sql in SQL_CREATE_ERROR_ROLLUP_TRIGGER_LIST:
+            conn.execute(sql)
+
+        if not is_rollup_exist:
+            rebuild_error_rollup(conn)
+
+
+# NOTE: i 番目の関数を実行すると、スキーマのバージョンが i + 1 になる
+MIGRATION_LIST = [migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5]
+
+SCHEMA_VERSION = len(MIGRATION_LIST)
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection):
+    """スキーマを最新のバージョンにアップグレード"""
+    version = get_version(conn)
+
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Unsupported metrics schema version: {version} > {SCHEMA_VERSION}")  # noqa: TRY003, EM102
+
+    for i in range(version, SCHEMA_VERSION):
+        logging.info("Migrate metrics database: version %d -> %d", i, i + 1)
+
+        MIGRATION_LIST[i](conn)
+        conn.execute(f"PRAGMA user_version={i + 1}")
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.config
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    config_file = args["-c"]
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    config = my_lib.config.load(config_file)
+
+    conn = sqlite3.connect(config["metrics"]["data"])
+    migrate(conn)
+
+    logging.info("Schema version: %d", get_version(conn))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+全てのスレッドのスタックを一定間隔でサンプリングし、flamegraph 用の collapsed stack 形式で出力します。
+
+sys._current_frames() でスタックを読むだけなので、対象のスレッドの処理は止めません。
+スタックの先頭にはスレッド名を付けます (HTTP リクエストを処理するスレッドは 1 つにまとめます)。
+
+Usage:
+  profiler.py [-s SEC] [-i MSEC] [-D]
+
+Options:
+  -s SEC            : サンプリングする時間 [秒] を指定します。[default: 5]
+  -i MSEC           : サンプリングの間隔 [ミリ秒] を指定します。[default: 10]
+  -D                : デバッグモードで動作します。
+"""
+
+from __future__ import annotations
+
+import collections
+import math
+import pathlib
+import re
+import sys
+import threading
+import time
+
+# NOTE: 本番環境で誤って長時間動かさないように、時間と間隔を制限する
+MAX_DURATION_SEC = 60
+MIN_INTERVAL_SEC = 0.001
+
+# NOTE: スタックが深すぎる場合は、根元側を省略する
+MAX_DEPTH = 64
+
+# NOTE: ThreadingMixIn などで作られる "Thread-12 (process_request_thread)" を 1 つにまとめる
+THREAD_NAME_PATTERN = re.compile(r"^Thread-\d+ \((.+)\)$")
+
+# NOTE: 同時に複数のサンプリングを行わない
+sample_lock = threading.Lock()
+
+
+class BusyError(Exception):
+    """既に他のサンプリングを実行中"""
+
+
+def get_thread_label(thread: threading.Thread | None, thread_id: int) -> str:
+    if thread is None:
+        return f"thread-{thread_id}"
+
+    match = THREAD_NAME_PATTERN.match(thread.name)
+    name = match.group(1) if match is not None else thread.name
+
+    # NOTE: collapsed stack 形式では ; が区切り文字になる
+    return name.replace(";", ":")
+
+
+def format_frame(frame) -> str:
+    code = frame.f_code
+    path = pathlib.Path(code.co_filename)
+
+    return f"{code.co_name} ({path.parent.name}/{path.name}:{frame.f_lineno})".replace(";", ":")
+
+
+def collapse_stack(frame) -> str:
+    frame_list = []
+    while (frame is not None) and (len(frame_list) < MAX_DEPTH):
+        frame_list.append(format_frame(frame))
+        frame = frame.f_back
+
+    return ";".join(reversed(frame_list))
+
+
+def sample(duration_sec: float, interval_sec: float) -> dict:
+    """
+    全てのスレッドのスタックをサンプリング
+
+    Args:
+    ----
+        duration_sec: サンプリングする時間 [秒] (MAX_DURATION_SEC まで)
+        interval_sec: サンプリングの間隔 [秒] (MIN_INTERVAL_SEC 以上)
+
+    Returns:
+    -------
+        collapsed stack (スレッド名;呼び出し元;...;呼び出し先) 毎のサンプル数と、サンプリングの回数
+
+    Raises:
+    ------
+        ValueError: 時間か間隔が正の有限の値でない場合
+        BusyError: 既に他のサンプリングを実行中の場合
+
+    """
+    # NOTE: NaN は大小の比較で制限をすり抜けるので、先に弾く
+    if not (math.isfinite(duration_sec) and math.isfinite(interval_sec)):
+        raise ValueError("duration_sec and interval_sec must be finite")  # noqa: TRY003, EM101
+    if (duration_sec <= 0) or (interval_sec <= 0):
+        raise ValueError("duration_sec and interval_sec must be positive")  # noqa: TRY003, EM101
+
+    duration_sec = min(duration_sec, MAX_DURATION_SEC)
+    interval_sec = max(interval_sec, MIN_INTERVAL_SEC)
+
+    if not sample_lock.acquire(blocking=False):
+        raise BusyError
+
+    try:
+        stack_count = collections.Counter()
+        sample_count = 0
+        self_id = threading.get_ident()
+
+        end_time = time.monotonic() + duration_sec
+        next_time = time.monotonic()
+        while True:
+            thread_map = {thread.ident: thread for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():  # noqa: SLF001
+                # NOTE: サンプリングしているスレッド自身は除く
+                if thread_id == self_id:
+                    continue
+
+                label = get_thread_label(thread_map.get(thread_id), thread_id)
+                stack_count[f"{label};{collapse_stack(frame)}"] += 1
+            sample_count += 1
+
+            next_time += interval_sec
+            now = time.monotonic()
+            if next_time >= end_time:
+                break
+            # NOTE: サンプリングに時間がかかって遅れた場合は、間隔を詰めずに次の時刻から再開する
+            if next_time > now:
+                time.sleep(next_time - now)
+            else:
+                next_time = now
+    finally:
+        sample_lock.release()
+
+    return {"stack": stack_count, "sample_count": sample_count}
+
+
+def format_collapsed(stack_count: dict) -> str:
+    """flamegraph.pl や speedscope で読める形式 (1 行毎に "スタック サンプル数") で出力"""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stack_count.items()))
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import logging
+
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    duration_sec = float(args["-s"])
+    interval_sec = float(args["-i"]) / 1000
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    def busy_worker():
+        end_time = time.monotonic() + duration_sec
+        while time.monotonic() < end_time:
+            sum(range(1000))
+
+    threading.Thread(target=busy_worker, name="busy_worker").start()
+
+    result = sample(duration_sec, interval_sec)
+    logging.info("Sampled %d times", result["sample_count"])
+
+    sys.stdout.write(format_collapsed(result["stack"]))
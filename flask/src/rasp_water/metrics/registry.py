@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+プロセス内のメトリクス (カウンタ・ゲージ・ヒストグラム) を保持し、OpenMetrics 形式で出力します。
+
+値はメモリ上にだけ保持するので、記録も出力もディスクにはアクセスしません。
+プロセスが再起動すると値は 0 に戻ります (Prometheus 側でリセットとして扱われます)。
+
+Usage:
+  registry.py [-D]
+
+Options:
+  -D                : デバッグモードで動作します。
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+import time
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+NAME_PREFIX = "rasp_water_"
+
+# NOTE: Prometheus のクライアントライブラリのデフォルトと同じ
+DEFAULT_BUCKET_LIST = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+def escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_label(label_name_list: list[str], label_value_list: tuple, extra: str | None = None) -> str:
+    item_list = [
+        f'{name}="{escape_label_value(value)}"'
+        for name, value in zip(label_name_list, label_value_list, strict=True)
+    ]
+    if extra is not None:
+        item_list.append(extra)
+
+    return "{" + ",".join(item_list) + "}" if len(item_list) != 0 else ""
+
+
+class Metric:
+    """メトリクスの基底クラス (ラベルの値の組毎に値を保持する)"""
+
+    TYPE = None
+
+    def __init__(self, name: str, help_text: str, label_name_list: list[str] | None = None, unit: str = ""):
+        """コンストラクタ
+
+        Args:
+        ----
+            name: メトリクス名 (NAME_PREFIX は付けない)
+            help_text: 説明
+            label_name_list: ラベル名のリスト
+            unit: 単位 (OpenMetrics の UNIT、名前の末尾と一致させる)
+
+        """
+        self.name = NAME_PREFIX + name
+        self.help_text = help_text
+        self.label_name_list = label_name_list or []
+        self.unit = unit
+        self.lock = threading.Lock()
+        self.value_map = {}
+
+    def _get_key(self, label_map: dict) -> tuple:
+        if set(label_map) != set(self.label_name_list):
+            raise ValueError(f"Label of {self.name} should be {self.label_name_list}: {list(label_map)}")  # noqa: TRY003, EM102
+
+        return tuple(str(label_map[name]) for name in self.label_name_list)
+
+    def render(self) -> list[str]:
+        line_list = [f"# TYPE {self.name} {self.TYPE}"]
+        if self.unit != "":
+            line_list.append(f"# UNIT {self.name} {self.unit}")
+        line_list.append(f"# HELP {self.name} {escape_label_value(self.help_text)}")
+
+        for key, value in sorted(self._snapshot().items()):
+            line_list.extend(self._render_sample(key, value))
+
+        return line_list
+
+    def _snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.value_map)
+
+    def _render_sample(self, key: tuple, value) -> list[str]:
+        return [f"{self.name}{format_label(self.label_name_list, key)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    """単調増加する値"""
+
+    TYPE = "counter"
+
+    def inc(self, value: float = 1, **label_map):
+        if value < 0:
+            raise ValueError(f"Counter {self.name} can only increase: {value}")  # noqa: TRY003, EM102
+
+        key = self._get_key(label_map)
+        with self.lock:
+            self.value_map[key] = self.value_map.get(key, 0) + value
+
+    def get(self, **label_map) -> float:
+        with self.lock:
+            return self.value_map.get(self._get_key(label_map), 0)
+
+    def _render_sample(self, key: tuple, value) -> list[str]:
+        return [f"{self.name}_total{format_label(self.label_name_list, key)} {format_value(value)}"]
+
+
+class Gauge(Metric):
+    """増減する現在の値"""
+
+    TYPE = "gauge"
+
+    def set(self, value: float, **label_map):
+        key = self._get_key(label_map)
+        with self.lock:
+            self.value_map[key] = value
+
+    def inc(self, value: float = 1, **label_map):
+        key = self._get_key(label_map)
+        with self.lock:
+            self.value_map[key] = self.value_map.get(key, 0) + value
+
+    def get(self, **label_map) -> float:
+        with self.lock:
+            return self.value_map.get(self._get_key(label_map), 0)
+
+
+class Histogram(Metric):
+    """値の分布 (バケット毎の累積件数と合計)"""
+
+    TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_name_list: list[str] | None = None,
+        unit: str = "",
+        bucket_list: list[float] | None = None,
+    ):
+        super().__init__(name, help_text, label_name_list, unit)
+        self.bucket_list = sorted(bucket_list or DEFAULT_BUCKET_LIST)
+
+    def observe(self, value: float, **label_map):
+        key = self._get_key(label_map)
+        with self.lock:
+            stat = self.value_map.get(key)
+            if stat is None:
+                # NOTE: バケット毎の件数 (累積ではない、最後は +Inf), 件数, 合計
+                stat = {"bucket": [0] * (len(self.bucket_list) + 1), "count": 0, "sum": 0.0}
+                self.value_map[key] = stat
+
+            for i, bound in enumerate(self.bucket_list):
+                if value <= bound:
+                    stat["bucket"][i] += 1
+                    break
+            else:
+                stat["bucket"][-1] += 1
+            stat["count"] += 1
+            stat["sum"] += value
+
+    def time(self, **label_map):
+        """with 文のブロックの所要時間 [秒] を記録"""
+        return HistogramTimer(self, label_map)
+
+    def get(self, **label_map) -> dict:
+        """件数と合計を取得"""
+        with self.lock:
+            stat = self.value_map.get(self._get_key(label_map))
+            if stat is None:
+                return {"count": 0, "sum": 0.0}
+            return {"count": stat["count"], "sum": stat["sum"]}
+
+    def get_label_list(self) -> list[dict]:
+        """記録されたラベルの値の組の一覧を取得"""
+        with self.lock:
+            key_list = sorted(self.value_map)
+
+        return [dict(zip(self.label_name_list, key, strict=True)) for key in key_list]
+
+    def get_quantile(self, quantile: float, **label_map) -> float | None:
+        """分位数を、その値を含むバケットの上限で推定 (記録が無い場合は None)"""
+        with self.lock:
+            stat = self.value_map.get(self._get_key(label_map))
+            if (stat is None) or (stat["count"] == 0):
+                return None
+            bucket = list(stat["bucket"])
+            count = stat["count"]
+
+        cumulative = 0
+        for bound, bucket_count in zip([*self.bucket_list, math.inf], bucket, strict=True):
+            cumulative += bucket_count
+            if cumulative >= quantile * count:
+                return bound
+
+        return math.inf
+
+    def _snapshot(self) -> dict:
+        # NOTE: 出力中に値が更新されても件数と合計が食い違わないように、コピーしてから出力する
+        with self.lock:
+            return {
+                key: {"bucket": list(stat["bucket"]), "count": stat["count"], "sum": stat["sum"]}
+                for key, stat in self.value_map.items()
+            }
+
+    def _render_sample(self, key: tuple, stat: dict) -> list[str]:
+        line_list = []
+        cumulative = 0
+        for bound, count in zip([*self.bucket_list, math.inf], stat["bucket"], strict=True):
+            cumulative += count
+            # NOTE: OpenMetrics では le は浮動小数点数の正規形 (1.0, +Inf など) で書く
+            le = "+Inf" if math.isinf(bound) else repr(float(bound))
+            label = format_label(self.label_name_list, key, f'le="{le}"')
+            line_list.append(f"{self.name}_bucket{label} {cumulative}")
+
+        label = format_label(self.label_name_list, key)
+        line_list.append(f"{self.name}_count{label} {stat['count']}")
+        line_list.append(f"{self.name}_sum{label} {format_value(stat['sum'])}")
+
+        return line_list
+
+
+class HistogramTimer:
+    def __init__(self, histogram: Histogram, label_map: dict):
+        self.histogram = histogram
+        self.label_map = label_map
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, **self.label_map)
+
+
+class Registry:
+    """メトリクスの一覧"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metric_list = []
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            if any(registered.name == metric.name for registered in self.metric_list):
+                raise ValueError(f"Metric {metric.name} is already registered")  # noqa: TRY003, EM102
+            self.metric_list.append(metric)
+
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        """OpenMetrics のテキスト形式で出力"""
+        with self.lock:
+            metric_list = list(self.metric_list)
+
+        line_list = []
+        for metric in metric_list:
+            line_list.extend(metric.render())
+        line_list.append("# EOF")
+
+        return "\n".join(line_list) + "\n"
+
+
+REGISTRY = Registry()
+
+# NOTE: アプリで記録するメトリクス
+WATERING = REGISTRY.counter("watering", "Number of waterings", ["type"])
+WATERING_VOLUME = REGISTRY.counter(
+    "watering_volume_liters", "Volume of water in liters", ["type"], unit="liters"
+)
+WATERING_DURATION = REGISTRY.counter(
+    "watering_duration_seconds", "Duration of waterings in seconds", ["type"], unit="seconds"
+)
+ERROR = REGISTRY.counter("error", "Number of errors (including coalesced ones)", ["type"])
+
+FLOW = REGISTRY.gauge("flow_liters_per_minute", "Current flow rate in liters per minute")
+VALVE_STATE = REGISTRY.gauge("valve_state", "Valve state (1: open, 0: close)")
+
+SCHEDULER_LATENESS = REGISTRY.histogram(
+    "scheduler_lateness_seconds",
+    "Delay between the scheduled time and the actual start of jobs",
+    unit="seconds",
+    bucket_list=[0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0],
+)
+SCHEDULER_OPEN_DELAY = REGISTRY.histogram(
+    "scheduler_open_delay_seconds",
+    "Delay between the scheduled time and the valve actually opening",
+    unit="seconds",
+    bucket_list=[0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0],
+)
+ADC_READ = REGISTRY.histogram(
+    "adc_read_seconds",
+    "Latency of reading the flow sensor ADC",
+    unit="seconds",
+    bucket_list=[0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1],
+)
+HTTP_REQUEST = REGISTRY.histogram(
+    "http_request_seconds", "Latency of HTTP requests", ["endpoint", "method", "status"], unit="seconds"
+)
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import logging
+
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    WATERING.inc(type="manual")
+    WATERING_VOLUME.inc(12.5, type="manual")
+    FLOW.set(3.2)
+    with ADC_READ.time():
+        time.sleep(0.001)
+
+    logging.info(REGISTRY.render())
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+制御ループなどの処理時間 (スパン) を計測します。
+
+計測値は単調増加する時計 (time.perf_counter) で測り、registry の固定バケットの
+ヒストグラムに記録します。計測は実行中に有効・無効を切り替えられ、無効の場合は
+時計も読みません。有効な場合は、LOG_INTERVAL_MIN 分毎にログに集計を出力します。
+
+Usage:
+  span.py [-D]
+
+Options:
+  -D                : デバッグモードで動作します。
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+
+import rasp_water.metrics.registry
+
+# NOTE: 0.1 ミリ秒 (ファイル読み出し・GPIO) から 1 秒 (スケジューラ・通知) 程度まで
+SPAN_BUCKET_LIST = [
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+]
+
+LOG_INTERVAL_MIN = 10
+
+QUANTILE_LIST = [0.5, 0.9, 0.99]
+
+SPAN = rasp_water.metrics.registry.REGISTRY.histogram(
+    "span_seconds", "Duration of hot-path spans", ["span"], unit="seconds", bucket_list=SPAN_BUCKET_LIST
+)
+
+is_enable = False
+log_interval_sec = LOG_INTERVAL_MIN * 60
+log_time = time.monotonic()
+# NOTE: 平均やパーセンタイルでは見えない、処理時間の揺らぎを見るためにスパン毎の最大値を保持する
+max_lock = threading.Lock()
+max_map = {}
+
+
+def init(config):
+    """設定ファイルの内容に従って、計測の有効・無効とログの出力間隔を設定"""
+    global log_interval_sec  # noqa: PLW0603
+
+    span_config = config.get("metrics", {}).get("span", {})
+
+    log_interval_sec = span_config.get("log_interval_min", LOG_INTERVAL_MIN) * 60
+    set_enable(span_config.get("enable", False))
+
+
+def set_enable(enable: bool):
+    global is_enable  # noqa: PLW0603
+    global log_time  # noqa: PLW0603
+
+    if enable and not is_enable:
+        log_time = time.monotonic()
+
+    is_enable = enable
+    logging.info("Span instrumentation is %s", "enabled" if enable else "disabled")
+
+
+def start() -> float | None:
+    """計測を開始 (無効の場合は None を返す)"""
+    return time.perf_counter() if is_enable else None
+
+
+def end(name: str, start_time: float | None):
+    """start() からの経過時間を記録"""
+    if start_time is None:
+        return
+
+    record(name, time.perf_counter() - start_time)
+
+
+class Span:
+    def __init__(self, name: str):
+        self.name = name
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end(self.name, self.start_time)
+
+
+def span(name: str) -> Span:
+    """with 文のブロックの処理時間を記録"""
+    return Span(name)
+
+
+def record(name: str, elapsed_sec: float):
+    SPAN.observe(elapsed_sec, span=name)
+
+    with max_lock:
+        if elapsed_sec > max_map.get(name, 0.0):
+            max_map[name] = elapsed_sec
+
+    log_summary_if_due()
+
+
+def get_summary() -> dict:
+    """スパン毎の回数、平均、最大、パーセンタイル (バケットの上限による推定値) を取得"""
+    with max_lock:
+        max_copy = dict(max_map)
+
+    summary = {}
+    for label in SPAN.get_label_list():
+        stat = SPAN.get(**label)
+        max_sec = max_copy.get(label["span"], 0.0)
+        summary[label["span"]] = {
+            "count": stat["count"],
+            "avg_sec": stat["sum"] / stat["count"] if stat["count"] > 0 else 0.0,
+            "max_sec": max_sec,
+            # NOTE: 最後のバケット (+Inf) に入る場合も、実際の値は最大値以下
+            **{
+                f"p{int(quantile * 100)}_sec": min(SPAN.get_quantile(quantile, **label), max_sec)
+                for quantile in QUANTILE_LIST
+            },
+        }
+
+    return summary
+
+
+def log_summary_if_due():
+    global log_time  # noqa: PLW0603
+
+    now = time.monotonic()
+    if (now - log_time) < log_interval_sec:
+        return
+    log_time = now
+
+    for name, stat in get_summary().items():
+        logging.info(
+            "SPAN %-28s: count=%d, avg=%.2fms, p90<=%.2fms, p99<=%.2fms, max=%.2fms",
+            name,
+            stat["count"],
+            stat["avg_sec"] * 1000,
+            stat["p90_sec"] * 1000,
+            stat["p99_sec"] * 1000,
+            stat["max_sec"] * 1000,
+        )
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.logger
+    import my_lib.pretty
+
+    args = docopt.docopt(__doc__)
+
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    set_enable(True)
+    for i in range(100):
+        with span("test.sleep"):
+            time.sleep(0.001 * (i % 5))
+
+    logging.info(my_lib.pretty.format(get_summary()))
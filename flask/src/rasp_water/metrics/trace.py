@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+1 回の水やりの流れ (スケジューラの起動、天気の判定、バルブの開閉、流量の計測、記録) を
+Chrome の trace event 形式 (chrome://tracing や Perfetto で開ける JSON) で記録します。
+
+バルブは 1 つなので、同時に記録する水やりは 1 つだけです。各スレッドは、記録中の水やりに
+スパン (開始・終了のある処理) やインスタント (時刻だけのできごと) を追加します。
+水やりが終わると、1 回分を 1 つのファイルに書き出し、古いファイルは削除します。
+
+バルブを別プロセス (rasp_water.control.valve_daemon) で制御する場合、デーモンで発生したイベントは
+set_forward() で指定したキューで WEB のプロセスに送り、append_event() で記録中の水やりに追加します。
+
+Usage:
+  trace.py [-d DIR] [-D]
+
+Options:
+  -d DIR            : トレースを書き出すディレクトリを指定します。[default: flask/data/trace]
+  -D                : デバッグモードで動作します。
+"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+TRACE_DIR_PATH = "flask/data/trace"
+KEEP_COUNT = 50
+
+# NOTE: 計測が終わらないまま (プロセスの再起動など) この時間が経過した記録は破棄する
+MAX_RUN_SEC = 6 * 60 * 60
+
+is_enable = False
+trace_dir_path = pathlib.Path(TRACE_DIR_PATH)
+keep_count = KEEP_COUNT
+
+trace_lock = threading.Lock()
+# NOTE: 記録中の水やり (記録していない場合は None)
+current_run = None
+# NOTE: イベントを送る先のキュー (別プロセスのデーモンで記録する場合)
+forward_queue = None
+
+
+def init(config):
+    """設定ファイルの内容に従って、記録の有効・無効と書き出し先を設定"""
+    global is_enable  # noqa: PLW0603
+    global trace_dir_path  # noqa: PLW0603
+    global keep_count  # noqa: PLW0603
+
+    trace_config = config.get("metrics", {}).get("trace", {})
+
+    is_enable = trace_config.get("enable", False)
+    trace_dir_path = pathlib.Path(trace_config.get("dir", TRACE_DIR_PATH))
+    keep_count = trace_config.get("keep_count", KEEP_COUNT)
+
+
+def get_ts() -> float:
+    """trace event の時刻 [マイクロ秒] (ログと突き合わせられるように UNIX 時間にする)"""
+    return time.time() * 1_000_000
+
+
+def set_forward(queue):
+    """イベントを記録せずに queue に送るようにする (記録中の水やりは WEB のプロセスにしか無いため)"""
+    global forward_queue  # noqa: PLW0603
+
+    forward_queue = queue
+
+
+def add_event(event: dict) -> bool:
+    thread = threading.current_thread()
+    event["pid"] = os.getpid()
+    event["tid"] = thread.ident
+
+    if forward_queue is not None:
+        forward_queue.put({"type": "trace", "event": event, "thread_name": thread.name})
+        return True
+
+    return append_event(event, thread.name)
+
+
+def append_event(event: dict, thread_name: str) -> bool:
+    """記録中の水やりに、pid と tid を設定済みのイベントを追加"""
+    with trace_lock:
+        if current_run is None:
+            return False
+
+        current_run["event_list"].append(event)
+        current_run["thread_map"][(event["pid"], event["tid"])] = thread_name
+
+    return True
+
+
+def begin(name: str, **args) -> bool:
+    """
+    水やりの記録を開始
+
+    Returns
+    -------
+        新たに記録を開始したかどうか (既に記録中の場合は False)
+
+    """
+    global current_run  # noqa: PLW0603
+
+    if not is_enable:
+        return False
+
+    with trace_lock:
+        if current_run is not None:
+            if (get_ts() - current_run["start_ts"]) < MAX_RUN_SEC * 1_000_000:
+                return False
+            logging.warning("Discard stale watering trace: %s", current_run["start_time"])
+
+        current_run = {
+            "name": name,
+            "start_time": datetime.datetime.now(),
+            "start_ts": get_ts(),
+            "tid": threading.get_ident(),
+            "event_list": [],
+            "thread_map": {(os.getpid(), threading.get_ident()): threading.current_thread().name},
+            "args": args,
+        }
+
+    return True
+
+
+def end(**args) -> pathlib.Path | None:
+    """水やりの記録を終了してファイルに書き出す"""
+    global current_run  # noqa: PLW0603
+
+    with trace_lock:
+        run = current_run
+        current_run = None
+
+    if run is None:
+        return None
+
+    run["args"].update(args)
+
+    event_list = [
+        {
+            "name": run["name"],
+            "cat": "watering",
+            "ph": "X",
+            "ts": run["start_ts"],
+            "dur": get_ts() - run["start_ts"],
+            "pid": os.getpid(),
+            "tid": run["tid"],
+            "args": run["args"],
+        },
+        *run["event_list"],
+    ]
+
+    # NOTE: ビューアでスレッド名を表示するためのメタデータ
+    event_list.extend(
+        {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+        for (pid, tid), name in run["thread_map"].items()
+    )
+
+    try:
+        return write(run["start_time"], run["name"], event_list)
+    except Exception:
+        logging.exception("Failed to write watering trace")
+        return None
+
+
+def write(start_time: datetime.datetime, name: str, event_list: list) -> pathlib.Path:
+    trace_dir_path.mkdir(parents=True, exist_ok=True)
+
+    path = trace_dir_path / "trace_{time}_{name}.json".format(
+        time=start_time.strftime("%Y%m%d_%H%M%S"), name=name
+    )
+    with path.open("w") as f:
+        json.dump({"traceEvents": event_list, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+    # NOTE: ファイル名は開始時刻順に並ぶので、古いものから削除する
+    for old_path in sorted(trace_dir_path.glob("trace_*.json"))[:-keep_count]:
+        old_path.unlink(missing_ok=True)
+
+    logging.info("Wrote watering trace: %s", path)
+
+    return path
+
+
+def is_active() -> bool:
+    return current_run is not None
+
+
+def instant(name: str, **args):
+    """時刻だけのできごとを記録"""
+    add_event({"name": name, "cat": "watering", "ph": "i", "s": "t", "ts": get_ts(), "args": args})
+
+
+def complete(name: str, start_ts: float, **args):
+    """start_ts (get_ts() の値) から現在までのスパンを記録"""
+    if start_ts is None:
+        return
+
+    add_event(
+        {"name": name, "cat": "watering", "ph": "X", "ts": start_ts, "dur": get_ts() - start_ts, "args": args}
+    )
+
+
+class Span:
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+        self.start_ts = None
+
+    def __enter__(self):
+        # NOTE: 記録していない場合は時刻も読まない
+        self.start_ts = get_ts() if (current_run is not None) or (forward_queue is not None) else None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start_ts is None:
+            return
+
+        if exc_type is not None:
+            self.args["error"] = repr(exc_value)
+        complete(self.name, self.start_ts, **self.args)
+
+
+def span(name: str, **args) -> Span:
+    """with 文のブロックをスパンとして記録"""
+    return Span(name, args)
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    init({"metrics": {"trace": {"dir": args["-d"]}}})
+
+    begin("manual", period=1)
+    with span("step1"):
+        time.sleep(0.01)
+    instant("event")
+    worker = threading.Thread(target=lambda: complete("step2", get_ts() - 5000), name="worker")
+    worker.start()
+    worker.join()
+    end(result="success")
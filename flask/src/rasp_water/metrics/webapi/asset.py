@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+メトリクスダッシュボード用の静的ファイル (Bulma, Chart.js, Font Awesome) を配信します。
+
+インターネットに接続できない環境でも表示できるように、vendor/ 以下に同梱したファイルを返します。
+URL には内容のハッシュを含めるので、ブラウザには無期限にキャッシュさせます。
+gzip / brotli で圧縮済みのファイル (*.gz, *.br) がある場合は、それを返します。
+
+Usage:
+  asset.py [-D]
+
+Options:
+  -D                : デバッグモードで動作します。
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import threading
+from pathlib import Path
+
+import my_lib.webapp.config
+
+import flask
+
+blueprint = flask.Blueprint("metrics-asset", __name__, url_prefix=my_lib.webapp.config.URL_PREFIX)
+
+VENDOR_DIR_PATH = Path(__file__).parent / "vendor"
+
+# NOTE: 圧縮済みファイルの拡張子と Content-Encoding (優先する順)
+ENCODING_LIST = [("br", ".br"), ("gzip", ".gz")]
+
+# NOTE: 圧縮済みファイルを用意するファイルの拡張子 (woff2 などは既に圧縮されている)
+COMPRESS_SUFFIX_LIST = [".css", ".js"]
+
+CACHE_MAX_AGE_SEC = 365 * 24 * 60 * 60
+
+bundle_hash_lock = threading.Lock()
+bundle_hash = None
+
+
+def get_bundle_hash() -> dict[str, str]:
+    """vendor/ 以下のディレクトリ毎に、含まれるファイルの内容からハッシュを計算"""
+    global bundle_hash  # noqa: PLW0603
+
+    with bundle_hash_lock:
+        if bundle_hash is not None:
+            return bundle_hash
+
+        # NOTE: CSS から相対パスで参照されるファイル (webfonts など) があるので、
+        # ファイル毎ではなくディレクトリ毎のハッシュを URL に含める
+        bundle_hash = {}
+        for bundle_path in sorted(path for path in VENDOR_DIR_PATH.iterdir() if path.is_dir()):
+            sha256 = hashlib.sha256()
+            for file_path in sorted(bundle_path.rglob("*")):
+                if (not file_path.is_file()) or (file_path.suffix in [suffix for _, suffix in ENCODING_LIST]):
+                    continue
+                sha256.update(file_path.relative_to(bundle_path).as_posix().encode())
+                sha256.update(file_path.read_bytes())
+            bundle_hash[bundle_path.name] = sha256.hexdigest()[:16]
+
+        return bundle_hash
+
+
+def url_for(bundle: str, path: str) -> str:
+    """同梱したファイルの URL を取得"""
+    return f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/vendor/{bundle}.{get_bundle_hash()[bundle]}/{path}"
+
+
+@blueprint.route("/api/metrics/vendor/<bundle>.<hash_value>/<path:path>", methods=["GET"])
+def vendor_file(bundle, hash_value, path):
+    if get_bundle_hash().get(bundle) != hash_value:
+        flask.abort(404)
+
+    bundle_path = VENDOR_DIR_PATH / bundle
+    file_path = (bundle_path / path).resolve()
+    if (not file_path.is_relative_to(bundle_path.resolve())) or (not file_path.is_file()):
+        flask.abort(404)
+
+    mimetype = mimetypes.guess_type(file_path.name)[0] or "application/octet-stream"
+
+    content_encoding = None
+    for encoding, suffix in ENCODING_LIST:
+        compressed_path = file_path.with_name(file_path.name + suffix)
+        if (encoding in flask.request.accept_encodings) and compressed_path.exists():
+            content_encoding = encoding
+            file_path = compressed_path
+            break
+
+    res = flask.send_file(file_path, mimetype=mimetype, max_age=CACHE_MAX_AGE_SEC, conditional=True)
+    if content_encoding is not None:
+        res.headers["Content-Encoding"] = content_encoding
+    res.headers["Cache-Control"] = f"public, max-age={CACHE_MAX_AGE_SEC}, immutable"
+    res.vary.add("Accept-Encoding")
+
+    return res
+
+
+def compress():
+    """圧縮済みファイルを作成 (brotli は、モジュールがインストールされている場合のみ)"""
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        logging.warning("brotli is not installed, skip creating *.br")
+
+    for file_path in sorted(VENDOR_DIR_PATH.rglob("*")):
+        if file_path.suffix not in COMPRESS_SUFFIX_LIST:
+            continue
+
+        data = file_path.read_bytes()
+
+        # NOTE: 同じ内容からは同じファイルができるように、mtime を固定する
+        file_path.with_name(file_path.name + ".gz").write_bytes(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            file_path.with_name(file_path.name + ".br").write_bytes(brotli.compress(data, quality=11))
+
+        logging.info("Compressed %s", file_path.relative_to(VENDOR_DIR_PATH))
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.logger
+
+    args = docopt.docopt(__doc__)
+
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    compress()
+
+    for bundle, hash_value in get_bundle_hash().items():
+        logging.info("%s: %s", bundle, hash_value)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+水やりメトリクスのエクスポート
+
+水やり・エラーのメトリクスを CSV, NDJSON または Arrow IPC (pyarrow がインストールされている場合)
+でストリーミングして返します。データは少しずつ読み出すので、メモリ使用量は件数に依存しません。
+"""
+
+from __future__ import annotations
+
+import csv
+import datetime
+import importlib.util
+import io
+import json
+import logging
+from pathlib import Path
+
+import my_lib.webapp.config
+import rasp_water.metrics.collector
+import rasp_water.metrics.webapi.page
+
+import flask
+
+blueprint = flask.Blueprint("metrics-export", __name__, url_prefix=my_lib.webapp.config.URL_PREFIX)
+
+FORMAT_MIMETYPE = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+ARROW_TYPE = {
+    "integer": "int64",
+    "real": "float64",
+    "text": "string",
+}
+
+
+@blueprint.route("/api/metrics/export", methods=["GET"])
+def metrics_export():
+    """
+    メトリクスをストリーミングでエクスポート
+
+    クエリパラメータ:
+        table: "watering" (水やり) または "error" (エラー)
+        format: "csv", "ndjson" または "arrow"
+        from: 開始日（YYYY-MM-DD形式、省略時は最初から）
+        to: 終了日（YYYY-MM-DD形式、省略時は最後まで）
+    """
+    config = flask.current_app.config["CONFIG"]
+    metrics_data_path = config.get("metrics", {}).get("data")
+
+    if not metrics_data_path or not Path(metrics_data_path).exists():
+        return flask.jsonify({"error": "メトリクスデータベースが見つかりません"}), 503
+
+    name = flask.request.args.get("table", "watering")
+    if name not in rasp_water.metrics.collector.EXPORT_TABLE:
+        return flask.jsonify(
+            {"error": f"table は {', '.join(rasp_water.metrics.collector.EXPORT_TABLE)} のいずれかです"}
+        ), 400
+
+    export_format = flask.request.args.get("format", "csv")
+    if export_format not in FORMAT_MIMETYPE:
+        return flask.jsonify({"error": f"format は {', '.join(FORMAT_MIMETYPE)} のいずれかです"}), 400
+    if (export_format == "arrow") and (importlib.util.find_spec("pyarrow") is None):
+        return flask.jsonify({"error": "Arrow 形式で出力するには pyarrow が必要です"}), 501
+
+    try:
+        start_date = rasp_water.metrics.webapi.page.parse_date(
+            flask.request.args.get("from"), datetime.date.min
+        ).isoformat()
+        end_date = rasp_water.metrics.webapi.page.parse_date(
+            flask.request.args.get("to"), datetime.date.max
+        ).isoformat()
+    except ValueError:
+        return flask.jsonify({"error": "日付は YYYY-MM-DD 形式で指定してください"}), 400
+
+    collector = rasp_water.metrics.collector.get_collector(metrics_data_path)
+    column_list = rasp_water.metrics.collector.EXPORT_TABLE[name]["column_list"]
+    batch_iter = collector.iter_export(name, start_date, end_date)
+
+    generator = {
+        "csv": generate_csv,
+        "ndjson": generate_ndjson,
+        "arrow": generate_arrow,
+    }[export_format]
+
+    res = flask.Response(
+        flask.stream_with_context(log_error(generator(column_list, batch_iter))),
+        mimetype=FORMAT_MIMETYPE[export_format],
+    )
+    res.headers["Content-Disposition"] = f'attachment; filename="{name}_metrics.{export_format}"'
+
+    return res
+
+
+def log_error(generator):
+    # NOTE: ストリーミング中はステータスコードを変更できないので、ログにだけ残す
+    try:
+        yield from generator
+    except Exception:
+        logging.exception("メトリクスのエクスポートに失敗しました")
+        raise
+
+
+def generate_csv(column_list, batch_iter):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    # NOTE: データが無い場合もヘッダは返す
+    writer.writerow([column for column, _ in column_list])
+    yield buffer.getvalue()
+
+    for row_list in batch_iter:
+        buffer.seek(0)
+        buffer.truncate()
+
+        writer.writerows(row_list)
+        yield buffer.getvalue()
+
+
+def generate_ndjson(column_list, batch_iter):
+    name_list = [column for column, _ in column_list]
+
+    for row_list in batch_iter:
+        yield "".join(
+            json.dumps(dict(zip(name_list, row, strict=True)), ensure_ascii=False, separators=(",", ":"))
+            + "\n"
+            for row in row_list
+        )
+
+
+def generate_arrow(column_list, batch_iter):
+    import pyarrow
+    import pyarrow.ipc
+
+    schema = pyarrow.schema([(column, ARROW_TYPE[column_type]) for column, column_type in column_list])
+
+    # NOTE: RecordBatch 毎に書き出して、バッファに溜まった分を返す
+    buffer = io.BytesIO()
+    with pyarrow.ipc.new_stream(buffer, schema) as writer:
+        for row_list in batch_iter:
+            writer.write_batch(
+                pyarrow.record_batch(
+                    [
+                        pyarrow.array(column, type=field.type)
+                        for column, field in zip(zip(*row_list, strict=True), schema, strict=True)
+                    ],
+                    schema=schema,
+                )
+            )
+            yield buffer.getvalue()
+
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+プロセス内のメトリクスを OpenMetrics 形式で返します (Prometheus からのスクレイプ用)。
+
+全ての HTTP リクエストの所要時間も、このモジュールで記録します。
+制御ループなどの処理時間 (スパン) の集計の取得と、計測の有効・無効の切り替えもここで行います。
+"""
+
+from __future__ import annotations
+
+import time
+
+import my_lib.webapp.config
+import rasp_water.control.valve
+import rasp_water.metrics.registry
+import rasp_water.metrics.span
+
+import flask
+
+blueprint = flask.Blueprint("metrics-openmetrics", __name__, url_prefix=my_lib.webapp.config.URL_PREFIX)
+
+
+@blueprint.route("/metrics", methods=["GET"])
+def openmetrics():
+    # NOTE: バルブを別プロセスで制御している場合は、デーモンの状態を反映してから出力する
+    rasp_water.control.valve.sync_metrics()
+
+    res = flask.Response(rasp_water.metrics.registry.REGISTRY.render(), mimetype="text/plain")
+    res.headers["Content-Type"] = rasp_water.metrics.registry.CONTENT_TYPE
+    res.headers["Cache-Control"] = "no-store"
+
+    return res
+
+
+@blueprint.route("/api/metrics/span", methods=["GET", "POST"])
+def span_summary():
+    """
+    スパン毎の処理時間の集計を取得
+
+    クエリパラメータ:
+        enable: "true" または "false" を指定すると、計測の有効・無効を切り替える (POST のみ)
+    """
+    if flask.request.method == "POST":
+        enable = flask.request.args.get("enable", flask.request.form.get("enable"))
+        if enable not in ["true", "false"]:
+            return flask.jsonify({"error": "enable は true または false です"}), 400
+
+        rasp_water.metrics.span.set_enable(enable == "true")
+
+    return flask.jsonify(
+        {"enable": rasp_water.metrics.span.is_enable, "span": rasp_water.metrics.span.get_summary()}
+    )
+
+
+@blueprint.before_app_request
+def start_timer():
+    flask.g.request_start = time.perf_counter()
+
+
+@blueprint.after_app_request
+def observe_latency(res):
+    start = flask.g.get("request_start")
+    if start is None:
+        return res
+
+    # NOTE: ラベルの種類が増えすぎないように、パスではなくルーティングのルールを使う
+    rule = flask.request.url_rule
+    rasp_water.metrics.registry.HTTP_REQUEST.observe(
+        time.perf_counter() - start,
+        endpoint=rule.rule if rule is not None else "(unmatched)",
+        method=flask.request.method,
+        status=res.status_code,
+    )
+
+    return res
@@ -8,19 +8,43 @@
 from __future__ import annotations
 
 import datetime
+import hashlib
 import io
 import json
 import logging
-from collections import defaultdict
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
 
 import my_lib.webapp.config
 import rasp_water.metrics.collector
+import rasp_water.metrics.webapi.asset
 from PIL import Image, ImageDraw
 
 import flask
 
 blueprint = flask.Blueprint("metrics", __name__, url_prefix=my_lib.webapp.config.URL_PREFIX)
 
+# NOTE: 再起動の前後で ETag が衝突しないように、プロセス毎に異なる値を混ぜる
+RENDER_CACHE_TOKEN = f"{os.getpid()}-{time.time()}"
+
+# NOTE: 描画結果をデータのバージョンが変わるまで使い回す。期間を指定できるので件数を制限する
+RENDER_CACHE_SIZE = 32
+render_cache_lock = threading.Lock()
+render_cache = OrderedDict()
+
+# NOTE: ダッシュボードの HTML はデータを含まないので、ブラウザにキャッシュさせる
+SHELL_MAX_AGE_SEC = 60 * 60
+
+DEFAULT_PERIOD_DAYS = 30
+RESOLUTION_LIST = ["day", "week", "watering"]
+
+# NOTE: favicon は内容が変わらないので、一度だけ描画する
+favicon_lock = threading.Lock()
+favicon_data = None
+
 
 @blueprint.route("/api/metrics", methods=["GET"])
 def metrics_view():
@@ -39,8 +63,6 @@ def metrics_view():
                 status=503,
             )
 
-        from pathlib import Path
-
         db_path = Path(metrics_data_path)
         if not db_path.exists():
             return flask.Response(
@@ -51,54 +73,177 @@ def metrics_view():
                 status=503,
             )
 
-        # メトリクス収集器を取得
-        collector = rasp_water.metrics.collector.get_collector(metrics_data_path)
+        # NOTE: HTML はデータを含まないので、プロセスが動いている間は変化しない
+        entry = get_render_cache("metrics_view", "shell", generate_metrics_html)
+
+        return make_cached_response(entry, "text/html", SHELL_MAX_AGE_SEC)
+
+    except Exception as e:
+        logging.exception("メトリクス表示の生成エラー")
+        return flask.Response(f"エラー: {e!s}", mimetype="text/plain", status=500)
+
+
+@blueprint.route("/api/metrics/data", methods=["GET"])
+def metrics_data():
+    """
+    メトリクスデータを列指向の JSON で返す
+
+    クエリパラメータ:
+        from: 開始日（YYYY-MM-DD形式、省略時は to の 30 日前）
+        to: 終了日（YYYY-MM-DD形式、省略時は今日）
+        resolution: "day" (日毎), "week" (週毎), "watering" (水やり毎の流量)
+    """
+    config = flask.current_app.config["CONFIG"]
+    metrics_data_path = config.get("metrics", {}).get("data")
+
+    if not metrics_data_path or not Path(metrics_data_path).exists():
+        return flask.jsonify({"error": "メトリクスデータベースが見つかりません"}), 503
+
+    try:
+        end_date = parse_date(flask.request.args.get("to"), datetime.date.today())
+        start_date = parse_date(
+            flask.request.args.get("from"), end_date - datetime.timedelta(days=DEFAULT_PERIOD_DAYS)
+        )
+    except ValueError:
+        return flask.jsonify({"error": "日付は YYYY-MM-DD 形式で指定してください"}), 400
 
-        # 最近30日間のデータを取得
-        watering_metrics = collector.get_recent_watering_metrics(days=30)
-        error_metrics = collector.get_recent_error_metrics(days=30)
+    resolution = flask.request.args.get("resolution", "day")
+    if resolution not in RESOLUTION_LIST:
+        return flask.jsonify({"error": f"resolution は {', '.join(RESOLUTION_LIST)} のいずれかです"}), 400
+    if start_date > end_date:
+        return flask.jsonify({"error": "from は to 以前の日付を指定してください"}), 400
 
-        # 統計データを生成
-        stats = generate_statistics(watering_metrics, error_metrics)
+    try:
+        collector = rasp_water.metrics.collector.get_collector(metrics_data_path)
 
-        # 時系列データを準備
-        time_series_data = prepare_time_series_data(watering_metrics)
+        start_date = start_date.isoformat()
+        end_date = end_date.isoformat()
+
+        def render():
+            return json.dumps(
+                {
+                    "from": start_date,
+                    "to": end_date,
+                    "resolution": resolution,
+                    "summary": generate_statistics(collector, start_date, end_date),
+                    "series": prepare_series_data(collector, start_date, end_date, resolution),
+                },
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
 
-        # HTMLを生成
-        html_content = generate_metrics_html(stats, time_series_data)
+        entry = get_render_cache(
+            f"metrics_data:{start_date}:{end_date}:{resolution}",
+            f"{datetime.date.today()}:{collector.get_data_version()}",
+            render,
+        )
 
-        return flask.Response(html_content, mimetype="text/html")
+        return make_cached_response(entry, "application/json")
 
     except Exception as e:
-        logging.exception("メトリクス表示の生成エラー")
-        return flask.Response(f"エラー: {e!s}", mimetype="text/plain", status=500)
+        logging.exception("メトリクスデータの生成エラー")
+        return flask.jsonify({"error": str(e)}), 500
+
+
+def parse_date(date_str: str | None, default: datetime.date) -> datetime.date:
+    if date_str is None or date_str == "":
+        return default
+
+    return datetime.date.fromisoformat(date_str)
+
+
+def get_render_cache(name: str, version: str, render) -> dict:
+    """
+    描画結果をキャッシュから取得 (バージョンが異なる場合は render() で描画し直す)
+
+    Args:
+    ----
+        name: キャッシュの名前
+        version: データのバージョン
+        render: 描画結果を返す関数
+
+    Returns:
+    -------
+        描画結果と ETag, Last-Modified を含む辞書
+
+    """
+    with render_cache_lock:
+        entry = render_cache.get(name)
+        if (entry is not None) and (entry["version"] == version):
+            render_cache.move_to_end(name)
+            return entry
+
+    entry = {
+        "version": version,
+        "body": render(),
+        "etag": hashlib.sha256(f"{RENDER_CACHE_TOKEN}:{name}:{version}".encode()).hexdigest(),
+        "last_modified": datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0),
+    }
+    with render_cache_lock:
+        render_cache[name] = entry
+        render_cache.move_to_end(name)
+        while len(render_cache) > RENDER_CACHE_SIZE:
+            render_cache.popitem(last=False)
+
+    return entry
+
+
+def make_cached_response(entry: dict, mimetype: str, max_age: int = 0) -> flask.Response:
+    """ETag と Last-Modified を付けたレスポンスを作成 (変化が無い場合は 304 になる)"""
+    res = flask.Response(entry["body"], mimetype=mimetype)
+    res.set_etag(entry["etag"])
+    res.last_modified = entry["last_modified"]
+    if max_age == 0:
+        # NOTE: ブラウザにキャッシュさせつつ、毎回更新の有無を確認させる
+        res.headers["Cache-Control"] = "no-cache"
+    else:
+        res.headers["Cache-Control"] = f"public, max-age={max_age}"
+
+    return res.make_conditional(flask.request)
 
 
 @blueprint.route("/favicon.ico", methods=["GET"])
 def favicon():
-    """動的生成された水やりメトリクス用favicon.icoを返す"""
+    """水やりメトリクス用favicon.icoを返す"""
     try:
-        # 水やりメトリクスアイコンを生成
-        img = generate_watering_metrics_icon()
+        data = get_favicon_data()
 
-        # ICO形式で出力
-        output = io.BytesIO()
-        img.save(output, format="ICO", sizes=[(32, 32)])
-        output.seek(0)
-
-        return flask.Response(
-            output.getvalue(),
+        res = flask.Response(
+            data,
             mimetype="image/x-icon",
             headers={
                 "Cache-Control": "public, max-age=3600",  # 1時間キャッシュ
-                "Content-Type": "image/x-icon",
             },
         )
+        res.set_etag(hashlib.sha256(data).hexdigest())
+
+        return res.make_conditional(flask.request)
     except Exception:
         logging.exception("favicon生成エラー")
         return flask.Response("", status=500)
 
 
+def get_favicon_data() -> bytes:
+    """favicon.ico のデータを取得 (初回のみ生成)"""
+    global favicon_data  # noqa: PLW0603
+
+    with favicon_lock:
+        if favicon_data is None:
+            # 水やりメトリクスアイコンを生成
+            img = generate_watering_metrics_icon()
+
+            # ICO形式で出力
+            output = io.BytesIO()
+            img.save(output, format="ICO", sizes=[(32, 32)])
+            favicon_data = output.getvalue()
+
+        return favicon_data
+
+
+# NOTE: リクエストの度に描画しないように、アプリケーションの起動時に描画しておく
+blueprint.record_once(lambda _state: get_favicon_data())
+
+
 def generate_watering_metrics_icon():
     """水やりメトリクス用のアイコンを動的生成（アンチエイリアス対応）"""
     # アンチエイリアスのため4倍サイズで描画してから縮小
@@ -162,40 +307,13 @@ def generate_watering_metrics_icon():
     return img.resize((size, size), Image.LANCZOS)
 
 
-def generate_statistics(watering_metrics: list[dict], error_metrics: list[dict]) -> dict:
+def generate_statistics(collector, start_date: str, end_date: str) -> dict:
     """メトリクスデータから統計情報を生成"""
-    if not watering_metrics:
-        return {
-            "total_days": 0,
-            "total_watering_count": 0,
-            "manual_watering_count": 0,
-            "auto_watering_count": 0,
-            "total_duration_minutes": 0,
-            "total_volume_liters": 0,
-            "avg_duration_minutes": 0,
-            "avg_volume_liters": 0,
-            "avg_flow_rate": 0,
-            "error_count": len(error_metrics),
-        }
-
-    # 日付ごとのデータを集計
-    unique_dates = {op.get("date") for op in watering_metrics if op.get("date")}
+    stats = collector.get_statistics(start_date, end_date)
 
-    # 各種カウントと合計値を計算
-    total_watering_count = len(watering_metrics)
-    manual_watering_count = sum(
-        1 for op in watering_metrics if op.get("operation_type") == "manual"
-    )
-    auto_watering_count = sum(
-        1 for op in watering_metrics if op.get("operation_type") == "auto"
-    )
-
-    total_duration_seconds = sum(
-        op.get("duration_seconds", 0) for op in watering_metrics
-    )
-    total_volume_liters = sum(
-        op.get("volume_liters", 0) for op in watering_metrics if op.get("volume_liters") is not None
-    )
+    total_watering_count = stats["total_watering_count"]
+    total_duration_seconds = stats["total_duration_seconds"]
+    total_volume_liters = stats["total_volume_liters"]
 
     # 平均値を計算
     avg_duration_seconds = total_duration_seconds / total_watering_count if total_watering_count > 0 else 0
@@ -205,128 +323,50 @@ def generate_statistics(watering_metrics: list[dict], error_metrics: list[dict])
     avg_flow_rate = total_volume_liters / total_duration_seconds if total_duration_seconds > 0 else 0
 
     return {
-        "total_days": len(unique_dates),
+        "total_days": stats["total_days"],
         "total_watering_count": total_watering_count,
-        "manual_watering_count": manual_watering_count,
-        "auto_watering_count": auto_watering_count,
+        "manual_watering_count": stats["manual_watering_count"],
+        "auto_watering_count": stats["auto_watering_count"],
         "total_duration_minutes": total_duration_seconds / 60,
         "total_volume_liters": total_volume_liters,
         "avg_duration_minutes": avg_duration_seconds / 60,
         "avg_volume_liters": avg_volume_liters,
         "avg_flow_rate": avg_flow_rate,
-        "error_count": len(error_metrics),
+        "error_count": stats["error_count"],
+        "schedule": collector.get_schedule_statistics(start_date, end_date),
     }
 
 
-def prepare_time_series_data(watering_metrics: list[dict]) -> dict:
-    """時系列データを準備"""
-    # 日付ごとのデータを集計
-    daily_data = defaultdict(lambda: {
-        "count": 0,
-        "manual_count": 0,
-        "auto_count": 0,
-        "duration_seconds": 0,
-        "volume_liters": 0,
-        "watering_list": []
-    })
-
-    for op in watering_metrics:
-        date = op.get("date")
-        if date:
-            daily_data[date]["count"] += 1
-            daily_data[date]["duration_seconds"] += op.get("duration_seconds", 0)
-            
-            if op.get("volume_liters") is not None:
-                daily_data[date]["volume_liters"] += op.get("volume_liters", 0)
-            
-            if op.get("operation_type") == "manual":
-                daily_data[date]["manual_count"] += 1
-            else:
-                daily_data[date]["auto_count"] += 1
-                
-            # 個別の水やりデータを保存（流量計算用）
-            daily_data[date]["watering_list"].append({
-                "duration_seconds": op.get("duration_seconds", 0),
-                "volume_liters": op.get("volume_liters", 0)
-            })
-
-    # 週ごとのデータを集計
-    weekly_data = defaultdict(lambda: {
-        "count": 0,
-        "manual_count": 0,
-        "auto_count": 0,
-        "duration_seconds": 0,
-        "volume_liters": 0,
-        "watering_list": []
-    })
-
-    for date_str, data in daily_data.items():
-        date_obj = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
-        week_start = date_obj - datetime.timedelta(days=date_obj.weekday())
-        week_key = week_start.isoformat()
-        
-        weekly_data[week_key]["count"] += data["count"]
-        weekly_data[week_key]["manual_count"] += data["manual_count"]
-        weekly_data[week_key]["auto_count"] += data["auto_count"]
-        weekly_data[week_key]["duration_seconds"] += data["duration_seconds"]
-        weekly_data[week_key]["volume_liters"] += data["volume_liters"]
-        weekly_data[week_key]["watering_list"].extend(data["watering_list"])
-
-    # ソートして配列に変換
-    sorted_dates = sorted(daily_data.keys())
-    sorted_weeks = sorted(weekly_data.keys())
-
-    # 日別データ
-    daily_labels = sorted_dates
-    daily_volumes = [daily_data[date]["volume_liters"] for date in sorted_dates]
-    daily_counts = [daily_data[date]["count"] for date in sorted_dates]
-    daily_durations = [daily_data[date]["duration_seconds"] / 60 for date in sorted_dates]  # 分に変換
-    daily_manual_counts = [daily_data[date]["manual_count"] for date in sorted_dates]
-
-    # 週別データ
-    weekly_labels = [f"{week}週" for week in sorted_weeks]
-    weekly_volumes = [weekly_data[week]["volume_liters"] for week in sorted_weeks]
-    weekly_counts = [weekly_data[week]["count"] for week in sorted_weeks]
-    weekly_durations = [weekly_data[week]["duration_seconds"] / 60 for week in sorted_weeks]  # 分に変換
-    weekly_manual_counts = [weekly_data[week]["manual_count"] for week in sorted_weeks]
-
-    # 流量データ（リットル/秒）
-    flow_rates = []
-    flow_labels = []
-    for op in watering_metrics:
-        if op.get("duration_seconds", 0) > 0 and op.get("volume_liters") is not None:
-            flow_rate = op.get("volume_liters", 0) / op.get("duration_seconds", 0)
-            flow_rates.append(flow_rate)
-            flow_labels.append(op.get("timestamp", ""))
+def prepare_series_data(collector, start_date: str, end_date: str, resolution: str) -> dict:
+    """時系列データを準備 (集計は SQL 側で行い、列毎のリストで返す)"""
+    if resolution == "watering":
+        flow = collector.get_flow_series(start_date, end_date)
 
-    return {
-        "daily": {
-            "labels": daily_labels,
-            "volumes": daily_volumes,
-            "counts": daily_counts,
-            "durations": daily_durations,
-            "manual_counts": daily_manual_counts,
-        },
-        "weekly": {
-            "labels": weekly_labels,
-            "volumes": weekly_volumes,
-            "counts": weekly_counts,
-            "durations": weekly_durations,
-            "manual_counts": weekly_manual_counts,
-        },
-        "flow": {
-            "labels": flow_labels,
-            "rates": flow_rates,
+        return {
+            "labels": flow["label"],
+            "rates": flow["rate"],
         }
-    }
 
+    if resolution == "week":
+        series = collector.get_weekly_series(start_date, end_date)
+    else:
+        series = collector.get_daily_series(start_date, end_date)
+
+    return {
+        "labels": series["label"],
+        "volumes": series["volume_liters"],
+        "counts": series["count"],
+        "durations": [duration / 60 for duration in series["duration_seconds"]],  # 分に変換
+        "manual_counts": series["manual_count"],
+    }
 
-def generate_metrics_html(stats: dict, time_series_data: dict) -> str:
-    """Bulma CSSを使用したメトリクスHTMLを生成"""
-    chart_data_json = json.dumps(time_series_data)
 
+def generate_metrics_html() -> str:
+    """Bulma CSSを使用したメトリクスHTMLを生成 (データは /api/metrics/data から取得する)"""
     # URL_PREFIXを取得してfaviconパスを構築
     favicon_path = f"{my_lib.webapp.config.URL_PREFIX}/favicon.ico"
+    data_path = f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/data"
+    asset = rasp_water.metrics.webapi.asset
 
     return f"""
 <!DOCTYPE html>
@@ -336,9 +376,9 @@ def generate_metrics_html(stats: dict, time_series_data: dict) -> str:
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <title>水やり メトリクス ダッシュボード</title>
     <link rel="icon" type="image/x-icon" href="{favicon_path}">
-    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bulma@0.9.4/css/bulma.min.css">
-    <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
+    <link rel="stylesheet" href="{asset.url_for("bulma", "css/bulma.min.css")}">
+    <script src="{asset.url_for("chartjs", "chart.umd.min.js")}"></script>
+    <link rel="stylesheet" href="{asset.url_for("fontawesome", "css/all.min.css")}">
     <style>
         .metrics-card {{ margin-bottom: 1rem; }}
         @media (max-width: 768px) {{
@@ -386,10 +426,16 @@ def generate_metrics_html(stats: dict, time_series_data: dict) -> str:
                     <span class="icon is-large"><i class="fas fa-tint"></i></span>
                     水やり メトリクス ダッシュボード
                 </h1>
-                <p class="subtitle has-text-centered">過去30日間の水やり統計</p>
+                <p class="subtitle has-text-centered" id="period-label">読み込み中...</p>
+
+                <!-- 期間指定 -->
+                {generate_period_form_section()}
 
                 <!-- 基本統計 -->
-                {generate_basic_stats_section(stats)}
+                {generate_basic_stats_section()}
+
+                <!-- スケジュール実行の遅延 -->
+                {generate_schedule_lateness_section()}
 
                 <!-- 日別時系列分析 -->
                 {generate_daily_time_series_section()}
@@ -404,29 +450,48 @@ def generate_metrics_html(stats: dict, time_series_data: dict) -> str:
     </div>
 
     <script>
-        const chartData = {chart_data_json};
+        const dataPath = "{data_path}";
+        const defaultPeriodDays = {DEFAULT_PERIOD_DAYS};
+        let chartData = {{}};
 
-        // チャート生成
-        generateDailyCharts();
-        generateWeeklyCharts();
-        generateFlowChart();
+        // データを取得してチャート生成
+        loadMetrics();
 
         // パーマリンク機能を初期化
         initializePermalinks();
 
+        {generate_data_javascript()}
+
         {generate_chart_javascript()}
     </script>
 </html>
     """
 
 
-def generate_basic_stats_section(stats: dict) -> str:
+def generate_period_form_section() -> str:
+    """期間指定フォームのHTML生成"""
+    return """
+    <form class="field is-grouped is-grouped-centered" method="get">
+        <p class="control">
+            <input class="input" type="date" name="from" id="period-from">
+        </p>
+        <p class="control">
+            <input class="input" type="date" name="to" id="period-to">
+        </p>
+        <p class="control">
+            <button class="button is-info" type="submit">表示</button>
+        </p>
+    </form>
+    """
+
+
+def generate_basic_stats_section() -> str:
     """基本統計セクションのHTML生成"""
-    return f"""
+    return """
     <div class="section">
         <h2 class="title is-4 permalink-header" id="basic-stats">
             <span class="icon"><i class="fas fa-chart-bar"></i></span>
-            基本統計（過去30日間）
+            基本統計
             <span class="permalink-icon" onclick="copyPermalink('basic-stats')">
                 <i class="fas fa-link"></i>
             </span>
@@ -443,55 +508,58 @@ def generate_basic_stats_section(stats: dict) -> str:
                             <div class="column is-one-third">
                                 <div class="has-text-centered">
                                     <p class="heading">総水やり回数</p>
-                                    <p class="stat-number has-text-primary">{stats["total_watering_count"]:,}</p>
+                                    <p class="stat-number has-text-primary"
+                                       id="stat-total-watering-count">-</p>
                                 </div>
                             </div>
                             <div class="column is-one-third">
                                 <div class="has-text-centered">
                                     <p class="heading">🔧 手動水やり</p>
-                                    <p class="stat-number has-text-info">{stats["manual_watering_count"]:,}</p>
+                                    <p class="stat-number has-text-info" id="stat-manual-watering-count">-</p>
                                 </div>
                             </div>
                             <div class="column is-one-third">
                                 <div class="has-text-centered">
                                     <p class="heading">🤖 自動水やり</p>
-                                    <p class="stat-number has-text-success">{stats["auto_watering_count"]:,}</p>
+                                    <p class="stat-number has-text-success"
+                                       id="stat-auto-watering-count">-</p>
                                 </div>
                             </div>
                             <div class="column is-one-third">
                                 <div class="has-text-centered">
                                     <p class="heading">総散水量</p>
-                                    <p class="stat-number has-text-link">{stats["total_volume_liters"]:.1f} L</p>
+                                    <p class="stat-number has-text-link" id="stat-total-volume-liters">-</p>
                                 </div>
                             </div>
                             <div class="column is-one-third">
                                 <div class="has-text-centered">
                                     <p class="heading">総散水時間</p>
-                                    <p class="stat-number has-text-warning">{stats["total_duration_minutes"]:.1f} 分</p>
+                                    <p class="stat-number has-text-warning"
+                                       id="stat-total-duration-minutes">-</p>
                                 </div>
                             </div>
                             <div class="column is-one-third">
                                 <div class="has-text-centered">
                                     <p class="heading">エラー回数</p>
-                                    <p class="stat-number has-text-danger">{stats["error_count"]:,}</p>
+                                    <p class="stat-number has-text-danger" id="stat-error-count">-</p>
                                 </div>
                             </div>
                             <div class="column is-one-third">
                                 <div class="has-text-centered">
                                     <p class="heading">平均散水量/回</p>
-                                    <p class="stat-number">{stats["avg_volume_liters"]:.2f} L</p>
+                                    <p class="stat-number" id="stat-avg-volume-liters">-</p>
                                 </div>
                             </div>
                             <div class="column is-one-third">
                                 <div class="has-text-centered">
                                     <p class="heading">平均散水時間/回</p>
-                                    <p class="stat-number">{stats["avg_duration_minutes"]:.1f} 分</p>
+                                    <p class="stat-number" id="stat-avg-duration-minutes">-</p>
                                 </div>
                             </div>
                             <div class="column is-one-third">
                                 <div class="has-text-centered">
                                     <p class="heading">平均流量</p>
-                                    <p class="stat-number">{stats["avg_flow_rate"]:.3f} L/秒</p>
+                                    <p class="stat-number" id="stat-avg-flow-rate">-</p>
                                 </div>
                             </div>
                         </div>
@@ -503,6 +571,80 @@ def generate_basic_stats_section(stats: dict) -> str:
     """
 
 
+def generate_schedule_lateness_section() -> str:
+    """スケジュール実行の遅延セクションのHTML生成"""
+    return """
+    <div class="section">
+        <h2 class="title is-4 permalink-header" id="schedule-lateness">
+            <span class="icon"><i class="fas fa-stopwatch"></i></span>
+            スケジュール実行の遅延
+            <span class="permalink-icon" onclick="copyPermalink('schedule-lateness')">
+                <i class="fas fa-link"></i>
+            </span>
+        </h2>
+
+        <div class="columns">
+            <div class="column">
+                <div class="card metrics-card">
+                    <div class="card-header">
+                        <p class="card-header-title">予定時刻からの遅延</p>
+                    </div>
+                    <div class="card-content">
+                        <div class="columns is-multiline">
+                            <div class="column is-one-third">
+                                <div class="has-text-centered">
+                                    <p class="heading">実行回数 (開始 / 見合わせ / 失敗)</p>
+                                    <p class="stat-number has-text-primary" id="stat-schedule-count">-</p>
+                                </div>
+                            </div>
+                            <div class="column is-one-third">
+                                <div class="has-text-centered">
+                                    <p class="heading" id="stat-schedule-slo-label">目標内の割合</p>
+                                    <p class="stat-number has-text-success" id="stat-schedule-slo">-</p>
+                                </div>
+                            </div>
+                            <div class="column is-one-third">
+                                <div class="has-text-centered">
+                                    <p class="heading">最大遅延 (バルブを開くまで)</p>
+                                    <p class="stat-number has-text-danger" id="stat-schedule-max">-</p>
+                                </div>
+                            </div>
+                        </div>
+                        <table class="table is-fullwidth is-striped">
+                            <thead>
+                                <tr>
+                                    <th></th>
+                                    <th class="has-text-right">p50</th>
+                                    <th class="has-text-right">p90</th>
+                                    <th class="has-text-right">p99</th>
+                                    <th class="has-text-right">最大</th>
+                                </tr>
+                            </thead>
+                            <tbody>
+                                <tr id="stat-schedule-dispatch-delay">
+                                    <th>実行の開始まで</th>
+                                    <td class="has-text-right">-</td>
+                                    <td class="has-text-right">-</td>
+                                    <td class="has-text-right">-</td>
+                                    <td class="has-text-right">-</td>
+                                </tr>
+                                <tr id="stat-schedule-open-delay">
+                                    <th>バルブを開くまで</th>
+                                    <td class="has-text-right">-</td>
+                                    <td class="has-text-right">-</td>
+                                    <td class="has-text-right">-</td>
+                                    <td class="has-text-right">-</td>
+                                </tr>
+                            </tbody>
+                        </table>
+                    </div>
+                </div>
+            </div>
+        </div>
+    </div>
+    """
+
+
 def generate_daily_time_series_section() -> str:
     """日別時系列分析セクションのHTML生成"""
     return """
@@ -705,6 +847,107 @@ def generate_flow_analysis_section() -> str:
     """
 
 
+def generate_data_javascript() -> str:
+    """データ取得用JavaScriptを生成"""
+    return """
+        function formatDate(date) {
+            return date.getFullYear() + '-' +
+                String(date.getMonth() + 1).padStart(2, '0') + '-' +
+                String(date.getDate()).padStart(2, '0');
+        }
+
+        function getPeriod() {
+            // NOTE: 期間は URL のクエリで指定する (パーマリンクでも同じ期間を表示できるように)
+            const params = new URLSearchParams(window.location.search);
+            const to = params.get('to') || formatDate(new Date());
+            const toDate = new Date(to + 'T00:00:00');
+            toDate.setDate(toDate.getDate() - defaultPeriodDays);
+            const from = params.get('from') || formatDate(toDate);
+
+            return { from: from, to: to };
+        }
+
+        function fetchMetrics(period, resolution) {
+            const query = new URLSearchParams({ from: period.from, to: period.to, resolution: resolution });
+            return fetch(dataPath + '?' + query.toString()).then((res) => {
+                if (!res.ok) {
+                    throw new Error(res.status + ' ' + res.statusText);
+                }
+                return res.json();
+            });
+        }
+
+        function loadMetrics() {
+            const period = getPeriod();
+            document.getElementById('period-from').value = period.from;
+            document.getElementById('period-to').value = period.to;
+
+            Promise.all([
+                fetchMetrics(period, 'day'),
+                fetchMetrics(period, 'week'),
+                fetchMetrics(period, 'watering')
+            ]).then(([daily, weekly, watering]) => {
+                document.getElementById('period-label').textContent =
+                    daily.from + ' 〜 ' + daily.to + ' の水やり統計';
+                updateBasicStats(daily.summary);
+                updateScheduleStats(daily.summary.schedule);
+
+                chartData = {
+                    daily: daily.series,
+                    weekly: Object.assign({}, weekly.series, {
+                        labels: weekly.series.labels.map((label) => label + '週')
+                    }),
+                    flow: watering.series
+                };
+
+                // チャート生成
+                generateDailyCharts();
+                generateWeeklyCharts();
+                generateFlowChart();
+            }).catch((error) => {
+                document.getElementById('period-label').textContent =
+                    'データの取得に失敗しました: ' + error.message;
+            });
+        }
+
+        function updateBasicStats(summary) {
+            const setStat = (id, text) => {
+                document.getElementById(id).textContent = text;
+            };
+
+            setStat('stat-total-watering-count', summary.total_watering_count.toLocaleString());
+            setStat('stat-manual-watering-count', summary.manual_watering_count.toLocaleString());
+            setStat('stat-auto-watering-count', summary.auto_watering_count.toLocaleString());
+            setStat('stat-total-volume-liters', summary.total_volume_liters.toFixed(1) + ' L');
+            setStat('stat-total-duration-minutes', summary.total_duration_minutes.toFixed(1) + ' 分');
+            setStat('stat-error-count', summary.error_count.toLocaleString());
+            setStat('stat-avg-volume-liters', summary.avg_volume_liters.toFixed(2) + ' L');
+            setStat('stat-avg-duration-minutes', summary.avg_duration_minutes.toFixed(1) + ' 分');
+            setStat('stat-avg-flow-rate', summary.avg_flow_rate.toFixed(3) + ' L/秒');
+        }
+
+        function updateScheduleStats(schedule) {
+            const formatSec = (sec) => (sec === null ? '-' : sec.toFixed(2) + ' 秒');
+
+            document.getElementById('stat-schedule-count').textContent =
+                schedule.open_count + ' / ' + schedule.skip_count + ' / ' + schedule.fail_count;
+            document.getElementById('stat-schedule-slo-label').textContent =
+                schedule.slo_sec + ' 秒以内に開始した割合';
+            document.getElementById('stat-schedule-slo').textContent =
+                schedule.slo_met_ratio === null ? '-' : (schedule.slo_met_ratio * 100).toFixed(1) + ' %';
+            document.getElementById('stat-schedule-max').textContent = formatSec(schedule.open_delay.max_sec);
+
+            [['stat-schedule-dispatch-delay', schedule.dispatch_delay],
+             ['stat-schedule-open-delay', schedule.open_delay]].forEach(([id, delay]) => {
+                const cellList = document.getElementById(id).querySelectorAll('td');
+                [delay.p50_sec, delay.p90_sec, delay.p99_sec, delay.max_sec].forEach((sec, i) => {
+                    cellList[i].textContent = formatSec(sec);
+                });
+            });
+        }
+    """
+
+
 def generate_chart_javascript() -> str:
     """チャート生成用JavaScriptを生成"""
     return """
@@ -721,7 +964,8 @@ def generate_chart_javascript() -> str:
         }
 
         function copyPermalink(sectionId) {
-            const url = window.location.origin + window.location.pathname + '#' + sectionId;
+            const url =
+                window.location.origin + window.location.pathname + window.location.search + '#' + sectionId;
 
             // Clipboard APIを使用してURLをコピー
             if (navigator.clipboard && window.isSecureContext) {
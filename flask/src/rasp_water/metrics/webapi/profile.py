@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+全てのスレッドのスタックをサンプリングして、flamegraph 用の collapsed stack 形式で返します。
+
+デバッグ用の機能なので、設定ファイルで metrics.profiler.enable を true にした場合か、
+デバッグモードで動作している場合にだけ有効になります。
+"""
+
+from __future__ import annotations
+
+import math
+
+import my_lib.webapp.config
+import rasp_water.metrics.profiler
+
+import flask
+
+blueprint = flask.Blueprint("metrics-profile", __name__, url_prefix=my_lib.webapp.config.URL_PREFIX)
+
+DEFAULT_DURATION_SEC = 5
+DEFAULT_INTERVAL_MSEC = 10
+
+
+@blueprint.route("/api/metrics/profile", methods=["GET"])
+def metrics_profile():
+    """
+    スタックをサンプリング
+
+    クエリパラメータ:
+        seconds: サンプリングする時間 [秒] (省略時は 5 秒、最大 60 秒)
+        interval: サンプリングの間隔 [ミリ秒] (省略時は 10 ミリ秒)
+    """
+    config = flask.current_app.config["CONFIG"]
+    if not (config.get("metrics", {}).get("profiler", {}).get("enable", False) or flask.current_app.debug):
+        flask.abort(404)
+
+    try:
+        duration_sec = float(flask.request.args.get("seconds", DEFAULT_DURATION_SEC))
+        interval_sec = float(flask.request.args.get("interval", DEFAULT_INTERVAL_MSEC)) / 1000
+    except ValueError:
+        return flask.jsonify({"error": "seconds と interval は数値で指定してください"}), 400
+
+    # NOTE: NaN や無限大を渡されると、終わらないか休まずに回り続けるので弾く
+    if not all(math.isfinite(value) and (value > 0) for value in [duration_sec, interval_sec]):
+        return flask.jsonify({"error": "seconds と interval は正の値で指定してください"}), 400
+
+    duration_sec = min(duration_sec, rasp_water.metrics.profiler.MAX_DURATION_SEC)
+
+    try:
+        result = rasp_water.metrics.profiler.sample(duration_sec, interval_sec)
+    except rasp_water.metrics.profiler.BusyError:
+        return flask.jsonify({"error": "他のサンプリングを実行中です"}), 409
+
+    res = flask.Response(rasp_water.metrics.profiler.format_collapsed(result["stack"]), mimetype="text/plain")
+    res.headers["X-Sample-Count"] = str(result["sample_count"])
+    res.headers["Cache-Control"] = "no-store"
+
+    return res
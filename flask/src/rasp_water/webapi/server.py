@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+本番用の WSGI サーバです。
+
+HTTP の処理 (持続的接続 (keep-alive) や chunked 転送、止まった接続の切断) は Waitress に任せ、
+アプリの呼び出しを以下のように管理します。
+- 決まった数のスレッドでリクエストを処理するので、アクセスが集中してもバルブの制御などのスレッドを妨げない
+- 処理が DEADLINE_SEC 秒で終わらないリクエストには 503 を返し、処理中のスレッドは新しいスレッドで置き換える
+- /api/event (Server-Sent Events) のように接続したまま応答を送り続けるリクエストや、
+  /api/metrics/profile のように時間がかかるリクエストは、上記とは別のスレッドで処理する
+  (同時に STREAM_COUNT 個まで)
+
+Usage:
+  server.py [-p PORT] [-t COUNT] [-D]
+
+Options:
+  -p PORT           : WEB サーバのポートを指定します。[default: 5000]
+  -t COUNT          : リクエストを処理するスレッドの数を指定します。[default: 32]
+  -D                : デバッグモードで動作します。
+"""
+
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+
+import waitress
+import werkzeug.exceptions
+import werkzeug.wsgi
+
+THREAD_COUNT = 32
+# NOTE: リクエストの受信や応答の送信が、この時間進まない場合は接続を切断する (次のリクエストを待つ場合も含む)
+TIMEOUT_SEC = 10
+# NOTE: リクエストの処理がこの時間で終わらない場合は、503 を返す
+DEADLINE_SEC = 10
+# NOTE: 同時に処理する、応答を送り続けるリクエストの最大数 (超えた場合は 503 を返す)
+STREAM_COUNT = 32
+
+# NOTE: EventSource はこの Accept ヘッダを付けて接続する
+STREAM_ACCEPT = "text/event-stream"
+# NOTE: 処理に時間がかかるので、応答を送り続けるリクエストと同じように扱うパス
+STREAM_PATH_LIST = ["/api/metrics/profile"]
+
+
+class DeadlineError(Exception):
+    pass
+
+
+class Task:
+    def __init__(self, func):
+        self.func = func
+        self.lock = threading.Lock()
+        self.done_event = threading.Event()
+        self.is_started = False
+        self.is_abandoned = False
+        self.result = None
+        self.error = None
+
+
+class WorkerPool:
+    """決まった数のスレッドで処理を行い、期限を過ぎても終わらない処理のスレッドは置き換えるスレッドプール"""
+
+    def __init__(self, thread_count):
+        self.thread_count = thread_count
+        self.task_queue = queue.SimpleQueue()
+
+        self.serial_lock = threading.Lock()
+        self.serial = 0
+
+        for _ in range(thread_count):
+            self.start_thread()
+
+    def start_thread(self):
+        with self.serial_lock:
+            name = f"http_worker_{self.serial}"
+            self.serial += 1
+
+        threading.Thread(target=self.worker, name=name, daemon=True).start()
+
+    def worker(self):
+        while True:
+            task = self.task_queue.get()
+            if task is None:
+                return
+
+            with task.lock:
+                if task.is_abandoned:
+                    continue
+                task.is_started = True
+
+            try:
+                task.result = task.func()
+            except Exception as e:
+                task.error = e
+
+            with task.lock:
+                task.done_event.set()
+                is_abandoned = task.is_abandoned
+
+            # NOTE: 期限を過ぎた処理のスレッドは既に置き換えられているので、終了する
+            if is_abandoned:
+                return
+
+    def run(self, func, deadline_sec):
+        """
+        プールのスレッドで関数を実行し、結果を返す
+
+        Args:
+        ----
+            func: 実行する関数
+            deadline_sec: 待つ時間 [秒] (超えた場合は DeadlineError を送出する)
+
+        """
+        task = Task(func)
+        self.task_queue.put(task)
+
+        if not task.done_event.wait(deadline_sec):
+            with task.lock:
+                if not task.done_event.is_set():
+                    task.is_abandoned = True
+                    # NOTE: 処理中のスレッドは返ってこないかもしれないので、代わりのスレッドを起動する
+                    if task.is_started:
+                        self.start_thread()
+                    raise DeadlineError
+
+        if task.error is not None:
+            raise task.error
+
+        return task.result
+
+    def shutdown(self):
+        for _ in range(self.thread_count):
+            self.task_queue.put(None)
+
+
+class PooledApp:
+    """アプリの呼び出しを、リクエストの種類に応じたスレッドで、期限や上限を設けて行う WSGI アプリ"""
+
+    def __init__(
+        self,
+        app,
+        thread_count=THREAD_COUNT,
+        deadline_sec=DEADLINE_SEC,
+        stream_count=STREAM_COUNT,
+    ):
+        self.app = app
+        self.deadline_sec = deadline_sec
+        self.pool = WorkerPool(thread_count)
+        self.stream_semaphore = threading.BoundedSemaphore(stream_count)
+
+    def __call__(self, environ, start_response):
+        if self.is_stream(environ):
+            return self.call_stream(environ, start_response)
+
+        try:
+            status, header_list, body = self.pool.run(lambda: self.call_app(environ), self.deadline_sec)
+        except DeadlineError:
+            logging.warning("Request exceeded the deadline: %s", environ["PATH_INFO"])
+            return werkzeug.exceptions.ServiceUnavailable()(environ, start_response)
+
+        start_response(status, header_list)
+
+        return [body]
+
+    def is_stream(self, environ):
+        return (STREAM_ACCEPT in environ.get("HTTP_ACCEPT", "")) or any(
+            environ["PATH_INFO"].endswith(path) for path in STREAM_PATH_LIST
+        )
+
+    def call_app(self, environ):
+        # NOTE: 期限内に処理を終えたかどうかを判断できるように、応答は全て揃えてから返す
+        response = {}
+        chunk_list = []
+
+        def start_response(status, header_list, exc_info=None):  # noqa: ARG001
+            # NOTE: まだ何も送っていないので、exc_info があっても応答を差し替えるだけでよい
+            response["status"] = status
+            response["header_list"] = header_list
+
+            return chunk_list.append
+
+        application_iter = self.app(environ, start_response)
+        try:
+            chunk_list.extend(application_iter)
+        finally:
+            if hasattr(application_iter, "close"):
+                application_iter.close()
+
+        return (response["status"], response["header_list"], b"".join(chunk_list))
+
+    def call_stream(self, environ, start_response):
+        if not self.stream_semaphore.acquire(blocking=False):
+            logging.warning("Too many streaming requests: %s", environ["PATH_INFO"])
+            return werkzeug.exceptions.ServiceUnavailable()(environ, start_response)
+
+        try:
+            application_iter = self.app(environ, start_response)
+        except Exception:
+            self.stream_semaphore.release()
+            raise
+
+        return werkzeug.wsgi.ClosingIterator(application_iter, self.stream_semaphore.release)
+
+
+def create_server(app, port, config=None, host="0.0.0.0"):  # noqa: S104
+    """設定ファイルの webapp.server に従ってサーバを作成"""
+    server_config = {} if config is None else config["webapp"].get("server", {})
+
+    thread_count = server_config.get("thread_count", THREAD_COUNT)
+    timeout_sec = server_config.get("timeout_sec", TIMEOUT_SEC)
+    deadline_sec = server_config.get("deadline_sec", DEADLINE_SEC)
+    stream_count = server_config.get("stream_count", STREAM_COUNT)
+
+    logging.info(
+        "Start production server on port %d (thread: %d, timeout: %d sec, deadline: %d sec, stream: %d)",
+        port,
+        thread_count,
+        timeout_sec,
+        deadline_sec,
+        stream_count,
+    )
+
+    return waitress.create_server(
+        PooledApp(app, thread_count, deadline_sec, stream_count),
+        host=host,
+        port=port,
+        # NOTE: Waitress のスレッドは、PooledApp の結果を待つものと応答を送り続けるものの両方に使う
+        threads=thread_count + stream_count,
+        channel_timeout=timeout_sec,
+        cleanup_interval=timeout_sec,
+    )
+
+
+if __name__ == "__main__":
+    # TEST Code
+    import docopt
+    import my_lib.logger
+
+    import flask
+
+    args = docopt.docopt(__doc__)
+
+    port = int(args["-p"])
+    thread_count = int(args["-t"])
+    debug_mode = args["-D"]
+
+    my_lib.logger.init("test", level=logging.DEBUG if debug_mode else logging.INFO)
+
+    app = flask.Flask("test")
+
+    @app.route("/")
+    def index():
+        return "OK"
+
+    create_server(app, port, {"webapp": {"server": {"thread_count": thread_count}}}).run()
@@ -74,9 +74,18 @@ def app(config):
 
 
 @pytest.fixture
-def client(app, mocker):
+def client(app, config, mocker, tmp_path):
+    import rasp_water.control.weather_forecast
     import slack_sdk
 
+    # NOTE: 降雨予想のキャッシュやサーキットブレーカーの状態を、前のテストから引き継がない
+    mocker.patch.dict(
+        config["weather"]["rain_fall"]["forecast"],
+        {"cache_file_path": str(tmp_path / "weather_forecast.dat")},
+    )
+    rasp_water.control.weather_forecast.cache_clear()
+    rasp_water.control.weather_forecast.provider_clear()
+
     sender_mock = mocker.MagicMock()
     sender_mock.emit.return_value = True
     sender_mock.close.return_value = True
@@ -595,7 +604,7 @@ def test_valve_ctrl_auto_forecast(client, mocker):
 
 def test_valve_ctrl_auto_forecast_error_1(client, mocker):
     mocker.patch("rasp_water.control.weather_forecast.get_rain_fall", side_effect=get_rain_fall_orig)
-    mocker.patch("rasp_water.control.weather_forecast.get_weather_info_yahoo", return_value=None)
+    mocker.patch("rasp_water.control.weather_forecast.get_weather_info", return_value=None)
 
     period = 2
     response = client.get(
@@ -612,7 +621,7 @@ def test_valve_ctrl_auto_forecast_error_1(client, mocker):
 
     time.sleep(period + 5)
 
-    # NOTE: get_weather_info_yahoo == None の場合、水やりは行う
+    # NOTE: get_weather_info == None の場合、水やりは行う
     ctrl_log_check(
         [{"state": "LOW"}, {"state": "HIGH"}, {"high_period": period, "state": "LOW"}], is_strict=False
     )
@@ -621,13 +630,13 @@ def test_valve_ctrl_auto_forecast_error_1(client, mocker):
 
 
 def test_valve_ctrl_auto_forecast_error_2(client, mocker):
-    import rasp_water.control.weather_forecast
+    import requests
 
     mocker.patch("rasp_water.control.weather_forecast.get_rain_fall", side_effect=get_rain_fall_orig)
 
     response_mock = mocker.Mock()
     response_mock.status_code = 404
-    mocker.patch.object(rasp_water.control.weather_forecast.requests, "get", return_value=response_mock)
+    mocker.patch.object(requests.Session, "get", return_value=response_mock)
 
     period = 2
     response = client.get(
@@ -658,7 +667,7 @@ def test_valve_ctrl_auto_forecast_error_3(client, mocker):
 
     response = requests.models.Response()
     response.status_code = 500
-    mocker.patch("rasp_water.control.weather_forecast.requests.get", return_value=response)
+    mocker.patch.object(requests.Session, "get", return_value=response)
 
     period = 2
     response = client.get(
@@ -683,10 +692,10 @@ def test_valve_ctrl_auto_forecast_error_3(client, mocker):
 
 
 def test_valve_ctrl_auto_forecast_error_4(client, mocker):
-    import rasp_water.control.weather_forecast
+    import requests
 
     mocker.patch("rasp_water.control.weather_forecast.get_rain_fall", side_effect=get_rain_fall_orig)
-    mocker.patch.object(rasp_water.control.weather_forecast.requests, "get", side_effect=RuntimeError())
+    mocker.patch.object(requests.Session, "get", side_effect=RuntimeError())
 
     period = 2
     response = client.get(
@@ -710,6 +719,226 @@ def test_valve_ctrl_auto_forecast_error_4(client, mocker):
     check_notify_slack(None)
 
 
+def test_weather_forecast_cache(config, mocker, tmp_path):
+    import copy
+
+    import my_lib.time
+    import rasp_water.control.weather_forecast
+    import requests
+
+    config = copy.deepcopy(config)
+    config["weather"]["rain_fall"]["forecast"]["cache_file_path"] = str(tmp_path / "weather_forecast.dat")
+
+    rasp_water.control.weather_forecast.cache_clear()
+    rasp_water.control.weather_forecast.provider_clear()
+
+    response = requests.models.Response()
+    response.status_code = 200
+    response._content = json.dumps(
+        {
+            "Feature": [
+                {
+                    "Property": {
+                        "WeatherList": {
+                            "Weather": [
+                                {
+                                    "Type": "observation",
+                                    "Date": my_lib.time.now().strftime("%Y%m%d%H%M"),
+                                    "Rainfall": 1.5,
+                                }
+                            ]
+                        }
+                    }
+                }
+            ]
+        }
+    ).encode()
+    get_mock = mocker.patch.object(requests.Session, "get", return_value=response)
+
+    assert get_rain_fall_orig(config) == (False, 1.5)
+    assert get_rain_fall_orig(config) == (False, 1.5)
+    assert get_mock.call_count == 1
+
+    # NOTE: TTL が切れても、古いデータを返しつつバックグラウンドで更新する
+    mocker.patch("rasp_water.control.weather_forecast.CACHE_TTL_SEC", 0)
+    assert get_rain_fall_orig(config) == (False, 1.5)
+    time.sleep(1)
+    assert get_mock.call_count == 2
+
+    # NOTE: 再起動後に API が落ちていても、保存しておいたデータを使う
+    rasp_water.control.weather_forecast.cache_data = None
+    mocker.patch("rasp_water.control.weather_forecast.CACHE_TTL_SEC", 600)
+    get_mock.side_effect = RuntimeError()
+    assert get_rain_fall_orig(config) == (False, 1.5)
+    assert get_mock.call_count == 2
+
+    # NOTE: 有効期限が切れて取得に失敗しても、古すぎなければ最後に取得できたデータを使う
+    mocker.patch("rasp_water.control.weather_forecast.CACHE_TTL_SEC", 0)
+    mocker.patch("rasp_water.control.weather_forecast.CACHE_EXPIRE_SEC", 0)
+    assert get_rain_fall_orig(config) == (False, 1.5)
+
+    mocker.patch("rasp_water.control.weather_forecast.CACHE_FALLBACK_SEC", 0)
+    assert get_rain_fall_orig(config) == (False, 0)
+
+    rasp_water.control.weather_forecast.cache_clear()
+
+
+def test_forecast_provider():
+    import http.server
+    import threading
+
+    import rasp_water.control.forecast_provider
+
+    request_list = []
+    response_map = {
+        "/yahoo": (
+            200,
+            {
+                "Feature": [
+                    {
+                        "Property": {
+                            "WeatherList": {
+                                "Weather": [
+                                    {"Type": "observation", "Date": "202401010000", "Rainfall": 0.5},
+                                    {"Type": "forecast", "Date": "202401010010", "Rainfall": 1.0},
+                                ]
+                            }
+                        }
+                    }
+                ]
+            },
+        ),
+        "/open_meteo": (
+            200,
+            {"minutely_15": {"time": [1704034800, 1704035700], "precipitation": [0.25, None]}},
+        ),
+        "/dead": (404, {}),
+    }
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            request_list.append(path)
+            status, body = response_map[path]
+            content = json.dumps(body).encode()
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    point = {"lat": 35.68, "lon": 139.73}
+
+    provider_list = rasp_water.control.forecast_provider.create_provider_list(
+        {
+            "yahoo": {"id": "dummy", "endpoint": f"{url}/yahoo"},
+            "open_meteo": {"endpoint": f"{url}/open_meteo"},
+        }
+    )
+    assert [provider.NAME for provider in provider_list] == ["yahoo", "open_meteo"]
+
+    timeline = provider_list[0].fetch(point)
+    assert timeline.provider == "yahoo"
+    assert timeline.rainfall == (0.5, 1.0)
+    assert timeline.time[1] - timeline.time[0] == 600
+
+    timeline = provider_list[1].fetch(point)
+    # NOTE: 15 分毎の降水量は、10 分毎の降水強度に揃えられる
+    assert timeline.provider == "open_meteo"
+    assert timeline.time == (1704034200, 1704034800, 1704035400)
+    assert timeline.rainfall == (1.0, 1.0, 0)
+
+    # NOTE: 失敗が続いたら、サーキットブレーカーが働いてアクセスしなくなる
+    provider = rasp_water.control.forecast_provider.YahooProvider({"id": "dummy", "endpoint": f"{url}/dead"})
+    for _ in range(rasp_water.control.forecast_provider.BREAKER_FAIL_COUNT):
+        assert provider.fetch(point) is None
+    count = len(request_list)
+    assert provider.breaker.is_open()
+    assert provider.fetch(point) is None
+    assert len(request_list) == count
+
+    # NOTE: 一定時間経過したら、1 回だけお試しで通す
+    provider.breaker.open_time -= rasp_water.control.forecast_provider.BREAKER_RESET_SEC
+    assert not provider.breaker.is_open()
+    assert provider.breaker.is_open()
+    provider.breaker.record_failure()
+    assert provider.breaker.is_open()
+
+    # NOTE: get_params と parse を実装していないプロバイダは作成できない
+    class IncompleteProvider(rasp_water.control.forecast_provider.ForecastProvider):
+        NAME = "incomplete"
+
+        def get_params(self, point):
+            return {"lat": point["lat"], "lon": point["lon"]}
+
+    with pytest.raises(TypeError):
+        IncompleteProvider({})
+
+    for provider in provider_list:
+        provider.close()
+    server.shutdown()
+
+
+def test_rain_fall_cache(config, mocker, tmp_path):
+    import rasp_water.control.rain_fall_cache
+
+    HOUR_SEC = rasp_water.control.rain_fall_cache.HOUR_SEC
+
+    query_list = []
+    # NOTE: 指定が無い時間の雨量は 1.0
+    value_map = {}
+
+    def query_mock(self, start, stop):  # noqa: ARG001
+        query_list.append((start, stop))
+        return [(hour, value_map.get(hour, 1.0)) for hour in range(start, int(stop), HOUR_SEC)]
+
+    mocker.patch.object(rasp_water.control.rain_fall_cache.RainFallCache, "_query", new=query_mock)
+
+    cache = rasp_water.control.rain_fall_cache.RainFallCache(
+        tmp_path / "rain_fall.db",
+        config["influxdb"],
+        config["weather"]["rain_fall"]["sensor"]["measure"],
+        config["weather"]["rain_fall"]["sensor"]["hostname"],
+    )
+
+    REFRESH_HOURS = rasp_water.control.rain_fall_cache.REFRESH_HOURS
+
+    hour = 1704034800
+    now = hour + 30 * 60
+    # NOTE: 直近 hours 時間を含むように、完了した hours 時間分と現在の時間を合計する
+    assert cache.get_sum(3, now) == 4.0
+    assert cache.get_sum(24, now) == 25.0
+    assert cache.get_high_water_mark() == hour - HOUR_SEC
+
+    # NOTE: 2 回目以降は、キャッシュ済みの時間より新しい分と、直近 REFRESH_HOURS 時間分だけを取得する
+    assert query_list[-1][0] == hour - REFRESH_HOURS * HOUR_SEC
+
+    # NOTE: 正時の直後でも、直前の 1 時間分の雨量が含まれる
+    assert cache.get_sum(1, hour + 60) == 2.0
+
+    # NOTE: 遅れて届いたデータは、次の更新で反映される
+    value_map[hour - HOUR_SEC] = 5.0
+    assert cache.get_sum(1, now) == 6.0
+
+    hour += HOUR_SEC
+    now += HOUR_SEC
+    assert cache.get_sum(3, now) == 8.0
+    assert query_list[-1][0] == hour - REFRESH_HOURS * HOUR_SEC
+
+    # NOTE: InfluxDB にアクセスできない場合は、キャッシュ済みの値を使う
+    mocker.patch.object(
+        rasp_water.control.rain_fall_cache.RainFallCache, "_query", side_effect=RuntimeError()
+    )
+    assert cache.get_sum(3, now) == 7.0
+
+
 def test_valve_flow(client):
     response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/api/valve_flow")
     assert response.status_code == 200
@@ -1428,6 +1657,942 @@ def test_memory(client):
     assert "memory" in response.json
 
 
+def test_metrics_collector_writer(tmp_path):
+    import rasp_water.metrics.collector
+
+    collector = rasp_water.metrics.collector.MetricsCollector(tmp_path / "metrics.db")
+
+    count = rasp_water.metrics.collector.WRITE_BATCH_SIZE * 2 + 1
+    for _ in range(count):
+        collector.record_watering("auto", 60, 10.0)
+    collector.record_error("valve_control", "ERROR")
+    collector.flush()
+
+    stat = collector.get_writer_stat()
+    assert stat["queue_depth"] == 0
+    assert stat["commit_row_count"] == count + 1
+    assert stat["commit_count"] < count
+
+    assert len(collector.get_recent_watering_metrics()) == count
+    assert len(collector.get_recent_error_metrics()) == 1
+
+    # NOTE: 終了時にキューに残っているデータも書き込まれる
+    collector.record_watering("manual", 30, 5.0)
+    collector.term()
+    assert len(collector.get_recent_watering_metrics()) == count + 1
+
+    collector.close()
+
+
+def test_metrics_collector_rollup(tmp_path):
+    import rasp_water.metrics.collector
+
+    collector = rasp_water.metrics.collector.MetricsCollector(tmp_path / "metrics.db", async_write=False)
+
+    # NOTE: 2025-01-05 は日曜日、2025-01-06 は月曜日
+    collector.record_watering("auto", 60, 10.0, datetime.datetime(2025, 1, 5, 6, 0))
+    collector.record_watering("manual", 30, None, datetime.datetime(2025, 1, 5, 18, 0))
+    collector.record_watering("auto", 90, 4.0, datetime.datetime(2025, 1, 6, 6, 0))
+
+    summary = collector.get_daily_summary("2025-01-05")["watering"]
+    assert summary["total_count"] == 2
+    assert summary["manual_count"] == 1
+    assert summary["auto_count"] == 1
+    assert summary["total_duration_seconds"] == 90
+    assert summary["total_volume_liters"] == 10.0
+    assert summary["avg_duration_seconds"] == 45
+    assert summary["avg_volume_liters"] == 10.0
+    assert summary["min_duration_seconds"] == 30
+    assert summary["max_volume_liters"] == 10.0
+
+    assert collector.get_daily_summary("2025-01-07")["watering"]["total_count"] == 0
+
+    weekly = collector.get_weekly_rollup("2024-12-01", "2025-01-31")
+    assert [row["week_start"] for row in weekly] == ["2024-12-30", "2025-01-06"]
+    assert [row["count"] for row in weekly] == [2, 1]
+    assert weekly[1]["min_volume_liters"] == 4.0
+
+    daily = collector.get_daily_rollup("2025-01-01", "2025-01-31")
+    collector.rebuild_rollup()
+    assert collector.get_daily_rollup("2025-01-01", "2025-01-31") == daily
+    assert collector.get_weekly_rollup("2024-12-01", "2025-01-31") == weekly
+
+    collector.close()
+
+
+def test_metrics_collector_retention(tmp_path):
+    import rasp_water.metrics.collector
+
+    db_path = tmp_path / "metrics.db"
+    collector = rasp_water.metrics.collector.MetricsCollector(db_path, async_write=False, retention_days=30)
+
+    old = datetime.datetime.now() - datetime.timedelta(days=60)
+    for i in range(rasp_water.metrics.collector.RETENTION_BATCH_SIZE + 10):
+        collector.record_watering("auto", 60, 10.0, old + datetime.timedelta(minutes=i))
+        collector.record_error("valve_control", f"{i:04d}" + "x" * 1000, old + datetime.timedelta(minutes=i))
+    collector.record_watering("manual", 30, 5.0)
+    collector.record_schedule(old, old, old + datetime.timedelta(seconds=1), 60, "open")
+
+    conn = collector._get_connection()
+    assert (
+        conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        == rasp_water.metrics.collector.AUTO_VACUUM_INCREMENTAL
+    )
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+
+    assert collector.maintain()
+
+    # NOTE: 生データは削除され、集計値は残る
+    assert len(collector.get_watering_metrics("0001-01-01", "9999-12-31")) == 1
+    assert len(collector.get_error_metrics("0001-01-01", "9999-12-31")) == 0
+    assert collector.get_daily_summary(old.date().isoformat())["watering"]["total_count"] > 0
+    assert collector.get_statistics("0001-01-01", "9999-12-31")["error_count"] == (
+        rasp_water.metrics.collector.RETENTION_BATCH_SIZE + 10
+    )
+
+    # NOTE: スケジュール実行の遅延は集計値にまとめられないので、削除しない
+    assert collector.get_schedule_statistics("0001-01-01", "9999-12-31")["count"] == 1
+
+    # NOTE: 空いた領域は解放される
+    assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    assert conn.execute("PRAGMA page_count").fetchone()[0] < page_count
+
+    # NOTE: 再構築しても、削除済みの日の集計値は残る
+    collector.rebuild_rollup()
+    assert collector.get_daily_summary(old.date().isoformat())["watering"]["total_count"] > 0
+    assert collector.get_daily_summary(old.date().isoformat())["errors"]["error_count"] > 0
+    assert sum(row["count"] for row in collector.get_weekly_rollup("0001-01-01", "9999-12-31")) == (
+        rasp_water.metrics.collector.RETENTION_BATCH_SIZE + 11
+    )
+
+    collector.close()
+
+
+def test_metrics_collector_migration(tmp_path, mocker):
+    import sqlite3
+
+    import rasp_water.metrics.collector
+    import rasp_water.metrics.migration
+
+    # NOTE: バージョン管理を導入する前のスキーマで、データを記録しておく
+    db_path = tmp_path / "metrics.db"
+    timestamp = datetime.datetime(2025, 1, 6, 7, 0, 0)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("""
+            CREATE TABLE watering_metrics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TIMESTAMP NOT NULL,
+                date TEXT NOT NULL,
+                operation_type TEXT NOT NULL CHECK (operation_type IN ('manual', 'auto')),
+                duration_seconds INTEGER NOT NULL,
+                volume_liters REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE error_metrics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT NOT NULL,
+                error_type TEXT NOT NULL,
+                error_message TEXT,
+                timestamp TIMESTAMP NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO watering_metrics (timestamp, date, operation_type, duration_seconds, volume_liters) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (str(timestamp + datetime.timedelta(minutes=i)), "2025-01-06", "auto", 60, 10.0)
+                for i in range(5)
+            ],
+        )
+        conn.execute(
+            "INSERT INTO error_metrics (date, error_type, error_message, timestamp) VALUES (?, ?, ?, ?)",
+            ("2025-01-06", "valve_control", "test", str(timestamp)),
+        )
+        # NOTE: UNIX 時間に変換できない行があっても、マイグレーションは終わる
+        conn.execute(
+            "INSERT INTO watering_metrics (timestamp, date, operation_type, duration_seconds, volume_liters) "
+            "VALUES (?, ?, ?, ?, ?)",
+            ("invalid", "2025-01-05", "auto", 60, 10.0),
+        )
+    conn.close()
+
+    # NOTE: 少しずつ書き換えられることを確認する
+    mocker.patch("rasp_water.metrics.migration.MIGRATE_BATCH_SIZE", 2)
+
+    collector = rasp_water.metrics.collector.MetricsCollector(db_path, async_write=False)
+    conn = collector._get_connection()
+
+    assert rasp_water.metrics.migration.get_version(conn) == rasp_water.metrics.migration.SCHEMA_VERSION
+    assert conn.execute("SELECT COUNT(*) FROM watering_metrics WHERE ts IS NULL").fetchone()[0] == 1
+    assert conn.execute("SELECT MIN(ts) FROM watering_metrics").fetchone()[0] == int(timestamp.timestamp())
+
+    index_list = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+    assert "idx_watering_metrics_ts" in index_list
+    assert "idx_watering_metrics_date" in index_list
+    assert "idx_watering_metrics_type" not in index_list
+
+    # NOTE: 既存のデータは集計され、期間の検索にも使われる
+    assert collector.get_daily_summary("2025-01-06")["watering"]["total_count"] == 5
+    assert collector.get_statistics("2025-01-06", "2025-01-06")["error_count"] == 1
+    assert len(collector.get_watering_metrics("2025-01-06", "2025-01-06")) == 5
+    assert collector.get_flow_series("2025-01-06", "2025-01-06")["label"][0] == int(timestamp.timestamp())
+
+    collector.record_watering("manual", 30, 5.0, timestamp + datetime.timedelta(days=1))
+    assert len(collector.get_watering_metrics("2025-01-07", "2025-01-07")) == 1
+
+    collector.close()
+
+    # NOTE: 2 回目以降は何もしない
+    collector = rasp_water.metrics.collector.MetricsCollector(db_path, async_write=False)
+    assert len(collector.get_watering_metrics("0001-01-01", "9999-12-31")) == 6
+    collector.close()
+
+
+def test_metrics_collector_error_coalesce(tmp_path):
+    import rasp_water.metrics.collector
+
+    timestamp = datetime.datetime.now().replace(microsecond=0)
+    window = datetime.timedelta(seconds=rasp_water.metrics.collector.ERROR_COALESCE_SEC)
+
+    for async_write in [False, True]:
+        db_path = tmp_path / f"metrics_{async_write}.db"
+        collector = rasp_water.metrics.collector.MetricsCollector(db_path, async_write=async_write)
+
+        assert collector.record_error("valve_control", "ERROR", timestamp)
+        for i in range(1, 10):
+            assert not collector.record_error(
+                "valve_control", "ERROR", timestamp + datetime.timedelta(seconds=i)
+            )
+        # NOTE: メッセージが異なるもの、期間を過ぎたものは別の行になる
+        assert collector.record_error("valve_control", "OTHER", timestamp)
+        assert collector.record_error("valve_control", "ERROR", timestamp + window)
+        assert not collector.record_error("valve_control", "ERROR", timestamp + window)
+        collector.flush()
+
+        row_list = collector.get_error_metrics("0001-01-01", "9999-12-31")
+        assert [(row["error_message"], row["count"]) for row in row_list] == [
+            ("ERROR", 10),
+            ("OTHER", 1),
+            ("ERROR", 2),
+        ]
+        assert row_list[0]["last_ts"] == int((timestamp + datetime.timedelta(seconds=9)).timestamp())
+
+        # NOTE: ダッシュボードの回数は、まとめる前の回数になる
+        end_date = (timestamp + window).date().isoformat()
+        assert collector.get_statistics(timestamp.date().isoformat(), end_date)["error_count"] == 13
+
+        # NOTE: 回数の更新だけでもデータのバージョンは変わり、書き込み前の回数も集計に含まれる
+        version = collector.get_data_version()
+        assert not collector.record_error("valve_control", "ERROR", timestamp + window)
+        assert collector.get_data_version() != version
+        assert collector.get_statistics(timestamp.date().isoformat(), end_date)["error_count"] == 14
+
+        # NOTE: 書き込みが続いている間も、まとめたエラーの回数は次の書き込みと一緒に反映される
+        assert not collector.record_error("valve_control", "ERROR", timestamp + window)
+        collector.record_watering("auto", 60, 10.0, timestamp)
+        if collector.writer is not None:
+            collector.write_queue.join()
+        row_list = collector.get_error_metrics("0001-01-01", "9999-12-31")
+        assert [row["count"] for row in row_list] == [10, 1, 4]
+
+        collector.term()
+        collector.close()
+
+
+def test_metrics_collector_schedule(tmp_path):
+    import rasp_water.metrics.collector
+    import rasp_water.metrics.webapi.page
+
+    collector = rasp_water.metrics.collector.MetricsCollector(tmp_path / "metrics.db", async_write=False)
+
+    planned_time = datetime.datetime(2025, 1, 5, 6, 0)
+    for i, open_delay_sec in enumerate([1, 2, 3, 4, 90]):
+        planned = planned_time + datetime.timedelta(days=i)
+        collector.record_schedule(
+            planned,
+            planned + datetime.timedelta(seconds=0.25),
+            planned + datetime.timedelta(seconds=open_delay_sec),
+            60,
+            "open",
+        )
+    collector.record_schedule(planned_time, planned_time, None, 60, "skip")
+    collector.record_schedule(planned_time, planned_time, None, 60, "fail", retry_count=3)
+
+    stats = collector.get_schedule_statistics("2025-01-01", "2025-01-31")
+    assert stats["count"] == 7
+    assert (stats["open_count"], stats["skip_count"], stats["fail_count"]) == (5, 1, 1)
+    assert stats["open_delay"]["p50_sec"] == 3
+    assert stats["open_delay"]["p99_sec"] == 90
+    assert stats["open_delay"]["max_sec"] == 90
+    assert stats["dispatch_delay"]["p90_sec"] == 0.25
+    # NOTE: 見合わせたものは除き、失敗したものは目標外として数える
+    assert stats["slo_met_ratio"] == 4 / 6
+
+    stats = rasp_water.metrics.webapi.page.generate_statistics(collector, "2024-01-01", "2024-01-31")
+    assert stats["schedule"]["count"] == 0
+    assert stats["schedule"]["open_delay"]["p50_sec"] is None
+    assert stats["schedule"]["slo_met_ratio"] is None
+
+    assert [row[4] for row in next(collector.iter_export("schedule", "2025-01-05", "2025-01-05"))] == [
+        "open",
+        "skip",
+        "fail",
+    ]
+
+    collector.close()
+
+
+def test_schedule_run_pending(mocker):
+    import rasp_water.control.scheduler
+    import schedule
+
+    fire_info_list = []
+    scheduler = schedule.Scheduler()
+    job = scheduler.every().day.at("06:00").do(
+        lambda: fire_info_list.append(rasp_water.control.scheduler.fire_info)
+    )
+    scheduler.every().day.at("06:00").do(lambda: schedule.CancelJob)
+
+    planned_time = datetime.datetime.now() - datetime.timedelta(seconds=5)
+    for entry in scheduler.jobs:
+        entry.next_run = planned_time
+
+    observe_mock = mocker.patch("rasp_water.metrics.registry.SCHEDULER_LATENESS.observe")
+    rasp_water.control.scheduler.run_pending(scheduler)
+
+    assert fire_info_list[0]["planned_time"] == planned_time
+    assert fire_info_list[0]["dispatch_time"] >= planned_time + datetime.timedelta(seconds=5)
+    assert rasp_water.control.scheduler.fire_info is None
+    assert observe_mock.call_count == 2
+    assert observe_mock.call_args_list[0].args[0] >= 5
+    # NOTE: CancelJob を返したジョブは削除される
+    assert scheduler.jobs == [job]
+    assert job.next_run > datetime.datetime.now()
+
+
+def test_metrics_page_aggregation(tmp_path):
+    import rasp_water.metrics.collector
+    import rasp_water.metrics.webapi.page
+
+    collector = rasp_water.metrics.collector.MetricsCollector(tmp_path / "metrics.db", async_write=False)
+
+    collector.record_watering("auto", 60, 12.0, datetime.datetime(2025, 1, 4, 6, 0))
+    collector.record_watering("auto", 60, 10.0, datetime.datetime(2025, 1, 5, 6, 0))
+    collector.record_watering("manual", 30, None, datetime.datetime(2025, 1, 5, 18, 0))
+    collector.record_watering("auto", 90, 4.5, datetime.datetime(2025, 1, 6, 6, 0))
+    collector.record_error("valve_control", "ERROR", datetime.datetime(2025, 1, 6, 7, 0))
+
+    # NOTE: 1/4 は期間外
+    stats = rasp_water.metrics.webapi.page.generate_statistics(collector, "2025-01-05", "2025-01-31")
+    assert stats["total_days"] == 2
+    assert stats["total_watering_count"] == 3
+    assert stats["manual_watering_count"] == 1
+    assert stats["auto_watering_count"] == 2
+    assert stats["total_duration_minutes"] == 3
+    assert stats["total_volume_liters"] == 14.5
+    assert stats["avg_flow_rate"] == 14.5 / 180
+    assert stats["error_count"] == 1
+
+    page = rasp_water.metrics.webapi.page
+    daily = page.prepare_series_data(collector, "2025-01-05", "2025-01-31", "day")
+    assert daily["labels"] == ["2025-01-05", "2025-01-06"]
+    assert daily["counts"] == [2, 1]
+    assert daily["durations"] == [1.5, 1.5]
+
+    weekly = page.prepare_series_data(collector, "2025-01-05", "2025-01-31", "week")
+    assert weekly["labels"] == ["2024-12-30", "2025-01-06"]
+    assert weekly["volumes"] == [10.0, 4.5]
+    assert weekly["manual_counts"] == [1, 0]
+
+    flow = page.prepare_series_data(collector, "2025-01-05", "2025-01-31", "watering")
+    assert flow["rates"] == [10.0 / 60, 4.5 / 90]
+
+    empty = page.prepare_series_data(collector, "2024-01-01", "2024-01-31", "day")
+    assert empty["labels"] == []
+    assert empty["volumes"] == []
+
+    collector.close()
+
+
+def test_metrics_view_cache(client, config):
+    import rasp_water.metrics.collector
+
+    collector = rasp_water.metrics.collector.get_collector(config["metrics"]["data"])
+    collector.record_watering("auto", 60, 10.0)
+    collector.flush()
+
+    # NOTE: ダッシュボードの HTML はデータを含まないので、ブラウザにキャッシュさせる
+    response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/api/metrics")
+    assert response.status_code == 200
+    assert "max-age" in response.headers["Cache-Control"]
+
+    response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/data")
+    assert response.status_code == 200
+    assert response.headers["ETag"] is not None
+    assert response.headers["Last-Modified"] is not None
+    assert response.json["summary"]["total_watering_count"] >= 1
+    assert len(response.json["series"]["labels"]) == len(response.json["series"]["counts"])
+
+    # NOTE: データに変化が無ければ 304
+    response_cached = client.get(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/data",
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+    assert response_cached.status_code == 304
+
+    collector.record_watering("manual", 30, 5.0)
+    collector.flush()
+
+    response_updated = client.get(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/data",
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+    assert response_updated.status_code == 200
+    assert response_updated.headers["ETag"] != response.headers["ETag"]
+
+
+def test_metrics_data_range(client, config):
+    import rasp_water.metrics.collector
+
+    # NOTE: データベースを作成しておく
+    rasp_water.metrics.collector.get_collector(config["metrics"]["data"])
+
+    response = client.get(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/data",
+        query_string={"from": "2024-01-01", "to": "2024-03-31", "resolution": "week"},
+    )
+    assert response.status_code == 200
+    assert response.json["from"] == "2024-01-01"
+    assert response.json["resolution"] == "week"
+
+    response = client.get(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/data", query_string={"resolution": "month"}
+    )
+    assert response.status_code == 400
+
+    response = client.get(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/data", query_string={"from": "2024/01/01"}
+    )
+    assert response.status_code == 400
+
+
+def test_metrics_asset(client, config):
+    import gzip
+
+    import rasp_water.metrics.collector
+
+    rasp_water.metrics.collector.get_collector(config["metrics"]["data"])
+
+    response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/api/metrics")
+    assert response.status_code == 200
+
+    # NOTE: CDN ではなく、同梱したファイルを参照している
+    url_list = re.findall(r'(?:href|src)="([^"]+/api/metrics/vendor/[^"]+)"', response.data.decode())
+    assert len(url_list) == 3
+    assert "cdn" not in response.data.decode()
+
+    for url in url_list:
+        response = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "immutable" in response.headers["Cache-Control"]
+        assert len(gzip.decompress(response.data)) > 0
+
+        response = client.get(url, headers={"Accept-Encoding": "identity"})
+        assert response.status_code == 200
+        assert "Content-Encoding" not in response.headers
+
+    # NOTE: CDN から読み込んでいた時と同じバージョンの Bulma を同梱している
+    bulma_url = next(url for url in url_list if "/bulma." in url)
+    response = client.get(bulma_url, headers={"Accept-Encoding": "identity"})
+    assert response.data.startswith(b"/*! bulma.io v0.9.4 ")
+
+    # NOTE: ハッシュが一致しない場合は 404
+    response = client.get(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/vendor/bulma.0000/css/bulma.min.css"
+    )
+    assert response.status_code == 404
+
+    response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/favicon.ico")
+    assert response.status_code == 200
+    assert response.mimetype == "image/x-icon"
+
+
+def test_metrics_span(client):
+    import rasp_water.metrics.span
+
+    response = client.post(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/span", query_string={"enable": "x"}
+    )
+    assert response.status_code == 400
+
+    response = client.post(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/span", query_string={"enable": "true"}
+    )
+    assert response.status_code == 200
+    assert response.json["enable"]
+
+    for _ in range(10):
+        with rasp_water.metrics.span.span("test.span"):
+            time.sleep(0.001)
+
+    response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/span")
+    stat = response.json["span"]["test.span"]
+    assert stat["count"] == 10
+    assert 0.001 <= stat["avg_sec"] <= stat["p99_sec"] <= stat["max_sec"]
+
+    # NOTE: 無効にすると記録されない
+    response = client.post(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/span", query_string={"enable": "false"}
+    )
+    assert not response.json["enable"]
+
+    with rasp_water.metrics.span.span("test.span"):
+        pass
+    assert rasp_water.metrics.span.get_summary()["test.span"]["count"] == 10
+
+
+def test_metrics_trace(tmp_path):
+    import threading
+
+    import rasp_water.metrics.trace
+
+    rasp_water.metrics.trace.init(
+        {"metrics": {"trace": {"enable": True, "dir": str(tmp_path), "keep_count": 2}}}
+    )
+
+    # NOTE: 記録していない間のスパンは捨てられる
+    with rasp_water.metrics.trace.span("test.ignore"):
+        pass
+
+    for i in range(3):
+        assert rasp_water.metrics.trace.begin("manual", period=60)
+        # NOTE: 記録中は新たに開始しない
+        assert not rasp_water.metrics.trace.begin("auto")
+
+        with rasp_water.metrics.trace.span("test.span", index=i):
+            time.sleep(0.001)
+        worker = threading.Thread(
+            target=rasp_water.metrics.trace.instant, args=("test.instant",), name="test_worker"
+        )
+        worker.start()
+        worker.join()
+
+        path = rasp_water.metrics.trace.end(result="success")
+        assert not rasp_water.metrics.trace.is_active()
+        # NOTE: ファイル名は秒単位なので、ずらしておく
+        time.sleep(1)
+
+    trace = json.loads(path.read_text())
+    event_map = {event["name"]: event for event in trace["traceEvents"]}
+
+    assert event_map["manual"]["args"] == {"period": 60, "result": "success"}
+    assert event_map["test.span"]["ph"] == "X"
+    assert event_map["test.span"]["dur"] >= 1000
+    assert event_map["test.span"]["args"] == {"index": 2}
+    assert event_map["test.instant"]["ph"] == "i"
+    assert "test.ignore" not in event_map
+    assert {event["args"]["name"] for event in trace["traceEvents"] if event["ph"] == "M"} >= {
+        "test_worker"
+    }
+
+    assert len(list(tmp_path.glob("trace_*.json"))) == 2
+
+
+def test_metrics_trace_fail(client, config, mocker, tmp_path):  # noqa: ARG001
+    import rasp_water.control.webapi.valve
+    import rasp_water.metrics.trace
+
+    rasp_water.metrics.trace.init({"metrics": {"trace": {"enable": True, "dir": str(tmp_path)}}})
+    mocker.patch("rasp_water.control.valve.set_control_mode", side_effect=RuntimeError("Test"))
+
+    # NOTE: バルブの操作に失敗しても、記録は終わる
+    with pytest.raises(RuntimeError):
+        rasp_water.control.webapi.valve.set_valve_state(config, 1, 60, False)
+    assert not rasp_water.metrics.trace.is_active()
+
+    trace = json.loads(next(tmp_path.glob("trace_*.json")).read_text())
+    event_map = {event["name"]: event for event in trace["traceEvents"]}
+    assert event_map["manual"]["args"] == {"period": 60, "result": "fail", "message": "Test"}
+
+    rasp_water.metrics.trace.init({})
+
+
+def test_valve_daemon(config, tmp_path):
+    import copy
+    import multiprocessing
+
+    import rasp_water.control.valve
+    import rasp_water.control.valve_daemon
+
+    config = copy.deepcopy(config)
+    config["control"]["daemon"] = {"enable": True}
+    config["metrics"]["trace"] = {"enable": True, "dir": str(tmp_path)}
+
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+    rasp_water.control.valve.init(config, queue)
+
+    try:
+        assert rasp_water.control.valve.get_state() == rasp_water.control.valve.VALVE_STATE.CLOSE
+        assert (
+            rasp_water.control.valve.get_control_mode()["mode"] == rasp_water.control.valve.CONTROL_MODE.IDLE
+        )
+
+        rasp_water.control.valve.set_control_mode(2)
+
+        assert rasp_water.control.valve.get_state() == rasp_water.control.valve.VALVE_STATE.OPEN
+        assert (
+            rasp_water.control.valve.get_control_mode()["mode"] == rasp_water.control.valve.CONTROL_MODE.TIMER
+        )
+        assert rasp_water.control.valve.last_open_time is not None
+
+        # NOTE: 計測中の流量は、デーモンが共有メモリに書き込んだサンプルから返す
+        time.sleep(1)
+        assert len(rasp_water.control.valve.daemon.shared_state.get_sample_list()) != 0
+        assert rasp_water.control.valve.get_flow(config["flow"]["offset"])["result"] == "success"
+
+        trace_event_list = []
+        while True:
+            stat = queue.get(timeout=30)
+            if stat["type"] == "trace":
+                trace_event_list.append(stat["event"])
+            if stat["type"] == "total":
+                break
+
+        # NOTE: デーモンで発生したトレースのイベントは、キューで WEB のプロセスに送られる
+        assert "flow.measure" in {event["name"] for event in trace_event_list}
+        assert rasp_water.control.valve.daemon.process.pid in {event["pid"] for event in trace_event_list}
+
+        assert rasp_water.control.valve.get_state() == rasp_water.control.valve.VALVE_STATE.CLOSE
+        assert (
+            rasp_water.control.valve.get_control_mode()["mode"] == rasp_water.control.valve.CONTROL_MODE.IDLE
+        )
+
+        # NOTE: 計測していない間は、流量の問い合わせが無ければデーモンは流量を読まない
+        daemon = rasp_water.control.valve.daemon
+        time.sleep(rasp_water.control.valve_daemon.SAMPLE_FRESH_SEC)
+        sample_list = daemon.shared_state.get_sample_list(1)
+        time.sleep(1)
+        assert daemon.shared_state.get_sample_list(1) == sample_list
+
+        # NOTE: 問い合わせがあれば、デーモンが読んだ流量を共有メモリから返す
+        assert rasp_water.control.valve.get_flow(config["flow"]["offset"])["result"] == "success"
+    finally:
+        rasp_water.control.valve.term()
+        manager.shutdown()
+
+    assert rasp_water.control.valve.daemon is None
+
+
+def test_valve_daemon_fail(config):
+    import copy
+    import multiprocessing
+
+    import rasp_water.control.valve
+    import rasp_water.control.valve_daemon
+
+    config = copy.deepcopy(config)
+    config["control"]["daemon"] = {"enable": True}
+
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+    rasp_water.control.valve.init(config, queue)
+    daemon = rasp_water.control.valve.daemon
+
+    try:
+        assert rasp_water.control.valve.get_state() == rasp_water.control.valve.VALVE_STATE.CLOSE
+
+        # NOTE: 期限を過ぎたコマンドは実行されない
+        with daemon.lock:
+            daemon.conn.send(
+                {
+                    "id": 0,
+                    "name": "set_state",
+                    "state": rasp_water.control.valve.VALVE_STATE.OPEN.value,
+                    "deadline": 0,
+                }
+            )
+            assert "error" in daemon.conn.recv()
+        assert rasp_water.control.valve.get_state() == rasp_water.control.valve.VALVE_STATE.CLOSE
+
+        # NOTE: 共有メモリのロックが取れない場合は、エラーとして扱う
+        with daemon.shared_state.lock:
+            assert rasp_water.control.valve.get_flow(config["flow"]["offset"])["result"] == "fail"
+            rasp_water.control.valve.sync_metrics()
+            with pytest.raises(rasp_water.control.valve_daemon.DaemonError):
+                rasp_water.control.valve.get_state()
+
+        # NOTE: デーモンが停止した場合は、エラーを通知して再起動する
+        pid = daemon.process.pid
+        daemon.process.kill()
+        while True:
+            stat = queue.get(timeout=10)
+            if stat["type"] == "error":
+                break
+        assert daemon.process.pid != pid
+        assert (
+            rasp_water.control.valve.set_state(rasp_water.control.valve.VALVE_STATE.CLOSE)
+            == rasp_water.control.valve.VALVE_STATE.CLOSE
+        )
+    finally:
+        rasp_water.control.valve.term()
+        manager.shutdown()
+
+
+def stop_server(server, worker):
+    import waitress.wasyncore
+
+    # NOTE: 別のスレッドから閉じると select と競合するので、サーバのスレッドで全ての接続を閉じて終了させる
+    server.trigger.pull_trigger(lambda: waitress.wasyncore.close_all(server._map))  # noqa: SLF001
+    worker.join()
+    server.task_dispatcher.shutdown()
+
+
+def test_webapi_server():
+    import http.client
+    import socket
+    import threading
+    import urllib.error
+    import urllib.request
+
+    import rasp_water.webapi.server
+
+    import flask
+
+    app = flask.Flask("test")
+    stop_event = threading.Event()
+
+    @app.route("/thread")
+    def thread_name():
+        return threading.current_thread().name
+
+    @app.route("/chunk")
+    def chunk():
+        return flask.Response(iter([b"O", b"K"]), mimetype="text/plain")
+
+    @app.route("/stuck")
+    def stuck():
+        stop_event.wait(10)
+        return "OK"
+
+    server = rasp_water.webapi.server.create_server(
+        app,
+        0,
+        {"webapp": {"server": {"thread_count": 1, "timeout_sec": 1, "deadline_sec": 1}}},
+        host="127.0.0.1",
+    )
+    worker = threading.Thread(target=server.run)
+    worker.start()
+
+    try:
+        # NOTE: 送受信が止まった接続はスレッドを使わず、タイムアウトで切断される
+        sock = socket.create_connection(("127.0.0.1", server.effective_port))
+        sock.sendall(b"GET /thread HTTP/1.1\r\n")
+
+        for _ in range(3):
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.effective_port}/thread", timeout=5) as res:
+                assert res.read().decode() == "http_worker_0"
+
+        sock.settimeout(5)
+        assert sock.recv(1024) == b""
+        sock.close()
+
+        # NOTE: HTTP/1.1 では、同じ接続で続けてリクエストを送れる
+        conn = http.client.HTTPConnection("127.0.0.1", server.effective_port, timeout=5)
+        conn.request("GET", "/thread")
+        res = conn.getresponse()
+        assert res.read().decode() == "http_worker_0"
+        keepalive_sock = conn.sock
+
+        conn.request("GET", "/chunk")
+        res = conn.getresponse()
+        assert res.read() == b"OK"
+        assert conn.sock is keepalive_sock
+        conn.close()
+
+        # NOTE: 期限内に終わらないリクエストは 503 になり、スレッドは置き換えられる
+        with pytest.raises(urllib.error.HTTPError) as exc_info:
+            urllib.request.urlopen(f"http://127.0.0.1:{server.effective_port}/stuck", timeout=5)
+        assert exc_info.value.code == 503
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.effective_port}/thread", timeout=5) as res:
+            assert res.read().decode() == "http_worker_1"
+    finally:
+        stop_event.set()
+        stop_server(server, worker)
+
+
+def test_webapi_server_stream():
+    import socket
+    import threading
+    import urllib.request
+
+    import rasp_water.webapi.server
+
+    import flask
+
+    app = flask.Flask("test")
+    stop_event = threading.Event()
+
+    @app.route("/thread")
+    def thread_name():
+        return threading.current_thread().name
+
+    @app.route("/event")
+    def event():
+        def generate():
+            while not stop_event.is_set():
+                yield f"data: {threading.current_thread().name}\n\n"
+                stop_event.wait(0.1)
+
+        return flask.Response(generate(), mimetype="text/event-stream")
+
+    server = rasp_water.webapi.server.create_server(
+        app,
+        0,
+        {"webapp": {"server": {"thread_count": 1, "timeout_sec": 1, "stream_count": 2}}},
+        host="127.0.0.1",
+    )
+    worker = threading.Thread(target=server.run)
+    worker.start()
+
+    def connect():
+        sock = socket.create_connection(("127.0.0.1", server.effective_port))
+        sock.settimeout(5)
+        sock.sendall(b"GET /event HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n")
+        return sock
+
+    try:
+        # NOTE: 応答を送り続けるリクエストは、リクエストを処理するスレッドを占有しない
+        sock_list = [connect() for _ in range(2)]
+        for sock in sock_list:
+            data = b""
+            while b"\n\n" not in data:
+                data += sock.recv(1024)
+            assert b"data: " in data
+            assert b"http_worker" not in data
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.effective_port}/thread", timeout=5) as res:
+            assert res.read().decode() == "http_worker_0"
+
+        # NOTE: 上限を超えた場合は 503
+        sock = connect()
+        assert sock.recv(1024).startswith(b"HTTP/1.1 503")
+        sock.close()
+
+        for sock in sock_list:
+            sock.close()
+    finally:
+        stop_event.set()
+        stop_server(server, worker)
+
+
+def test_metrics_profile(client, config, monkeypatch):
+    import threading
+
+    import rasp_water.metrics.profiler
+
+    # NOTE: 設定で有効にしない限り使えない
+    response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/profile")
+    assert response.status_code == 404
+
+    monkeypatch.setitem(config["metrics"], "profiler", {"enable": True})
+
+    response = client.get(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/profile", query_string={"seconds": "x"}
+    )
+    assert response.status_code == 400
+
+    # NOTE: NaN や無限大、0 以下の値は受け付けない
+    for query_string in [{"seconds": "nan"}, {"seconds": "inf"}, {"seconds": 0}, {"interval": "nan"}]:
+        response = client.get(
+            f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/profile", query_string=query_string
+        )
+        assert response.status_code == 400
+    assert not rasp_water.metrics.profiler.sample_lock.locked()
+
+    worker = threading.Thread(target=time.sleep, args=(1,), name="profile_test")
+    worker.start()
+    response = client.get(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/profile",
+        query_string={"seconds": 0.2, "interval": 10},
+    )
+    worker.join()
+
+    assert response.status_code == 200
+    assert int(response.headers["X-Sample-Count"]) > 0
+    assert any(line.startswith("profile_test;") for line in response.data.decode().splitlines())
+
+    # NOTE: 同時には実行できない
+    with rasp_water.metrics.profiler.sample_lock:
+        response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/profile")
+    assert response.status_code == 409
+
+
+def test_metrics_export(client, config):
+    import rasp_water.metrics.collector
+
+    collector = rasp_water.metrics.collector.get_collector(config["metrics"]["data"])
+    collector.record_watering("auto", 60, 10.0)
+    collector.record_error("valve_control", "ERROR")
+    collector.flush()
+
+    watering_count = len(collector.get_watering_metrics("0001-01-01", "9999-12-31"))
+
+    # NOTE: キーセットページネーションで全ての行が 1 回ずつ読み出される
+    batch_list = list(collector.iter_export("watering", "0001-01-01", "9999-12-31", batch_size=1))
+    assert len(batch_list) == watering_count
+    assert len({batch[0][0] for batch in batch_list}) == watering_count
+
+    response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/export")
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    line_list = response.data.decode().splitlines()
+    assert line_list[0] == "id,timestamp,date,operation_type,duration_seconds,volume_liters"
+    assert len(line_list) == watering_count + 1
+
+    response = client.get(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/export",
+        query_string={"table": "error", "format": "ndjson"},
+    )
+    assert response.status_code == 200
+    row_list = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert row_list[-1]["error_type"] == "valve_control"
+
+    response = client.get(
+        f"{my_lib.webapp.config.URL_PREFIX}/api/metrics/export", query_string={"format": "xml"}
+    )
+    assert response.status_code == 400
+
+
+def test_metrics_openmetrics(client, config):
+    import rasp_water.metrics.collector
+    import rasp_water.metrics.registry
+
+    rasp_water.metrics.collector.get_collector(config["metrics"]["data"])
+
+    watering_count = rasp_water.metrics.registry.WATERING.get(type="manual")
+    rasp_water.metrics.collector.record_watering("manual", 60, config["metrics"]["data"], 10.0)
+    assert rasp_water.metrics.registry.WATERING.get(type="manual") == watering_count + 1
+
+    response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/api/valve_flow")
+    assert response.status_code == 200
+
+    response = client.get(f"{my_lib.webapp.config.URL_PREFIX}/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("application/openmetrics-text")
+
+    text = response.data.decode()
+    assert text.endswith("# EOF\n")
+    assert f'rasp_water_watering_total{{type="manual"}} {watering_count + 1}' in text
+    assert "# TYPE rasp_water_http_request_seconds histogram" in text
+    assert 'endpoint="/rasp-water/api/valve_flow",method="GET",status="200",le="+Inf"' in text
+
+
 def test_second_str():
     import rasp_water.control.webapi.valve
 